@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""Startup benchmark of the translation catalogs.
+
+Builds a bundle with a number of locales, each with a catalog of a
+number of messages, and times what a LanguageComboBox does at activity
+startup: list the available translations and install the one for the
+language, for
+
+  eager  every catalog parsed while listing them, as
+         list_available_translations used to
+  lazy   i18n.list_available_translations, which only parses the
+         catalog installed
+
+'first' is the first combo box, as at startup. 'next' is three more,
+as made for the other canvases, without clearing any cache.
+"""
+
+import os
+import time
+import shutil
+import struct
+import gettext
+import tempfile
+from optparse import OptionParser
+
+import i18n
+
+# Directories of the bundle's locale directory: every language i18n
+# knows, then regional variants of them
+LOCALES = ['cs', 'da', 'de', 'en', 'en_GB', 'en_US', 'es', 'fi', 'fr',
+           'hu', 'it', 'ja', 'ko', 'nl', 'no', 'pl', 'pt', 'pt_BR', 'ru',
+           'sk', 'sv', 'tr', 'zh_CN', 'zh_TW', 'de_AT', 'de_CH', 'es_AR',
+           'es_MX', 'fr_BE', 'fr_CA', 'it_CH', 'nl_BE', 'pt_AO', 'sv_FI']
+
+
+def write_mo(path, messages):
+    """Write messages, a {msgid: msgstr} dict, as a GNU .mo file."""
+    ids = sorted(messages.keys())
+    count = len(ids)
+    ids_start = 28 + 16 * count
+    offsets = []
+    id_data = ''
+    for msgid in ids:
+        offsets.append((len(msgid), ids_start + len(id_data)))
+        id_data += msgid + '\0'
+    strs_start = ids_start + len(id_data)
+    str_data = ''
+    for msgid in ids:
+        offsets.append((len(messages[msgid]), strs_start + len(str_data)))
+        str_data += messages[msgid] + '\0'
+    f = open(path, 'wb')
+    try:
+        f.write(struct.pack('<7I', 0x950412de, 0, count, 28, 28 + 8 * count,
+                            0, 0))
+        for length, offset in offsets:
+            f.write(struct.pack('<2I', length, offset))
+        f.write(id_data + str_data)
+    finally:
+        f.close()
+
+
+def make_bundle(directory, locales, messages):
+    """Write a catalog of messages messages for each of locales."""
+    for code in locales:
+        path = os.path.join(directory, 'locale', code, 'LC_MESSAGES')
+        os.makedirs(path)
+        catalog = {'': 'Content-Type: text/plain; charset=UTF-8\n'}
+        for i in range(messages):
+            catalog['Message number %d' % i] = '%s message %d' % (code, i)
+        write_mo(os.path.join(path, i18n.DOMAIN + '.mo'), catalog)
+
+
+class _EagerLangDetails(i18n.LangDetails):
+    """LangDetails as it was, parsing its catalog when guessed."""
+    gnutranslation = None
+
+    def guess_translation(self, fallback=False):
+        self.gnutranslation = gettext.translation(
+            i18n.DOMAIN, 'locale', [self.code], fallback=fallback)
+
+
+def eager_translations():
+    """Return the translations as list_available_translations used to."""
+    english = _EagerLangDetails('en', 'English', 'united_states')
+    english.guess_translation(True)
+    translations = [english]
+    for name in os.listdir('locale'):
+        if not os.path.isdir('locale/' + name) or name.startswith('.'):
+            continue
+        details = i18n.get_lang_details(name)
+        if details is not None:
+            details = _EagerLangDetails(details.code, details.name,
+                                        details.image)
+            details.guess_translation()
+            translations.append(details)
+    return translations
+
+
+LISTERS = {'eager': eager_translations,
+           'lazy': i18n.list_available_translations}
+
+
+def start(list_translations, code):
+    """List the translations and install the one for code, like the
+    first LanguageComboBox.install does."""
+    translations = list_translations()
+    for exact in (True, False):
+        for details in translations:
+            if details.matches(code, exact):
+                details.install()
+                return
+    translations[0].install()
+
+
+def _reset():
+    """Forget every translation listed or parsed so far."""
+    i18n._available = None
+    i18n._translations.clear()
+    gettext._translations.clear()
+
+
+def run(locales, messages, code, repeat):
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        make_bundle(directory, locales, messages)
+        os.chdir(directory)
+        print '%d locales of %d messages, installing %s' % (
+            len(locales), messages, code)
+        for name in sorted(LISTERS.keys()):
+            first = []
+            later = []
+            for i in range(repeat):
+                _reset()
+                begin = time.time()
+                start(LISTERS[name], code)
+                middle = time.time()
+                for j in range(3):
+                    start(LISTERS[name], code)
+                first.append(middle - begin)
+                later.append(time.time() - middle)
+            print '%-6s first %7.1fms  next 3 %7.1fms' % (
+                name, min(first) * 1000, min(later) * 1000)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+        _reset()
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]',
+                          description='Benchmark loading translations.')
+    parser.add_option('-n', '--locales', type='int', default=len(LOCALES),
+                      help='number of locales, at most %d [%%default]' %
+                      len(LOCALES))
+    parser.add_option('-m', '--messages', type='int', default=2000,
+                      help='messages per catalog [%default]')
+    parser.add_option('-l', '--lang', default='pt_BR',
+                      help='language to install [%default]')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='runs, the best is reported [%default]')
+    options, args = parser.parse_args()
+    run(LOCALES[:options.locales], options.messages, options.lang,
+        options.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""Save and load benchmark of the journal formats.
+
+For each number of polls this saves and loads the same polls in both
+formats and reports the time taken and the file size:
+
+  legacy  the unversioned stream of ten pickles per poll, built by
+          string concatenation as write_file used to
+  journal the versioned format of journal.py, as a snapshot
+
+Loading means decoding every poll completely with journal.read_polls,
+which reads both formats.
+
+With --open it instead opens each file the way read_file does, in a
+fresh process, and reports the time taken and the growth of the
+resident set size. A legacy file is unpickled into complete Polls, as
+read_file used to do. A journal of MAP_THRESHOLD bytes or more is
+memory-mapped, and only its index is decoded into Polls whose bodies
+are read from the mapping when first used.
+"""
+
+import os
+import sys
+import time
+import shutil
+import cPickle
+import resource
+import tempfile
+import subprocess
+from datetime import date
+from optparse import OptionParser
+
+import journal
+from poll import Poll, sha1
+
+
+def make_polls(polls, voters):
+    """Return polls Polls with voters votes each."""
+    today = date.today()
+    shas = [sha1(str(i)).hexdigest() for i in range(voters)]
+    result = []
+    for i in xrange(polls):
+        result.append(Poll(None, 'poll %d' % i, 'kid%d' % (i % 40),
+                           bool(i % 2), today, 1000, 'Question %d?' % i, 3,
+                           {0: 'Yes', 1: 'No', 2: 'Maybe', 3: '', 4: ''},
+                           {0: i % 7, 1: 3, 2: 0, 3: 0, 4: 0},
+                           [(sha, j % 3) for j, sha in enumerate(shas)]))
+    return result
+
+
+def legacy_dumps(polls):
+    """Return polls in the legacy format, built as write_file used to."""
+    s = cPickle.dumps(len(polls))
+    for poll in polls:
+        s += cPickle.dumps(str(poll.title))
+        s += cPickle.dumps(str(poll.author))
+        s += cPickle.dumps(bool(poll.active))
+        s += cPickle.dumps(poll.createdate.toordinal())
+        s += cPickle.dumps(int(poll.maxvoters))
+        s += cPickle.dumps(str(poll.question))
+        s += cPickle.dumps(int(poll.number_of_options))
+        options = {}
+        for key in poll.options:
+            options[int(key)] = str(poll.options[key])
+        data = {}
+        for key in poll.data:
+            data[int(key)] = int(poll.data[key])
+        votes = {}
+        for key in poll.votes:
+            votes[str(key)] = int(poll.votes[key])
+        s += cPickle.dumps(options)
+        s += cPickle.dumps(data)
+        s += cPickle.dumps(votes)
+    return s
+
+
+def save_legacy(path, polls):
+    f = open(path, 'wb')
+    try:
+        f.write(legacy_dumps(polls))
+    finally:
+        f.close()
+
+
+def save_journal(path, polls):
+    f = open(path, 'wb')
+    try:
+        journal.write_polls(f, polls)
+    finally:
+        f.close()
+
+
+def load(path):
+    f = open(path, 'rb')
+    try:
+        return journal.read_polls(f)
+    finally:
+        f.close()
+
+
+def open_legacy(path):
+    """Return the polls at path, decoded as read_file used to."""
+    return [Poll(None, *fields) for fields in load(path)]
+
+
+def open_journal(path):
+    """Return the polls at path, read as read_file does."""
+    f = open(path, 'rb')
+    try:
+        return [Poll(None, title, author, active, createdate, maxvoters,
+                     number_of_options=number_of_options,
+                     load_body=load_body)
+                for (title, author, active, createdate, maxvoters,
+                     number_of_options, load_body) in journal.read_index(f)]
+    finally:
+        f.close()
+
+
+FORMATS = [('legacy', save_legacy), ('journal', save_journal)]
+OPENERS = {'legacy': open_legacy, 'journal': open_journal}
+
+
+def _timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def run(sizes, voters):
+    """Print the save and load times and sizes for each of sizes."""
+    directory = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            polls = make_polls(size, voters)
+            for name, save in FORMATS:
+                path = os.path.join(directory, name)
+                saving = _timed(save, path, polls)
+                loading = _timed(load, path)
+                print '%7d polls %-7s save %6.2fs  load %6.2fs  %9d bytes' % (
+                    size, name, saving, loading, os.path.getsize(path))
+    finally:
+        shutil.rmtree(directory)
+
+
+def _rss():
+    """Return the resident set size in KB.
+
+    The peak from getrusage would be the parent's for a child process,
+    so the current size is read from /proc where there is one.
+    """
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        pages = int(f.read().split()[1])
+    finally:
+        f.close()
+    return pages * resource.getpagesize() / 1024
+
+
+def _open_child(name, path):
+    """Open path with the opener name and print seconds and KB."""
+    before = _rss()
+    start = time.time()
+    polls = OPENERS[name](path)
+    elapsed = time.time() - start
+    print elapsed, _rss() - before
+
+
+def run_open(sizes, voters):
+    """Print the time and memory taken to open each of sizes polls."""
+    directory = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            polls = make_polls(size, voters)
+            for name, save in FORMATS:
+                path = os.path.join(directory, name)
+                save(path, polls)
+                child = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__),
+                     '--open-child', name, path], stdout=subprocess.PIPE)
+                output = child.communicate()[0].split()
+                print '%7d polls %-7s open %6.2fs  +%7.1f MB RSS' % (
+                    size, name, float(output[-2]), int(output[-1]) / 1024.0)
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [polls...]',
+                          description='Benchmark saving and loading polls.')
+    parser.add_option('-v', '--voters', type='int', default=10,
+                      help='voters per poll [%default]')
+    parser.add_option('-o', '--open', action='store_true', default=False,
+                      help='measure opening files instead')
+    parser.add_option('--open-child', help='(internal)')
+    options, args = parser.parse_args()
+    if options.open_child:
+        _open_child(options.open_child, args[0])
+        return
+    sizes = [int(arg) for arg in args] or [1000, 10000, 100000]
+    if options.open:
+        run_open(sizes, options.voters)
+    else:
+        run(sizes, options.voters)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""Memory benchmark of Poll: resident memory per poll for many polls.
+
+Each layout is measured in a child process of its own, as the growth
+of its peak resident set size while it builds the polls:
+
+  slots   poll.Poll, with array tallies and interned voter sha1s
+  dicts   the same fields in three dicts per poll, voters keyed by
+          their own sha1 strings, as Poll kept them before
+
+Voter sha1s are built afresh for every poll, as they are when decoded
+from a journal or received from the mesh.
+"""
+
+import os
+import sys
+import logging
+import resource
+from datetime import date
+from optparse import OptionParser
+
+from poll import Poll, sha1
+
+
+class _DictPoll(object):
+    """A poll laid out as Poll was before it had slots."""
+    def __init__(self, activity, title, author, active, createdate,
+                 maxvoters, question, number_of_options, options, data,
+                 votes):
+        self._logger = logging.getLogger('poll-activity.Poll')
+        self.activity = activity
+        self.title = title
+        self.author = author
+        self.active = active
+        self.createdate = createdate
+        self.maxvoters = maxvoters
+        self.question = question
+        self.number_of_options = number_of_options
+        self.options = options
+        self.data = data
+        self.votes = dict(votes)
+
+
+LAYOUTS = {'slots': Poll, 'dicts': _DictPoll}
+
+
+def make_polls(cls, polls, voters):
+    """Return polls instances of cls with voters votes each."""
+    today = date.today()
+    shas = [sha1(str(i)).hexdigest() for i in range(voters)]
+    result = []
+    for i in xrange(polls):
+        votes = [(''.join(sha), j % 3) for j, sha in enumerate(shas)]
+        result.append(cls(None, 'poll %d' % i, 'kid%d' % (i % 40), True,
+                          today, voters, 'Question %d?' % i, 3,
+                          {0: 'Yes', 1: 'No', 2: 'Maybe'},
+                          {0: voters - voters * 2 / 3, 1: voters / 3,
+                           2: voters / 3}, votes))
+    return result
+
+
+def _max_rss():
+    """Return the peak resident set size in KB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(layout, polls, voters):
+    """Return the KB of resident memory each poll takes in layout.
+
+    Runs in a child process, so layouts do not share freed memory.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        before = _max_rss()
+        kept = make_polls(LAYOUTS[layout], polls, voters)
+        os.write(write_fd, '%f' % ((_max_rss() - before) * 1.0 / polls))
+        os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 100)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return float(result)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [layout...]',
+                          description='Measure the memory used per poll.')
+    parser.add_option('-n', '--polls', type='int', default=10000,
+                      help='number of polls [%default]')
+    parser.add_option('-v', '--voters', type='int', default=20,
+                      help='voters per poll [%default]')
+    options, layouts = parser.parse_args()
+    for layout in layouts or sorted(LAYOUTS.keys()):
+        if layout not in LAYOUTS:
+            parser.error('unknown layout %s' % layout)
+        print '%-6s %d polls, %d voters each: %.2f KB per poll' % (
+            layout, options.polls, options.voters,
+            measure(layout, options.polls, options.voters))
+
+
+if __name__ == '__main__':
+    main()
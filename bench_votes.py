@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""Benchmark of a burst of votes on one shared poll.
+
+A class of simulated peers on a loopback.LoopbackBus share the
+teacher's poll, then the others cast a number of votes on it, spread
+evenly over a burst. For each vote window (PollSession.vote_window,
+given as arguments in ms) this reports
+
+  signals  Votes signals sent during the burst, and per second
+  alerts   vote alerts shown by each peer
+  latency  mean and longest time from a vote being cast to it being
+           counted in another peer's copy of the poll
+
+A window of 0 sends each vote on its own as soon as it is cast, as the
+Vote signal used to, with an alert for each.
+"""
+
+import time
+import random
+from datetime import date
+from optparse import OptionParser
+
+import gobject
+
+from loopback import LoopbackBus, _LoadPeer
+from poll import Poll
+
+
+class _TimedPeer(_LoadPeer):
+    """_LoadPeer which records when the votes it merges were cast."""
+    def __init__(self, bus, nick, initiator, cast):
+        """Create the _TimedPeer.
+
+        cast -- dict, (votersha, choice, count) -> time the vote was cast
+        """
+        _LoadPeer.__init__(self, bus, nick, initiator)
+        self._cast = cast
+        self._seen = {}  # (votersha, choice) -> highest count merged
+        self.latencies = []
+
+    def vote_on_poll(self, author, title, choice, votersha, count=None,
+                     alert=True):
+        merged = _LoadPeer.vote_on_poll(self, author, title, choice,
+                                        votersha, count, alert)
+        if merged and count is not None:
+            now = time.time()
+            key = (votersha, choice)
+            # A count can stand for several votes sent together
+            for n in range(self._seen.get(key, 0) + 1, count + 1):
+                self.latencies.append(now - self._cast[key + (n,)])
+            self._seen[key] = max(self._seen.get(key, 0), count)
+        return merged
+
+
+def run_burst(window, peers=40, votes=500, burst=2000, latency=5, seed=0):
+    """Share a poll among peers, then cast votes on it in a burst.
+
+    window -- integer, ms of PollSession.vote_window
+    peers -- integer, number of simulated laptops
+    votes -- integer, votes cast in the burst
+    burst -- integer, ms the votes are spread over
+    latency -- integer, ms each message takes to arrive
+    seed -- integer, for the random choice of votes
+
+    Returns a dict of the measurements.
+    """
+    rand = random.Random(seed)
+    bus = LoopbackBus(latency)
+    cast = {}
+    everybody = [_TimedPeer(bus, 'peer%d' % i, i == 0, cast)
+                 for i in range(peers)]
+    teacher = everybody[0]
+    teacher._polls.add(Poll(teacher, 'Lunch', teacher.nick, True,
+                            date.today(), votes, 'What would you like?', 3,
+                            {0: 'Pasta', 1: 'Rice', 2: 'Soup'},
+                            {0: 0, 1: 0, 2: 0}, {}))
+    state = {'cast': 0, 'start': None, 'signals': 0}
+    counts = {}  # (votersha, choice) -> votes cast
+
+    def vote_cb():
+        peer = rand.choice(everybody[1:])
+        choice = rand.randint(0, 2)
+        key = (peer.nick_sha1, choice)
+        counts[key] = counts.get(key, 0) + 1
+        cast[key + (counts[key],)] = time.time()
+        poll = peer._polls.find(teacher.nick, 'Lunch')
+        poll.register_vote(choice, peer.nick_sha1)
+        peer._polls.vote_registered(poll, choice, peer.nick_sha1)
+        state['cast'] += 1
+        return False
+
+    def start_burst():
+        for peer in everybody:
+            peer.poll_session.vote_window = window
+            peer.alerts = 0
+        state['signals'] = bus.signals
+        state['start'] = time.time()
+        for i in range(votes):
+            gobject.timeout_add(burst * i // votes, vote_cb)
+
+    def counted():
+        for peer in everybody:
+            poll = peer._polls.find(teacher.nick, 'Lunch')
+            if poll is None or poll.vote_count != state['cast']:
+                return False
+        return True
+
+    def check_cb():
+        if bus.pending or not counted():
+            return True
+        if state['start'] is None:
+            start_burst()
+            return True
+        if state['cast'] < votes:
+            return True
+        # Let the last vote alerts go off
+        gobject.timeout_add(window + 100, loop.quit)
+        return False
+
+    loop = gobject.MainLoop()
+    for peer in everybody:
+        peer.join()
+    gobject.timeout_add(50, check_cb)
+    loop.run()
+    tallies = [dict(peer._polls.find(teacher.nick, 'Lunch').data)
+               for peer in everybody]
+    latencies = []
+    for peer in everybody:
+        latencies.extend(peer.latencies)
+    signals = bus.signals - state['signals']
+    return {
+        'window': window,
+        'signals': signals,
+        'rate': signals * 1000.0 / burst,
+        'alerts': sum([peer.alerts for peer in everybody]) / float(peers),
+        'mean': sum(latencies) * 1000 / max(len(latencies), 1),
+        'max': max(latencies + [0]) * 1000,
+        'agreed': tallies.count(tallies[0]) == len(tallies),
+    }
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [window ms...]',
+                          description='Benchmark a burst of votes.')
+    parser.add_option('-n', '--peers', type='int', default=40,
+                      help='number of simulated peers [%default]')
+    parser.add_option('-v', '--votes', type='int', default=500,
+                      help='votes in the burst [%default]')
+    parser.add_option('-b', '--burst', type='int', default=2000,
+                      help='ms the votes are spread over [%default]')
+    parser.add_option('-l', '--latency', type='int', default=5,
+                      help='ms per message [%default]')
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='random seed [%default]')
+    options, args = parser.parse_args()
+    windows = [int(arg) for arg in args] or [0, 250, 500]
+    print '%d peers, %d votes in %dms' % (options.peers, options.votes,
+                                          options.burst)
+    print '%6s %8s %9s %7s %9s %8s' % ('window', 'signals', 'signals/s',
+                                       'alerts', 'mean ms', 'max ms')
+    for window in windows:
+        result = run_burst(window, options.peers, options.votes,
+                           options.burst, options.latency, options.seed)
+        print ('%(window)6d %(signals)8d %(rate)9.0f %(alerts)7.1f '
+               '%(mean)9.0f %(max)8.0f' % result),
+        if not result['agreed']:
+            print ' copies differ',
+        print
+
+
+if __name__ == '__main__':
+    main()
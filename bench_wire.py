@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""Benchmark of the UpdatedPoll payload: the old signature against wire.py.
+
+For polls with a growing number of voters this reports the size of
+one poll on the wire and the time to encode and decode it, for
+
+  old   the 'ssuuusua{us}a{uu}a{su}' arguments UpdatedPoll used to
+        carry, with the {voter: choice} map
+  wire  the 'ay' payload of wire.encode_poll
+
+The old size is that of the D-Bus message body, worked out from the
+D-Bus marshalling rules. Its times are those of the Python side only:
+building the dict arguments, and converting every received key and
+value as updatedpoll_cb used to. The time dbus-python takes to build
+two D-Bus objects per voter is not included, so the old times are on
+the low side.
+"""
+
+import timeit
+from datetime import date
+from optparse import OptionParser
+
+import wire
+from poll import Poll, sha1
+
+
+def make_poll(voters):
+    """Return a poll with one vote by each of voters voters."""
+    return Poll(None, 'Lunch', 'teacher', True, date.today(), voters * 2,
+                'What would you like for lunch?', 3,
+                {0: 'Pasta', 1: 'Rice', 2: 'Soup'}, {0: 0, 1: 0, 2: 0},
+                [(sha1('kid%d' % i).hexdigest(), i % 3)
+                 for i in range(voters)])
+
+
+def old_args(poll):
+    """Return poll as the arguments of the old UpdatedPoll."""
+    return (poll.title, poll.author, poll.active,
+            poll.createdate.toordinal(), poll.maxvoters, poll.question,
+            poll.number_of_options, dict(poll.options), dict(poll.data),
+            dict(poll.votes))
+
+
+def old_decode(title, author, active, createdate, maxvoters, question,
+               number_of_options, options_d, data_d, votes_d):
+    """Convert the old arguments as updatedpoll_cb used to."""
+    options = {}
+    for key in options_d:
+        options[int(key)] = str(options_d[key])
+    data = {}
+    for key in data_d:
+        data[int(key)] = int(data_d[key])
+    votes = {}
+    for key in votes_d:
+        votes[str(key)] = int(votes_d[key])
+    return (str(title), str(author), bool(active),
+            date.fromordinal(int(createdate)), int(maxvoters), str(question),
+            int(number_of_options), options, data, votes)
+
+
+def old_size(args):
+    """Return the size of the D-Bus body of the old arguments."""
+    size = [0]
+
+    def align(boundary):
+        size[0] += -size[0] % boundary
+
+    def string(value):
+        align(4)
+        size[0] += 4 + len(value) + 1
+
+    def uint32(value):
+        align(4)
+        size[0] += 4
+
+    def dictionary(value, key_type, value_type):
+        uint32(len(value))
+        align(8)
+        for key in value:
+            align(8)
+            key_type(key)
+            value_type(value[key])
+
+    (title, author, active, createdate, maxvoters, question,
+     number_of_options, options, data, votes) = args
+    string(title)
+    string(author)
+    uint32(active)
+    uint32(createdate)
+    uint32(maxvoters)
+    string(question)
+    uint32(number_of_options)
+    dictionary(options, uint32, string)
+    dictionary(data, uint32, uint32)
+    dictionary(votes, string, uint32)
+    return size[0]
+
+
+def _best(function, number):
+    """Return the best time in ms of calling function number times."""
+    return min(timeit.repeat(function, number=number, repeat=3)) / number \
+        * 1000
+
+
+def run(voter_counts):
+    print '%6s %9s %9s %10s %10s %10s %10s' % (
+        'voters', 'old B', 'wire B', 'old enc', 'wire enc', 'old dec',
+        'wire dec')
+    for voters in voter_counts:
+        poll = make_poll(voters)
+        args = old_args(poll)
+        payload = wire.encode_poll(poll)
+        number = max(1, 20000 / voters)
+        print '%6d %9d %9d %8.3fms %8.3fms %8.3fms %8.3fms' % (
+            voters, old_size(args), len(payload),
+            _best(lambda: old_args(poll), number),
+            _best(lambda: wire.encode_poll(poll), number),
+            _best(lambda: old_decode(*args), number),
+            _best(lambda: wire.decode_poll(payload), number))
+
+
+def main():
+    parser = OptionParser(usage='%prog [voters...]',
+                          description='Benchmark the poll wire format.')
+    options, args = parser.parse_args()
+    run([int(arg) for arg in args] or [10, 100, 1000, 10000])
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,7 @@
 ### (c) 2007 World Wide Workshop Foundation
 
 import os
+import errno
 import gettext
 import locale
 
@@ -62,15 +63,46 @@ lang_name_mapping = {
     'tr':(None, _('Turkish'),'turkey'),
     }
 
+DOMAIN = 'org.worldwideworkshop.olpc.SliderPuzzle'
+
+# Translations parsed so far, by language code. Only the one installed
+# is ever needed, so they are parsed on first use rather than up front.
+_translations = {}
+
+# Result of list_available_translations, which only changes with the
+# bundle
+_available = None
+
 class LangDetails (object):
     def __init__ (self, code, name, image):
         self.code = code
         self.country_code = self.code.split('_')[0]
         self.name = name
         self.image = image
+        self._fallback = True
 
     def guess_translation (self, fallback=False):
-        self.gnutranslation = gettext.translation('org.worldwideworkshop.olpc.SliderPuzzle', 'locale', [self.code], fallback=fallback)
+        """Check there is a translation for this language.
+
+        Like gettext.translation this raises IOError if there is none,
+        unless fallback is True, but the file is only parsed when the
+        translation is first used.
+        """
+        self._fallback = fallback
+        if not fallback and gettext.find(DOMAIN, 'locale', [self.code]) is None:
+            raise IOError(errno.ENOENT,
+                          'No translation file found for domain', DOMAIN)
+
+    def _get_gnutranslation (self):
+        try:
+            return _translations[self.code]
+        except KeyError:
+            translation = gettext.translation(DOMAIN, 'locale', [self.code],
+                                              fallback=self._fallback)
+            _translations[self.code] = translation
+            return translation
+
+    gnutranslation = property(_get_gnutranslation)
 
     def install (self):
         self.gnutranslation.install()
@@ -93,6 +125,9 @@ def get_lang_details (lang):
     return LangDetails(lang, mapping[0], mapping[2])
 
 def list_available_translations ():
+    global _available
+    if _available is not None:
+        return list(_available)
     rv = [get_lang_details('en')]
     rv[0].guess_translation(True)
     for i,x in enumerate([x for x in os.listdir('locale') if os.path.isdir('locale/' + x) and not x.startswith('.')]):
@@ -104,7 +139,8 @@ def list_available_translations ():
         except:
             raise
             pass
-    return rv
+    _available = rv
+    return list(rv)
 
 class LanguageComboBox (gtk.ComboBox):
     def __init__ (self):
@@ -151,6 +187,80 @@ class LanguageComboBox (gtk.ComboBox):
         return False
 
 ###
+# Lesson files found at bundle build time, see gather_other_translations
+LESSON_MANIFEST = os.path.join('lessons', 'manifest')
+
+def scan_lessons (basepath='.'):
+    """Return {lesson: list of .abw file names} of the lesson directories.
+
+    basepath -- string, path of the bundle
+    """
+    lessons = {}
+    top = os.path.join(basepath, 'lessons')
+    for lesson in os.listdir(top):
+        path = os.path.join(top, lesson)
+        if os.path.isdir(path):
+            lessons[lesson] = sorted(filter(lambda x: x.endswith('.abw'),
+                                            os.listdir(path)))
+    return lessons
+
+def write_lesson_manifest (lessons, basepath='.'):
+    """Write lessons, as returned by scan_lessons, to LESSON_MANIFEST.
+
+    Each line is a lesson followed by its file names, separated by tabs.
+    """
+    f = file(os.path.join(basepath, LESSON_MANIFEST), 'w')
+    for lesson in sorted(lessons.keys()):
+        f.write('\t'.join([lesson] + lessons[lesson]) + '\n')
+    f.close()
+
+def read_lesson_manifest (basepath='.'):
+    """Return the lessons in LESSON_MANIFEST like scan_lessons, or None
+    if there is no manifest."""
+    try:
+        f = file(os.path.join(basepath, LESSON_MANIFEST))
+    except IOError:
+        return None
+    lessons = {}
+    try:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            lessons[fields[0]] = fields[1:]
+    finally:
+        f.close()
+    return lessons
+
+def find_lessons (basepath='.', code=None, rescan=False):
+    """Return a sorted list of (lesson, path of the file to show).
+
+    basepath -- string, path of the bundle
+    code -- string, locale code such as 'pt_BR', or None
+    rescan -- boolean, True to ignore LESSON_MANIFEST, e.g. because a
+      file it lists is missing
+
+    The file is the one for code, else for its language, else
+    default.abw. Without rescan this only reads LESSON_MANIFEST, unless
+    the bundle has none; then the lesson directories are scanned.
+    """
+    lessons = None
+    if not rescan:
+        lessons = read_lesson_manifest(basepath)
+    if lessons is None:
+        lessons = scan_lessons(basepath)
+    names = ['default.abw']
+    if code:
+        names[:0] = ['_%s.abw' % code.lower(),
+                     '_%s.abw' % code.split('_')[0].lower()]
+    found = []
+    for lesson in sorted(lessons.keys()):
+        files = lessons[lesson]
+        for name in names:
+            if name in files:
+                found.append((lesson, os.path.join(basepath, 'lessons',
+                                                   lesson, name)))
+                break
+    return found
+
 def gather_other_translations ():
     from glob import glob
     entries = filter(lambda x: os.path.isdir(x), glob('images/*'))
@@ -160,6 +270,7 @@ def gather_other_translations ():
     for e in entries:
         f.write('_("%s")\n' % e)
     f.close()
+    write_lesson_manifest(scan_lessons())
 
 if __name__ == '__main__':
     gather_other_translations()
@@ -0,0 +1,729 @@
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""Journal file format for the Poll activity.
+
+Version 2 of the format is laid out as follows, all integers big-endian:
+
+  header    'POLLJRNL', uint16 version
+  snapshot  a poll section, see below
+  log       zero or more change records, see below
+
+A poll section is split into an index, which is all the select screen
+needs, and the poll bodies, which are only decoded when a poll is
+opened:
+
+  uint32 number of polls
+  index strings   string table of titles and authors
+  index           per poll: uint32 title, uint32 author (index strings),
+                  uint8 active, uint32 createdate ordinal,
+                  uint32 maxvoters, uint8 number_of_options,
+                  uint32 offset of the body
+  body strings    string table of questions, options and voter sha1s
+  bodies          uint32 total length, then per poll:
+                    uint32 question (body strings)
+                    uint8 option count, then per option uint8 key,
+                      uint32 text
+                    uint8 tally count, then one uint32 per tally
+                    uint32 vote count, then per vote uint32 voter,
+                      uint8 choice; a voter who voted more than once
+                      has one entry per vote
+
+A string table is a uint32 count, then one uint32 end offset per string
+and the concatenated string bytes.
+
+Each change record is a uint32 length, that many bytes of record body
+and a uint32 CRC-32 of the body. The body starts with a uint8 record
+type:
+
+  POLL      a poll section holding the one added or changed poll
+  DELETE    author, title
+  VOTE      author, title, uint8 choice, votersha
+
+where each string is a uint32 length followed by the bytes. Replay stops
+at the first truncated or corrupt record, so a save interrupted while
+appending loses only the changes it was writing.
+
+Journals larger than MAP_THRESHOLD bytes are memory-mapped rather than
+read, and the tallies and votes of their polls are read straight from
+the mapping (see MappedTally and MappedVotes) until they are changed.
+
+Files written before the format was versioned are a stream of pickled
+fields, ten per poll; read_polls() detects and loads those too.
+Version 1 was never released and is not read.
+"""
+
+import os
+import mmap
+import shutil
+import cPickle
+import logging
+import struct
+import zlib
+from cStringIO import StringIO
+from datetime import date
+
+MAGIC = 'POLLJRNL'
+VERSION = 2
+
+# Journals at least this large are memory-mapped by read_index()
+MAP_THRESHOLD = 64 * 1024
+
+# Default compaction thresholds for JournalWriter
+COMPACT_RECORDS = 500
+COMPACT_RATIO = 1.0
+
+RECORD_POLL = 1
+RECORD_DELETE = 2
+RECORD_VOTE = 3
+
+_HEADER = struct.Struct('>%dsH' % len(MAGIC))
+_COUNT = struct.Struct('>I')
+_INDEX = struct.Struct('>IIBIIBI')
+_BODY = struct.Struct('>IB')
+_OPTION = struct.Struct('>BI')
+_SMALL_COUNT = struct.Struct('>B')
+_VOTE = struct.Struct('>IB')
+
+_logger = logging.getLogger('poll-activity.journal')
+
+
+def _to_str(value):
+    """Convert a (possibly dbus) string to a byte string."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class _StringTable(object):
+    """Assign each distinct string an index, in order of first use."""
+    def __init__(self):
+        self._index = {}
+        self.strings = []
+
+    def add(self, value):
+        try:
+            return self._index[value]
+        except KeyError:
+            index = len(self.strings)
+            self._index[value] = index
+            self.strings.append(_to_str(value))
+            return index
+
+    def encode(self):
+        ends = []
+        end = 0
+        for value in self.strings:
+            end += len(value)
+            ends.append(end)
+        return (_COUNT.pack(len(ends)) +
+                struct.pack('>%dI' % len(ends), *ends) +
+                ''.join(self.strings))
+
+
+def _decode_string_table(buf, offset):
+    """Return the strings of the table at offset and the offset after it."""
+    (count,) = _COUNT.unpack_from(buf, offset)
+    offset += _COUNT.size
+    ends = struct.unpack_from('>%dI' % count, buf, offset)
+    offset += 4 * count
+    strings = []
+    start = 0
+    for end in ends:
+        strings.append(buf[offset + start:offset + end])
+        start = end
+    return strings, offset + start
+
+
+def _skip_string_table(buf, offset):
+    """Return the offset following the string table at offset."""
+    (count,) = _COUNT.unpack_from(buf, offset)
+    offset += _COUNT.size
+    if not count:
+        return offset
+    (length,) = _COUNT.unpack_from(buf, offset + 4 * (count - 1))
+    return offset + 4 * count + length
+
+
+def write_polls(f, polls):
+    """Write polls to the open file f as a snapshot with no log.
+
+    polls -- sequence of Poll
+    """
+    f.write(_HEADER.pack(MAGIC, VERSION) + _encode_polls(polls))
+
+
+def read_index(f):
+    """Read the poll index from the open file f, replaying any change log.
+
+    Returns a list of (title, author, active, createdate, maxvoters,
+    number_of_options, load_body) tuples. load_body is a function
+    returning the (question, options, data, votes) of the poll, which
+    are only decoded when it is called. data and votes may be a
+    MappedTally and MappedVotes rather than dicts.
+
+    If the file is memory-mapped, the mapping stays open for as long as
+    any of the returned functions or mapped values are referenced. The
+    file must therefore be replaced, not rewritten in place, while they
+    are in use; JournalWriter snapshots do that.
+    """
+    buf = _map(f)
+    if buf[:len(MAGIC)] != MAGIC:
+        if isinstance(buf, mmap.mmap):
+            buf = buf[:]
+        return [fields[:5] + (fields[6], _loaded(fields[5], fields[7],
+                                                 fields[8], fields[9]))
+                for fields in _read_legacy_polls(buf)]
+    magic, version = _HEADER.unpack_from(buf)
+    if version != VERSION:
+        raise ValueError('Unsupported journal version %d' % version)
+    section = _PollSection(buf, _HEADER.size)
+    by_key = {}
+    for entry in section.entries():
+        by_key[(entry[1], entry[0])] = entry
+    _replay_log(buf, section.end, by_key)
+    return [tuple(entry) for entry in by_key.values()]
+
+
+def read_polls(f):
+    """Read polls from the open file f, replaying any change log.
+
+    Returns a list of (title, author, active, createdate, maxvoters,
+    question, number_of_options, options, data, votes) tuples, in the
+    order of the Poll constructor arguments following activity. votes
+    is a list of (votersha, choice) pairs, one per vote, except in files
+    written before the format was versioned where it is a dict.
+    """
+    polls = []
+    for (title, author, active, createdate, maxvoters, number_of_options,
+         load_body) in read_index(f):
+        question, options, data, votes = _unmap(*load_body())
+        polls.append((title, author, active, createdate, maxvoters,
+                      question, number_of_options, options, data, votes))
+    return polls
+
+
+def _loaded(*body):
+    """Return a load_body function for an already decoded body."""
+    return lambda: body
+
+
+def _unmap(question, options, data, votes):
+    """Return a poll body with any mapped tally or votes decoded.
+
+    A mapped tally becomes a dict and mapped votes a list of
+    (votersha, choice), one per vote.
+    """
+    if isinstance(data, MappedTally):
+        data = dict(enumerate(data))
+    if isinstance(votes, MappedVotes):
+        votes = votes.items()
+    return question, options, data, votes
+
+
+def _map(f):
+    """Return the contents of the open file f, mapped if it is large."""
+    try:
+        size = os.fstat(f.fileno()).st_size
+    except (AttributeError, OSError):
+        return f.read()
+    if size < MAP_THRESHOLD:
+        return f.read()
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        return f.read()
+
+
+class MappedTally(object):
+    """Read-only sequence of the uint32 tallies of a poll in a buffer."""
+    __slots__ = ('_buf', '_offset', '_len')
+
+    def __init__(self, buf, offset, length):
+        self._buf = buf
+        self._offset = offset
+        self._len = length
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, choice):
+        if not 0 <= choice < self._len:
+            raise IndexError(choice)
+        return _COUNT.unpack_from(self._buf, self._offset + 4 * choice)[0]
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def tolist(self):
+        return list(struct.unpack_from('>%dI' % self._len, self._buf,
+                                       self._offset))
+
+
+class MappedVotes(object):
+    """Read-only votes of a poll in a buffer, decoded when iterated."""
+    __slots__ = ('_section', '_offset', '_len')
+
+    def __init__(self, section, offset, length):
+        self._section = section
+        self._offset = offset
+        self._len = length
+
+    def __len__(self):
+        return self._len
+
+    def iteritems(self):
+        """Yield (votersha, choice) pairs."""
+        strings = self._section.body_strings()
+        fields = struct.unpack_from('>' + 'IB' * self._len,
+                                    self._section.buf, self._offset)
+        for i in xrange(0, len(fields), 2):
+            yield strings[fields[i]], fields[i + 1]
+
+    def items(self):
+        return list(self.iteritems())
+
+
+def _encode_polls(polls):
+    """Return a poll section holding polls."""
+    heads = _StringTable()
+    strings = _StringTable()
+    add = strings.add
+    index = []
+    bodies = []
+    append = bodies.append
+    body_offset = 0
+    for poll in polls:
+        question, options, data, votes = poll.body()
+        if hasattr(votes, 'items'):
+            votes = votes.items()
+        index.append(_INDEX.pack(
+            heads.add(poll.title), heads.add(poll.author),
+            bool(poll.active), poll.createdate.toordinal(),
+            int(poll.maxvoters), int(poll.number_of_options),
+            body_offset))
+        fields = [add(question), len(options)]
+        for key in options:
+            fields.extend((int(key), add(options[key])))
+        if isinstance(data, MappedTally):
+            tally = data.tolist()
+        else:
+            tally = [int(data[key]) for key in sorted(data.keys())]
+        fields.append(len(tally))
+        fields.extend(tally)
+        fields.append(len(votes))
+        for votersha, choice in votes:
+            fields.extend((add(votersha), int(choice)))
+        body = struct.pack('>IB%sB%dII%s' % ('BI' * len(options), len(tally),
+                                             'IB' * len(votes)), *fields)
+        append(body)
+        body_offset += len(body)
+
+    return ''.join([_COUNT.pack(len(index)), heads.encode()] + index +
+                   [strings.encode(), _COUNT.pack(body_offset)] + bodies)
+
+
+class _PollSection(object):
+    """A poll section of a journal buffer, with bodies decoded on demand."""
+    def __init__(self, buf, offset):
+        self.buf = buf
+        (num_polls,) = _COUNT.unpack_from(buf, offset)
+        offset += _COUNT.size
+        self._heads, offset = _decode_string_table(buf, offset)
+        self._index = struct.unpack_from('>' + 'IIBIIBI' * num_polls,
+                                         buf, offset)
+        offset += _INDEX.size * num_polls
+        self._strings_offset = offset
+        self._strings = None
+        offset = _skip_string_table(buf, offset)
+        (length,) = _COUNT.unpack_from(buf, offset)
+        self._bodies_offset = offset + _COUNT.size
+        self.end = self._bodies_offset + length
+
+    def entries(self):
+        """Return a list of read_index() entries, as lists."""
+        heads = self._heads
+        index = self._index
+        fromordinal = date.fromordinal
+        entries = []
+        for i in xrange(0, len(index), 7):
+            entries.append([heads[index[i]], heads[index[i + 1]],
+                            bool(index[i + 2]), fromordinal(index[i + 3]),
+                            index[i + 4], index[i + 5],
+                            self._body_loader(index[i + 6])])
+        return entries
+
+    def _body_loader(self, body_offset):
+        return lambda: self._load_body(body_offset)
+
+    def body_strings(self):
+        """Return the body string table, decoding it on first use."""
+        if self._strings is None:
+            self._strings, end = _decode_string_table(self.buf,
+                                                      self._strings_offset)
+        return self._strings
+
+    def _load_body(self, body_offset):
+        buf = self.buf
+        strings = self.body_strings()
+        offset = self._bodies_offset + body_offset
+        question, num_options = _BODY.unpack_from(buf, offset)
+        offset += _BODY.size
+        fields = struct.unpack_from('>' + 'BI' * num_options, buf, offset)
+        offset += _OPTION.size * num_options
+        options = {}
+        for i in xrange(0, len(fields), 2):
+            options[fields[i]] = strings[fields[i + 1]]
+
+        (num_tallies,) = _SMALL_COUNT.unpack_from(buf, offset)
+        offset += _SMALL_COUNT.size
+        data = MappedTally(buf, offset, num_tallies)
+        offset += 4 * num_tallies
+
+        (num_votes,) = _COUNT.unpack_from(buf, offset)
+        offset += _COUNT.size
+        votes = MappedVotes(self, offset, num_votes)
+        return strings[question], options, data, votes
+
+
+def _encode_string(value):
+    value = _to_str(value)
+    return _COUNT.pack(len(value)) + value
+
+
+def _decode_string(buf, offset):
+    (length,) = _COUNT.unpack_from(buf, offset)
+    offset += _COUNT.size
+    return buf[offset:offset + length], offset + length
+
+
+def _encode_record(body):
+    return (_COUNT.pack(len(body)) + body +
+            _COUNT.pack(zlib.crc32(body) & 0xffffffff))
+
+
+def _log_records(buf, offset):
+    """Yield (body, offset after it) for the change records in buf.
+
+    offset -- integer, where the log starts
+
+    Stops at the first truncated or corrupt record.
+    """
+    end = len(buf)
+    while offset + _COUNT.size <= end:
+        (length,) = _COUNT.unpack_from(buf, offset)
+        body_start = offset + _COUNT.size
+        body_end = body_start + length
+        if length == 0 or body_end + _COUNT.size > end:
+            return
+        body = buf[body_start:body_end]
+        (crc,) = _COUNT.unpack_from(buf, body_end)
+        if zlib.crc32(body) & 0xffffffff != crc:
+            return
+        offset = body_end + _COUNT.size
+        yield body, offset
+
+
+def _replay_log(buf, offset, by_key):
+    """Apply the change records in buf from offset to the polls by_key.
+
+    by_key -- dict of (author, title): read_index() entry, as a list
+    """
+    for body, offset in _log_records(buf, offset):
+        _apply_record(body, by_key)
+    if offset < len(buf):
+        _logger.warning('Ignoring %d bytes of truncated or corrupt journal '
+                        'log', len(buf) - offset)
+
+
+def _log_extent(f):
+    """Return (snapshot size, log records, size) of the journal f.
+
+    size is that of the snapshot and the intact records, so it is less
+    than the file size if the log has a truncated or corrupt tail.
+    Returns None if f is not a journal of the current version.
+    """
+    buf = _map(f)
+    if buf[:len(MAGIC)] != MAGIC:
+        return None
+    magic, version = _HEADER.unpack_from(buf)
+    if version != VERSION:
+        return None
+    snapshot = offset = _PollSection(buf, _HEADER.size).end
+    records = 0
+    for body, offset in _log_records(buf, offset):
+        records += 1
+    return snapshot, records, offset
+
+
+def _apply_record(body, by_key):
+    """Apply one change record body to the polls by_key."""
+    record_type = ord(body[0])
+    if record_type == RECORD_POLL:
+        for entry in _PollSection(body, 1).entries():
+            by_key[(entry[1], entry[0])] = entry
+    elif record_type == RECORD_DELETE:
+        author, offset = _decode_string(body, 1)
+        title, offset = _decode_string(body, offset)
+        by_key.pop((author, title), None)
+    elif record_type == RECORD_VOTE:
+        author, offset = _decode_string(body, 1)
+        title, offset = _decode_string(body, offset)
+        (choice,) = _SMALL_COUNT.unpack_from(body, offset)
+        offset += _SMALL_COUNT.size
+        votersha, offset = _decode_string(body, offset)
+        entry = by_key.get((author, title))
+        if entry is None:
+            return
+        # Same effect as Poll.register_vote
+        question, options, data, votes = _unmap(*entry[6]())
+        if hasattr(votes, 'items'):
+            votes = votes.items()
+        votes.append((votersha, choice))
+        data[choice] = data.get(choice, 0) + 1
+        if sum([data.get(key, 0) for key in options]) >= entry[4]:
+            entry[2] = False
+        entry[6] = _loaded(question, options, data, votes)
+    else:
+        _logger.warning('Ignoring unknown journal record type %d',
+                        record_type)
+
+
+class JournalWriter(object):
+    """Save polls as a snapshot followed by an append-only change log.
+
+    Connect it to a PollRegistry with watch() and it queues a change
+    record for each poll added, changed, removed or voted on. write()
+    then appends only the queued records if it is saving to the same
+    file it wrote last, so saving after one vote writes a few dozen
+    bytes. Otherwise, or when the log has grown past compact_records
+    records or compact_ratio times the size of the snapshot, it writes
+    a fresh snapshot instead.
+
+    Sugar saves to a new file every time, so with a log_path the
+    journal is kept there instead and each file saved to is a hard link
+    to it, or a copy where links are not supported. adopt() carries on
+    the log of a file that was read. The log is copied before appending
+    to it while a file saved to still links to it, so saved files keep
+    their contents.
+
+    Added and changed polls are only encoded when write() is called, so
+    queueing them does not load lazily read poll bodies, and neither
+    does encoding them (see Poll.body).
+    """
+    def __init__(self, log_path=None, compact_records=COMPACT_RECORDS,
+                 compact_ratio=COMPACT_RATIO):
+        """Create the JournalWriter.
+
+        log_path -- string, path to keep the journal at between saves,
+          or None to write it to the file saved to
+        compact_records -- integer, maximum number of log records
+        compact_ratio -- float, maximum size of the log relative to
+          the snapshot
+        """
+        self.log_path = log_path
+        self.compact_records = compact_records
+        self.compact_ratio = compact_ratio
+        self.reset()
+
+    def reset(self):
+        """Drop queued records so the next write() is a snapshot."""
+        self._pending = []  # encoded records, or Polls to encode
+        self._pending_polls = {}  # Poll -> its index in self._pending
+        self._keys = {}  # Poll -> (author, title) last written
+        self._path = None
+        self._size = 0
+        self._snapshot_bytes = 0
+        self._log_bytes = 0
+        self._log_records = 0
+
+    def watch(self, registry):
+        """Queue records for the changes announced by registry.
+
+        registry -- PollRegistry
+        """
+        registry.connect('poll-added', self._poll_changed_cb)
+        registry.connect('poll-changed', self._poll_changed_cb)
+        registry.connect('poll-removed', self._poll_removed_cb)
+        registry.connect('poll-voted', self._poll_voted_cb)
+
+    def _poll_changed_cb(self, registry, poll):
+        key = (_to_str(poll.author), _to_str(poll.title))
+        old_key = self._keys.get(poll)
+        if old_key is not None and old_key != key:
+            self._queue_delete(old_key)
+        self._keys[poll] = key
+        # A queued POLL record is encoded with the state at write time,
+        # which covers this change too.
+        if poll not in self._pending_polls:
+            self._pending_polls[poll] = len(self._pending)
+            self._pending.append(poll)
+
+    def _poll_removed_cb(self, registry, poll):
+        index = self._pending_polls.pop(poll, None)
+        if index is not None:
+            self._pending[index] = None
+        key = self._keys.pop(poll, None)
+        if key is None:
+            key = (_to_str(poll.author), _to_str(poll.title))
+        self._queue_delete(key)
+
+    def _poll_voted_cb(self, registry, poll, choice, votersha):
+        if poll in self._pending_polls:
+            return
+        self._pending.append(_encode_record(
+            chr(RECORD_VOTE) + _encode_string(poll.author) +
+            _encode_string(poll.title) + _SMALL_COUNT.pack(int(choice)) +
+            _encode_string(votersha)))
+
+    def _queue_delete(self, key):
+        author, title = key
+        self._pending.append(_encode_record(
+            chr(RECORD_DELETE) + _encode_string(author) +
+            _encode_string(title)))
+
+    def _encode_pending(self):
+        records = []
+        for record in self._pending:
+            if record is None:
+                continue
+            if not isinstance(record, str):
+                record = _encode_record(chr(RECORD_POLL) +
+                                        _encode_polls([record]))
+            records.append(record)
+        return records
+
+    def _needs_compaction(self):
+        return (self._log_records + len(self._pending) >
+                    self.compact_records or
+                self._log_bytes > self.compact_ratio * self._snapshot_bytes)
+
+    def write(self, file_path, polls):
+        """Save polls to file_path.
+
+        file_path -- string
+        polls -- sequence of Poll, the complete current state
+        """
+        path = self.log_path or file_path
+        if (path == self._path and not self._needs_compaction() and
+            os.path.exists(path) and os.path.getsize(path) == self._size):
+            records = self._encode_pending()
+            log = ''.join(records)
+            self._unshare(path)
+            f = open(path, 'ab')
+            try:
+                f.write(log)
+            finally:
+                f.close()
+            self._size += len(log)
+            self._log_bytes += len(log)
+            self._log_records += len(records)
+            self._pending = []
+            self._pending_polls = {}
+        else:
+            self._write_snapshot(path, polls)
+        if path != file_path:
+            _link(path, file_path)
+
+    def _write_snapshot(self, path, polls):
+        polls = list(polls)
+        self.reset()
+        snapshot = _HEADER.pack(MAGIC, VERSION) + _encode_polls(polls)
+        tmp_path = path + '.tmp'
+        f = open(tmp_path, 'wb')
+        try:
+            f.write(snapshot)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+        self._set_keys(polls)
+        self._path = path
+        self._size = len(snapshot)
+        self._snapshot_bytes = len(snapshot)
+
+    def adopt(self, file_path, polls):
+        """Carry on the journal at file_path, which polls were read from.
+
+        file_path -- string
+        polls -- sequence of Poll, as read from file_path
+
+        Drops queued records. The next write() appends to the log of
+        file_path if there is a log_path and file_path is a journal of
+        the current version with an intact log; otherwise it writes a
+        snapshot.
+        """
+        self.reset()
+        if self.log_path is None:
+            return
+        f = open(file_path, 'rb')
+        try:
+            extent = _log_extent(f)
+            size = os.fstat(f.fileno()).st_size
+        finally:
+            f.close()
+        if extent is None or extent[2] != size:
+            return
+        _link(file_path, self.log_path)
+        self._set_keys(polls)
+        self._path = self.log_path
+        self._size = size
+        self._snapshot_bytes, self._log_records = extent[:2]
+        self._log_bytes = size - self._snapshot_bytes
+
+    def _set_keys(self, polls):
+        for poll in polls:
+            self._keys[poll] = (_to_str(poll.author), _to_str(poll.title))
+
+    def _unshare(self, path):
+        """Replace path by a copy if other files link to it."""
+        if os.stat(path).st_nlink > 1:
+            tmp_path = path + '.tmp'
+            shutil.copyfile(path, tmp_path)
+            os.rename(tmp_path, path)
+
+
+def _link(source, link_path):
+    """Make link_path a hard link to source, or a copy of it."""
+    if os.path.exists(link_path):
+        os.remove(link_path)
+    try:
+        os.link(source, link_path)
+    except OSError:
+        shutil.copyfile(source, link_path)
+
+
+def _read_legacy_polls(buf):
+    """Read the unversioned stream of pickled fields."""
+    unpickler = cPickle.Unpickler(StringIO(buf))
+    num_polls = unpickler.load()
+    polls = []
+    for p in range(num_polls):
+        title = unpickler.load()
+        author = unpickler.load()
+        active = unpickler.load()
+        createdate_i = unpickler.load()
+        maxvoters = unpickler.load()
+        question = unpickler.load()
+        number_of_options = unpickler.load()
+        options = unpickler.load()
+        data = unpickler.load()
+        votes = unpickler.load()
+        polls.append((title, author, active,
+                      date.fromordinal(int(createdate_i)),
+                      maxvoters, question, number_of_options, options,
+                      data, votes))
+    return polls
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""In-process stand-in for a D-Bus tube, for exercising PollSession.
+
+A LoopbackBus connects any number of LoopbackTubes in one process. Each
+tube provides what PollSession uses of a TubeConnection:
+watch_participants, add_signal_receiver, get_object and get_unique_name,
+plus export, which routes the D-Bus signals and methods of the session
+through the bus. Like on a real tube, signals and method calls are
+delivered from the main loop, not while they are being sent, and
+arguments are copied on the way.
+
+Run as a script, this is a load test: it starts a number of simulated
+peers with their own polls, lets them all join and vote, and reports
+how long they took to agree, how many messages they sent and how many
+bytes those took (pickled, as an approximation of their size on the
+wire).
+"""
+
+import time
+import random
+import cPickle
+from datetime import date
+from optparse import OptionParser
+
+import gobject
+from dbus import DBusException, Signature
+
+from poll import Poll, PollRegistry, PollSession, sha1
+
+
+class LoopbackBus(object):
+    """Deliver signals and method calls between LoopbackTubes."""
+    def __init__(self, latency=0):
+        """Create the LoopbackBus.
+
+        latency -- integer, ms each message takes to arrive
+        """
+        self.latency = latency
+        self._tubes = {}  # bus name -> LoopbackTube
+        self._next_handle = 1
+        self.pending = 0  # messages sent but not delivered yet
+        self.signals = 0
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+
+    def connect(self, nick):
+        """Return a new LoopbackTube for the buddy nick on this bus."""
+        handle = self._next_handle
+        self._next_handle += 1
+        tube = LoopbackTube(self, ':loopback.%d' % handle, handle, nick)
+        self._tubes[tube.bus_name] = tube
+        return tube
+
+    def get_buddy(self, handle):
+        """Return the buddy of handle, like PollBuilder._get_buddy."""
+        for tube in self._tubes.itervalues():
+            if tube.handle == handle:
+                return _LoopbackBuddy(tube.nick)
+        return None
+
+    def _joined(self, tube):
+        for other in self._tubes.values():
+            if other is not tube and other.online:
+                other._participants_changed([(tube.handle, tube.bus_name)],
+                                            [])
+        tube._participants_changed(
+            [(other.handle, other.bus_name)
+             for other in self._tubes.values() if other.online], [])
+
+    def _left(self, tube):
+        for other in self._tubes.values():
+            if other.online:
+                other._participants_changed([], [tube.handle])
+
+    def _copy(self, value):
+        """Return a copy of value as it would arrive, counting its size."""
+        data = cPickle.dumps(value, 2)
+        self.bytes += len(data)
+        return cPickle.loads(data)
+
+    def _deliver(self, function, *args):
+        """Call function(*args) from the main loop."""
+        self.pending += 1
+        gobject.timeout_add(self.latency, self._deliver_cb, function, args)
+
+    def _deliver_cb(self, function, args):
+        self.pending -= 1
+        function(*args)
+        return False
+
+    def _emit(self, sender, name, args):
+        self.signals += 1
+        args = self._copy(args)
+        for tube in self._tubes.values():
+            if tube.online:
+                for handler in tube._receivers.get(name, ()):
+                    self._deliver(handler, sender.bus_name, args)
+
+    def _call(self, sender, bus_name, name, args, reply_handler,
+              error_handler):
+        self.calls += 1
+        args = self._copy(args)
+        self._deliver(self._dispatch, sender, bus_name, name, args,
+                      reply_handler, error_handler)
+
+    def _dispatch(self, sender, bus_name, name, args, reply_handler,
+                  error_handler):
+        tube = self._tubes.get(bus_name)
+        if tube is None or not tube.online or tube.exported is None:
+            self.errors += 1
+            self._deliver(error_handler, DBusException(
+                'org.freedesktop.DBus.Error.ServiceUnknown: %s' % bus_name))
+            return
+        function = getattr(tube.exported, name)
+        keywords = {}
+        if function._dbus_sender_keyword:
+            keywords[function._dbus_sender_keyword] = sender.bus_name
+        try:
+            values = function(*args, **keywords)
+        except Exception, e:
+            self.errors += 1
+            self._deliver(error_handler, DBusException(str(e)))
+            return
+        out_args = len(list(Signature(function._dbus_out_signature or '')))
+        if out_args == 0:
+            values = ()
+        elif out_args == 1:
+            values = (values,)
+        self._deliver(reply_handler, *self._copy(tuple(values)))
+
+
+class LoopbackTube(object):
+    """One peer's connection to a LoopbackBus, see TubeConnection."""
+    def __init__(self, bus, bus_name, handle, nick):
+        self.bus = bus
+        self.bus_name = bus_name
+        self.handle = handle
+        self.nick = nick
+        self.online = False
+        self.exported = None
+        self._watchers = []
+        self._receivers = {}  # signal name -> handlers
+
+    def watch_participants(self, callback):
+        """Call callback(added, removed) when participants change.
+
+        Joins the bus, so callback is first called with everybody
+        already on it.
+        """
+        self._watchers.append(callback)
+        if not self.online:
+            self.online = True
+            self.bus._joined(self)
+
+    def close(self):
+        """Leave the bus, telling the other participants."""
+        if self.online:
+            self.online = False
+            self.bus._left(self)
+
+    def _participants_changed(self, added, removed):
+        for callback in self._watchers:
+            self.bus._deliver(callback, added, removed)
+
+    def add_signal_receiver(self, handler, signal_name, dbus_interface=None,
+                            path=None, sender_keyword=None,
+                            byte_arrays=False):
+        if sender_keyword:
+            receiver = lambda sender, args: handler(
+                *args, **{sender_keyword: sender})
+        else:
+            receiver = lambda sender, args: handler(*args)
+        self._receivers.setdefault(signal_name, []).append(receiver)
+
+    def get_unique_name(self):
+        return self.bus_name
+
+    def get_object(self, bus_name, path):
+        return _LoopbackProxy(self, bus_name)
+
+    def export(self, obj, path):
+        """Route the D-Bus signals and methods of obj through the bus.
+
+        obj -- dbus.service.Object, not exported on any real connection
+        path -- string, object path (only one object per tube)
+        """
+        self.exported = obj
+        for name in dir(type(obj)):
+            if getattr(getattr(type(obj), name), '_dbus_is_signal', False):
+                setattr(obj, name, self._signal_emitter(name))
+
+    def _signal_emitter(self, name):
+        return lambda *args: self.bus._emit(self, name, args)
+
+
+class _LoopbackProxy(object):
+    """Remote object whose methods are called through the bus."""
+    def __init__(self, tube, bus_name):
+        self._tube = tube
+        self._bus_name = bus_name
+
+    def __getattr__(self, name):
+        def call(*args, **keywords):
+            reply_handler = keywords.get('reply_handler')
+            error_handler = keywords.get('error_handler')
+            if reply_handler is None or error_handler is None:
+                raise ValueError('Only asynchronous calls are supported')
+            self._tube.bus._call(self._tube, self._bus_name, name, args,
+                                 reply_handler, error_handler)
+        return call
+
+
+class _LoopbackBuddy(object):
+    """Just enough of a sugar.presence.buddy.Buddy for PollSession."""
+    def __init__(self, nick):
+        self.props = _LoopbackBuddyProps()
+        self.props.nick = nick
+
+
+class _LoopbackBuddyProps(object):
+    pass
+
+
+class _LoadPeer(object):
+    """Stand-in for the PollBuilder of a simulated peer."""
+    def __init__(self, bus, nick, initiator):
+        self.nick = nick
+        self.nick_sha1 = sha1(nick).hexdigest()
+        self._polls = PollRegistry()
+        self.alerts = 0
+        self._bus = bus
+        self._initiator = initiator
+        self.poll_session = None
+
+    def join(self):
+        self.poll_session = PollSession(self._bus.connect(self.nick),
+                                        self._initiator, self._bus.get_buddy,
+                                        self)
+
+    def get_my_polls(self):
+        return self._polls.by_author(self.nick)
+
+    def alert(self, title, text=''):
+        self.alerts += 1
+
+    def vote_on_poll(self, author, title, choice, votersha, count=None,
+                     alert=True):
+        poll = self._polls.find(author, title)
+        if poll is None:
+            return False
+        if count is not None:
+            return self._polls.merge_vote(poll, choice, votersha, count)
+        try:
+            poll.register_vote(choice, votersha)
+        except (OverflowError, ValueError):
+            return False
+        self._polls.vote_registered(poll, choice, votersha)
+        return True
+
+
+def run_load_test(peers=50, polls=5, votes=2, latency=5, seed=0,
+                  max_seconds=600):
+    """Simulate a class sharing polls and report how it went.
+
+    peers -- integer, number of simulated laptops
+    polls -- integer, polls each peer has before joining
+    votes -- integer, votes each peer casts once it has joined
+    latency -- integer, ms each message takes to arrive
+    seed -- integer, for the random choice of votes
+    max_seconds -- integer, give up after this long
+
+    Returns a dict of the measurements.
+    """
+    rand = random.Random(seed)
+    bus = LoopbackBus(latency)
+    everybody = []
+    for i in range(peers):
+        peer = _LoadPeer(bus, 'peer%d' % i, i == 0)
+        for j in range(polls):
+            peer._polls.add(Poll(peer, 'poll %d' % j, peer.nick, True,
+                                 date.today(), peers * votes, 'Question?',
+                                 3, {0: 'Yes', 1: 'No', 2: 'Maybe'},
+                                 {0: 0, 1: 0, 2: 0}, {}))
+        everybody.append(peer)
+    total_polls = peers * polls
+    state = {'voted': False, 'converged': None}
+
+    def vote():
+        for peer in everybody:
+            mine = list(peer._polls)
+            for k in range(votes):
+                poll = rand.choice(mine)
+                choice = rand.randint(0, 2)
+                poll.register_vote(choice, peer.nick_sha1)
+                peer._polls.vote_registered(poll, choice, peer.nick_sha1)
+
+    def agreed():
+        first = None
+        for peer in everybody:
+            if len(peer._polls) != total_polls:
+                return False
+            digest = sorted(peer.poll_session.digest())
+            if first is None:
+                first = digest
+            elif digest != first:
+                return False
+        return True
+
+    def check_cb():
+        if time.time() - start > max_seconds:
+            loop.quit()
+            return False
+        if bus.pending:
+            return True
+        if not state['voted']:
+            if agreed():
+                state['synced'] = time.time() - start
+                state['voted'] = True
+                vote()
+            return True
+        if agreed():
+            state['converged'] = time.time() - start
+            loop.quit()
+            return False
+        return True
+
+    loop = gobject.MainLoop()
+    start = time.time()
+    for peer in everybody:
+        peer.join()
+    gobject.timeout_add(50, check_cb)
+    loop.run()
+    return {
+        'peers': peers,
+        'polls': total_polls,
+        'synced': state.get('synced'),
+        'converged': state['converged'],
+        'signals': bus.signals,
+        'calls': bus.calls,
+        'errors': bus.errors,
+        'bytes': bus.bytes,
+        'alerts': sum([peer.alerts for peer in everybody]),
+    }
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]',
+                          description='Load test the poll sharing code.')
+    parser.add_option('-n', '--peers', type='int', default=50,
+                      help='number of simulated peers [%default]')
+    parser.add_option('-p', '--polls', type='int', default=5,
+                      help='polls per peer [%default]')
+    parser.add_option('-v', '--votes', type='int', default=2,
+                      help='votes per peer [%default]')
+    parser.add_option('-l', '--latency', type='int', default=5,
+                      help='ms per message [%default]')
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='random seed [%default]')
+    options, args = parser.parse_args()
+    result = run_load_test(options.peers, options.polls, options.votes,
+                           options.latency, options.seed)
+    print '%(peers)d peers, %(polls)d polls' % result
+    if result['converged'] is None:
+        print 'Did not converge'
+    else:
+        print 'Synced in %.2fs, converged after voting in %.2fs' % (
+            result['synced'], result['converged'])
+    print ('%(signals)d signals, %(calls)d method calls (%(errors)d failed), '
+           '%(bytes)d bytes, %(alerts)d alerts' % result)
+
+
+if __name__ == '__main__':
+    main()
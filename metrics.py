@@ -0,0 +1,141 @@
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""Counters and latency histograms for the hot paths of the activity.
+
+Metrics are off unless the POLL_METRICS environment variable names a
+file when the activity starts. Then:
+
+  @timed('name')  counts the calls of a function and records how long
+                  they took in a histogram
+  count('name')   adds to a counter
+  dump()          writes everything to the POLL_METRICS file, as does
+                  sending the activity SIGUSR1
+
+When metrics are off, timed() returns the function itself and count()
+returns at once, so instrumented code runs as if it were not.
+
+Each histogram has one bucket per power of two microseconds: bucket n
+counts the calls that took from 2**n up to 2**(n+1) us.
+"""
+
+import os
+import math
+import time
+import signal
+import logging
+
+# File dumped to, or None when metrics are off
+PATH = os.environ.get('POLL_METRICS') or None
+enabled = PATH is not None
+
+_counters = {}  # name -> count
+_histograms = {}  # name -> _Histogram
+
+_logger = logging.getLogger('poll-activity.metrics')
+
+
+class _Histogram(object):
+    """Call count, total, maximum and log2 buckets of some latencies."""
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * 32
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = math.frexp(seconds * 1000000)[1] - 1
+        self.buckets[min(max(bucket, 0), 31)] += 1
+
+
+def count(name, n=1):
+    """Add n to the counter name."""
+    if enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def record(name, seconds):
+    """Add a latency of seconds to the histogram name."""
+    try:
+        histogram = _histograms[name]
+    except KeyError:
+        histogram = _histograms[name] = _Histogram()
+    histogram.add(seconds)
+
+
+def timed(name):
+    """Return a decorator recording the calls of a function as name.
+
+    The function is returned unchanged when metrics are off.
+    """
+    def decorate(function):
+        if not enabled:
+            return function
+
+        def timed_function(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.time() - start)
+        timed_function.__name__ = function.__name__
+        timed_function.__doc__ = function.__doc__
+        return timed_function
+    return decorate
+
+
+def dump(path=None):
+    """Write the counters and histograms to path, by default PATH.
+
+    Each line is a counter and its count, or a histogram followed by
+    its call count, total and maximum ms, and its non-empty buckets as
+    lower bound in us:calls.
+    """
+    path = path or PATH
+    if path is None:
+        return
+    lines = ['# %s' % time.ctime()]
+    for name in sorted(_counters.keys()):
+        lines.append('%s %d' % (name, _counters[name]))
+    for name in sorted(_histograms.keys()):
+        histogram = _histograms[name]
+        lines.append('%s %d %.3f %.3f %s' % (
+            name, histogram.count, histogram.total * 1000,
+            histogram.max * 1000,
+            ' '.join(['%d:%d' % (1 << bucket, calls)
+                      for bucket, calls in enumerate(histogram.buckets)
+                      if calls])))
+    f = file(path, 'w')
+    try:
+        f.write('\n'.join(lines) + '\n')
+    finally:
+        f.close()
+    _logger.debug('Metrics written to %s', path)
+
+
+def _dump_signal_cb(signum, frame):
+    dump()
+
+
+if enabled:
+    signal.signal(signal.SIGUSR1, _dump_signal_cb)
@@ -20,21 +20,26 @@
 # info@WorldWideWorkshop.org !
 #
 
+import time
+# Start of the imports, see StartupProfiler
+_imports_started = time.time()
+
 import os
-import cPickle
+import zlib
+import bisect
+from array import array
+from UserDict import DictMixin
 import gtk
+import gobject
 import hippo
 import pango
 import locale
 import logging
 from datetime import date
 from gettext import gettext as _
-import telepathy
-import telepathy.client
-from dbus import Interface
+from dbus import Interface, DBusException, ByteArray
 from dbus.service import method, signal
 from dbus.gobject_service import ExportedGObject
-from sugar.presence.tubeconn import TubeConnection
 
 try:
     from hashlib import sha1
@@ -49,8 +54,26 @@ try:
 except:
     pass  # FIXME remove this once compatibility with Trial 3 not required
 from sugar.presence import presenceservice
-from abiword import Canvas as AbiCanvas
+import i18n
 from i18n import LanguageComboBox
+import journal
+import metrics
+import wire
+# telepathy and sugar.presence.tubeconn are only imported once the
+# activity is shared, and abiword when lesson plans are shown.
+
+_imports_done = time.time()
+
+_telepathy = None
+
+
+def _get_telepathy():
+    """Return the telepathy module, imported the first time it is needed."""
+    global _telepathy
+    if _telepathy is None:
+        import telepathy
+        _telepathy = telepathy
+    return _telepathy
 
 SERVICE = "org.worldwideworkshop.olpc.PollBuilder"
 IFACE = SERVICE
@@ -147,6 +170,34 @@ def theme_radiobutton(btn, size=12):
     return btn
 
 
+class StartupProfiler(object):
+    """Time the phases of starting the activity.
+
+    Each phase runs from the end of the previous one, or from the
+    creation of the profiler, until phase() is called with its name.
+    """
+    def __init__(self):
+        self.phases = []  # (name, seconds)
+        self._last = time.time()
+
+    def add(self, name, seconds):
+        """Record a phase timed elsewhere."""
+        self.phases.append((name, seconds))
+
+    def phase(self, name):
+        """End the current phase, calling it name."""
+        now = time.time()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def report(self):
+        """Return the phases and their total as a line of text."""
+        total = sum([seconds for name, seconds in self.phases])
+        return 'Started in %dms: %s' % (total * 1000, ', '.join(
+            ['%s %dms' % (name, seconds * 1000)
+             for name, seconds in self.phases]))
+
+
 class PollBuilder(activity.Activity):
     """Sugar activity for polls
 
@@ -160,7 +211,10 @@ class PollBuilder(activity.Activity):
     
     """
     def __init__(self, handle):
+        startup = StartupProfiler()
+        startup.add('imports', _imports_done - _imports_started)
         activity.Activity.__init__(self, handle)
+        startup.phase('activity')
 
         self._logger = logging.getLogger('poll-activity')
         self._logger.debug('Starting Poll activity')
@@ -172,36 +226,73 @@ class PollBuilder(activity.Activity):
         # Buddy object for you
         owner = self.pservice.get_owner()
         self.owner = owner
-        self.nick = owner.props.nick
-        self.nick_sha1 = sha1(self.nick).hexdigest()
+        self.identity = OwnerIdentity(owner)
+        startup.phase('presence service')
 
         self._basepath = activity.get_bundle_path()
         os.chdir(self._basepath)  # required for i18n.py to work
 
         # setup example poll
-        self._polls = set()
+        self._polls = PollRegistry()
+        # Sugar saves to a new file each time, so the journal is kept
+        # here to append to
+        self._journal = journal.JournalWriter(os.path.join(
+            activity.get_activity_root(), 'instance',
+            'polls-%s.journal' % self.get_id()))
+        self._journal.watch(self._polls)
+        self._poll_selector = None  # PollSelector, made by _select_canvas
+        # Lesson plans are slow to lay out, so each is only built once
+        self._lesson_plans = {}  # locale code -> CanvasWidget
+        self._polls.connect('poll-voted', self._poll_voted_cb)
+        self._polls.connect('poll-changed', self._poll_changed_cb)
         # Removed default polls since it creates too much noise
         # when shared with many on the mesh
         #self._make_default_poll()
         self._has_voted = False
         self._previewing = False
         self._current_view = None  # so we can switch back
+        self._results_shape = None  # see draw_poll_details_box
 
         toolbox = activity.ActivityToolbox(self)
         self.set_toolbox(toolbox)
         toolbox.show()
+        startup.phase('toolbox')
 
-        # Show poll screen
-        # Setup screen
+        # Show an empty screen first, and the select screen once it
+        # has been drawn
         self._canvas = hippo.Canvas()
-        self._canvas.set_root(self._select_canvas())
+        self._canvas.set_root(self._canvas_root())
         self.set_canvas(self._canvas)
         self.show_all()
+        startup.phase('first frame')
+        self._startup = startup
+        gobject.idle_add(self._first_canvas_cb)
 
         self.poll_session = None  # PollSession
         self.connect('shared', self._shared_cb)
         self.connect('joined', self._joined_cb)
 
+    def _first_canvas_cb(self):
+        """Show the select screen unless another one was shown already."""
+        if self._current_view is None:
+            self._canvas.set_root(self._select_canvas())
+            self.show_all()
+        self._startup.phase('first canvas')
+        self._logger.debug(self._startup.report())
+        self._startup = None
+        return False
+
+    @property
+    def nick(self):
+        """My nick, from self.identity."""
+        return self.identity.nick
+
+    @property
+    def nick_sha1(self):
+        """sha1 of my nick, from self.identity."""
+        return self.identity.nick_sha1
+
+    @metrics.timed('read_file')
     def read_file(self, file_path):
         """Implement reading from journal
         
@@ -210,39 +301,35 @@ class PollBuilder(activity.Activity):
         """
         self._logger.debug('Reading file from datastore via Journal: %s' %
                            file_path)
-        self._polls = set()
-        f = open(file_path, 'r')
-        num_polls = cPickle.load(f)
-        for p in range(num_polls):
-            title = cPickle.load(f)
-            author = cPickle.load(f)
-            active = cPickle.load(f)
-            createdate_i = cPickle.load(f)
-            maxvoters = cPickle.load(f)
-            question = cPickle.load(f)
-            number_of_options = cPickle.load(f)
-            options = cPickle.load(f)
-            data = cPickle.load(f)
-            votes = cPickle.load(f)
-            poll = Poll(self, title, author, active, 
-                        date.fromordinal(int(createdate_i)),
-                        maxvoters, question, number_of_options, options,
-                        data, votes)
-            self._polls.add(poll)
-        f.close()
-
+        for poll in list(self._polls):
+            self._polls.remove(poll)
+        f = open(file_path, 'rb')
+        try:
+            # Only the index is read now; the question, options and votes
+            # of each poll are decoded when it is opened.
+            for (title, author, active, createdate, maxvoters,
+                 number_of_options, load_body) in journal.read_index(f):
+                try:
+                    self._polls.add(Poll(self, title, author, active,
+                                         createdate, maxvoters,
+                                         number_of_options=number_of_options,
+                                         load_body=load_body))
+                except ValueError, e:
+                    # Files from before PollRegistry may hold duplicates
+                    self._logger.debug('Skipping poll: %s' % e)
+        finally:
+            f.close()
+        # The next write_file appends to this file's log
+        self._journal.adopt(file_path, self._polls)
+
+    @metrics.timed('write_file')
     def write_file(self, file_path):
         """Implement writing to the journal
 
         This is called within sugar.activity.Activity code
         which provides the file_path.
         """
-        s = cPickle.dumps(len(self._polls))
-        for poll in self._polls:
-            s += poll.dump()
-        f = open(file_path, 'w')
-        f.write(s)
-        f.close()
+        self._journal.write(file_path, self._polls)
 
     def alert(self, title, text=None):
         """Show an alert above the activity."""
@@ -299,6 +386,7 @@ class PollBuilder(activity.Activity):
 
         return canvasbox
 
+    @metrics.timed('select_canvas')
     def _select_canvas(self):
         """Show the select canvas where children choose an existing poll."""
         self._current_view = 'select'
@@ -325,65 +413,15 @@ class PollBuilder(activity.Activity):
             orientation=hippo.ORIENTATION_VERTICAL)
         mainbox.append(poll_details_box)
 
-        # add scroll window
-        scrolledwindow = hippo.CanvasScrollbars()
-        scrolledwindow.set_policy(
-            hippo.ORIENTATION_HORIZONTAL, hippo.SCROLLBAR_NEVER)
-
-        poll_selector_box = hippo.CanvasBox(
-            orientation=hippo.ORIENTATION_VERTICAL)
-        scrolledwindow.set_root(poll_selector_box)
-        poll_details_box.append(scrolledwindow,
+        # The selector is built once and kept up to date from
+        # self._polls, so only move it into the new canvas.
+        if self._poll_selector is None:
+            self._poll_selector = PollSelector(
+                self._polls, self.identity, self._select_poll_button_cb,
+                self._delete_poll_button_cb)
+        poll_details_box.append(self._poll_selector.get_root(),
                                 hippo.PACK_EXPAND)
 
-        row_number = 0
-        for poll in self._polls:
-            sha = poll.sha
-            if row_number % 2:
-                row_bgcolor=style.COLOR_WHITE.get_int()
-            else:
-                row_bgcolor=style.COLOR_SELECTION_GREY.get_int()
-            row_number += 1
-            poll_row = hippo.CanvasBox(
-                padding_top=4, padding_bottom=4,
-                background_color=row_bgcolor,
-                orientation=hippo.ORIENTATION_HORIZONTAL)
-            poll_selector_box.append(poll_row)
-
-            sized_box = hippo.CanvasBox(
-                box_width=600,
-                orientation=hippo.ORIENTATION_HORIZONTAL)
-            poll_row.append(sized_box)
-            title = hippo.CanvasText(
-                text=poll.title+' ('+poll.author+')',
-                xalign=hippo.ALIGNMENT_START,
-                color=style.Color(DARK_GREEN).get_int(),
-                font_desc = pango.FontDescription('Sans 10'))
-            sized_box.append(title)
-
-            sized_box = hippo.CanvasBox(
-                box_width=180,
-                orientation=hippo.ORIENTATION_HORIZONTAL)
-            poll_row.append(sized_box)
-            if poll.active:
-                button = gtk.Button(_('VOTE'))
-            else:
-                button = gtk.Button(_('SEE RESULTS'))
-            button.connect('clicked', self._select_poll_button_cb, sha)
-            sized_box.append(hippo.CanvasWidget(widget=theme_button(button)))
-
-            sized_box = hippo.CanvasBox(
-                box_width=150,
-                orientation=hippo.ORIENTATION_HORIZONTAL)
-            poll_row.append(sized_box)
-            if poll.author == self._pservice.get_owner().props.nick:
-                button = gtk.Button(_('DELETE'))
-                button.connect('clicked', self._delete_poll_button_cb, sha)
-                sized_box.append(hippo.CanvasWidget(widget=theme_button(button)))
-            poll_row.append(hippo.CanvasText(
-                text=poll.createdate.strftime('%d/%m/%y'),
-                color=style.Color(DARK_GREEN).get_int()))
-
         button_box = self._canvas_buttonbox(button_to_highlight=2)
         mainbox.append(button_box, hippo.PACK_END)
 
@@ -415,10 +453,17 @@ class PollBuilder(activity.Activity):
             orientation=hippo.ORIENTATION_VERTICAL)
         mainbox.append(poll_details_box)
 
-        lessonplan = LessonPlanWidget(self._basepath)
-        lessonplan.set_size_request(1050, 500)
-        poll_details_box.append(hippo.CanvasWidget(widget=lessonplan),
-                                hippo.PACK_EXPAND)
+        code, encoding = locale.getdefaultlocale()
+        item = self._lesson_plans.get(code)
+        if item is None:
+            lessonplan = LessonPlanWidget(self._basepath, code)
+            lessonplan.set_size_request(1050, 500)
+            item = hippo.CanvasWidget(widget=lessonplan)
+            self._lesson_plans[code] = item
+        parent = item.get_parent()
+        if parent is not None:
+            parent.remove(item)
+        poll_details_box.append(item, hippo.PACK_EXPAND)
 
         button_box = self._canvas_buttonbox()
         mainbox.append(button_box, hippo.PACK_END)
@@ -441,8 +486,6 @@ class PollBuilder(activity.Activity):
             self._logger.debug('Strange, which button was clicked?')
             return
         self.delete_poll(sha)
-        self._canvas.set_root(self._select_canvas())
-        self.show_all()
 
     def delete_poll(self, sha=None, poll=None):
         """Delete a poll, either by passing sha or the actual poll object.
@@ -452,16 +495,52 @@ class PollBuilder(activity.Activity):
         """
         if poll:
             if self._poll == poll:
-                self._make_blank_poll
+                self._make_blank_poll()
             self._polls.remove(poll)
         if sha:
-            if self._poll.sha == sha:
+            poll = self._polls.get(sha)
+            if poll is None:
+                return
+            if self._poll is poll:
                 self._logger.debug('delete_poll: removing current poll')
                 self._make_blank_poll()
-            for poll in self._polls.copy():
-                if poll.sha == sha:
-                    self._polls.remove(poll)
+            self._polls.remove(poll)
         
+    def _poll_details_shape(self):
+        """Return what decides the layout of the poll details box.
+
+        While this stays the same, update_poll_details_box() only needs
+        to change texts and bar widths.
+        """
+        votes_total = self._poll.vote_count
+        return (self._poll, self._poll.active, self._previewing,
+                self._has_voted, votes_total > 0,
+                votes_total < self._poll.maxvoters)
+
+    def update_poll_details_box(self):
+        """Bring the poll details box up to date with self._poll.
+
+        The results are updated in place; the box is only redrawn if
+        its layout has to change, e.g. when the poll closes.
+        """
+        if self._poll_details_shape() != self._results_shape:
+            self.draw_poll_details_box()
+            return
+        votes_total = self._poll.vote_count
+        data = self._poll.data
+        for choice, (count, graph, percent) in enumerate(self._results_rows):
+            count.props.text = justify(data, choice)
+            graph.props.box_width = int(
+                data[choice] * 1.0 / votes_total * 20) * 20
+            percent.props.text = str(data[choice] * 100 / votes_total) + '%'
+        if self._results_total is not None:
+            self._results_total.props.text = str(votes_total)
+        if self._results_left is not None:
+            self._results_left.props.text = (
+                ' (' + str(self._poll.maxvoters - votes_total) +
+                ' votes left to collect)')
+
+    @metrics.timed('draw_poll_details_box')
     def draw_poll_details_box(self):
         """(Re)draw the poll details box
         
@@ -471,6 +550,11 @@ class PollBuilder(activity.Activity):
         poll_details_box.remove_all()
 
         votes_total = self._poll.vote_count
+        # Kept for update_poll_details_box
+        self._results_shape = self._poll_details_shape()
+        self._results_rows = []
+        self._results_total = None
+        self._results_left = None
 
         text_size = self._size_heading_text(self._poll.title)
         title = hippo.CanvasText(
@@ -514,17 +598,19 @@ class PollBuilder(activity.Activity):
 
             if votes_total > 0:
                 # show results
-                self._logger.debug(str(self._poll.data[choice] * 1.0 / votes_total))
+                self._logger.debug('%f', self._poll.data[choice] * 1.0 /
+                                   votes_total)
                 result_box = hippo.CanvasBox(
                     orientation=hippo.ORIENTATION_VERTICAL,
                     box_width=100)
                 answer_row.append(result_box)
-                result_box.append(hippo.CanvasText(
+                count = hippo.CanvasText(
                     #text=str(self._poll.data[choice]),
                     text=justify(self._poll.data, choice),
                     xalign=hippo.ALIGNMENT_END,
                     color=style.Color(DARK_GREEN).get_int(),
-                    font_desc = pango.FontDescription('Sans 12')))
+                    font_desc = pango.FontDescription('Sans 12'))
+                result_box.append(count)
                 # int(self._poll.data[choice] * 1.0 / votes_total * 20) * '*',
                 # APPEND BARGRAPH TO result_box
                 graphbox = hippo.CanvasBox(
@@ -532,10 +618,12 @@ class PollBuilder(activity.Activity):
                     background_color=style.Color(PINK).get_int(),
                     box_width=int(self._poll.data[choice] * 1.0 / votes_total * 20) * 20)
                 answer_row.append(graphbox)
-                answer_row.append(hippo.CanvasText(
+                percent = hippo.CanvasText(
                     text=str(self._poll.data[choice] * 100 / votes_total)+'%',
                     color=style.Color(DARK_GREEN).get_int(),
-                    font_desc=pango.FontDescription('Sans 10')))
+                    font_desc=pango.FontDescription('Sans 10'))
+                answer_row.append(percent)
+                self._results_rows.append((count, graphbox, percent))
 
             poll_details_box.append(answer_row)
 
@@ -566,11 +654,12 @@ class PollBuilder(activity.Activity):
             totals_box.append(spacer)
             spacer = hippo.CanvasBox(
                 box_width=100, orientation=hippo.ORIENTATION_VERTICAL)
-            spacer.append(hippo.CanvasText(
+            self._results_total = hippo.CanvasText(
                 text=str(votes_total),
                 xalign=hippo.ALIGNMENT_END,
                 color=style.Color(DARK_GREEN).get_int(),
-                font_desc = pango.FontDescription('Sans 12')))
+                font_desc = pango.FontDescription('Sans 12'))
+            spacer.append(self._results_total)
             totals_box.append(spacer)
             totals_box.append(hippo.CanvasText(
                 text=' '+_('votes'),
@@ -578,11 +667,12 @@ class PollBuilder(activity.Activity):
                 color=style.Color(DARK_GREEN).get_int(),
                 font_desc = pango.FontDescription('Sans 12')))
             if votes_total < self._poll.maxvoters:
-                totals_box.append(hippo.CanvasText(
+                self._results_left = hippo.CanvasText(
                     text=' ('+str(self._poll.maxvoters-votes_total)+
                          ' votes left to collect)',
                     color=style.Color(DARK_GREEN).get_int(),
-                    font_desc = pango.FontDescription('Sans 12')))
+                    font_desc = pango.FontDescription('Sans 12'))
+                totals_box.append(self._results_left)
 
         # Button area
         if self._poll.active and not self._previewing:
@@ -605,6 +695,16 @@ class PollBuilder(activity.Activity):
             button_box.append(hippo.CanvasWidget(widget=theme_button(button)))
             poll_details_box.append(button_box)
 
+    def _poll_voted_cb(self, registry, poll, choice, votersha):
+        """A vote was registered, here or from the mesh."""
+        if self._current_view == 'poll' and poll is self._poll:
+            self.update_poll_details_box()
+
+    def _poll_changed_cb(self, registry, poll):
+        """A poll changed, e.g. it was closed when its author left."""
+        if self._current_view == 'poll' and poll is self._poll:
+            self.update_poll_details_box()
+
     def vote_choice_radio_button(self, widget, data=None):
         """Track which radio button has been selected
 
@@ -634,8 +734,13 @@ class PollBuilder(activity.Activity):
             except ValueError:
                 self._logger.debug('Local vote failed: '
                     'poll closed.')
-            self._logger.debug('Results: '+str(self._poll.data))
-            self.draw_poll_details_box()
+            else:
+                self._logger.debug('Results: '+str(self._poll.data))
+                # _poll_voted_cb updates the poll details box
+                self._polls.vote_registered(self._poll, self.current_vote,
+                                            self.nick_sha1)
+                return
+            self.update_poll_details_box()
 
     def button_select_clicked(self, button):
         """Show Choose a Poll canvas"""
@@ -647,8 +752,8 @@ class PollBuilder(activity.Activity):
         """
         # Reset vote data to 0
         self._make_blank_poll()
-        owner = self._pservice.get_owner()
-        self._poll.author = owner.props.nick
+        self._poll.author = self.nick
+        metrics.count('owner_calls_avoided')
         self._poll.active = False
         self._canvas.set_root(self._build_canvas())
         self.show_all()
@@ -788,7 +893,14 @@ class PollBuilder(activity.Activity):
         if data:
             if text:
                 if data=='title':
-                    self._poll.title = text
+                    if self._poll in self._polls:
+                        try:
+                            self._polls.retitle(self._poll, text)
+                        except ValueError:
+                            # Another of my polls has this title
+                            pass
+                    else:
+                        self._poll.title = text
                 elif data=='question':
                     self._poll.question = text
                 elif data=='maxvoters':
@@ -819,6 +931,11 @@ class PollBuilder(activity.Activity):
         failed_items = []
         if self._poll.title == '':
             failed_items.append('title')
+        else:
+            existing = self._polls.get(self._poll.sha)
+            if existing is not None and existing is not self._poll:
+                # I already have a poll with this title
+                failed_items.append('title')
         if self._poll.question == '':
             failed_items.append('question')
         if self._poll.maxvoters == 0:
@@ -855,15 +972,18 @@ class PollBuilder(activity.Activity):
 
         sha -- string
         """
-        for poll in self._polls:
-            if poll.sha == sha:
-                self._poll = poll
+        poll = self._polls.get(sha)
+        if poll is not None:
+            self._poll = poll
+            if self.poll_session:
+                self.poll_session.fetch_votes(poll)
 
     def get_my_polls(self):
         """Return list of Polls for all polls I created."""
-        return [poll for poll in self._polls if poll.author==self.nick] 
+        return self._polls.by_author(self.nick)
 
-    def vote_on_poll(self, author, title, choice, votersha):
+    def vote_on_poll(self, author, title, choice, votersha, count=None,
+                     alert=True):
         """Register a vote on a poll from the mesh.
         
         author -- string
@@ -871,21 +991,37 @@ class PollBuilder(activity.Activity):
         choice -- integer 0-4
         votersha -- string
           sha1 of the voter nick
+        count -- integer, the voter's count for choice (see
+          Poll.merge_vote), or None from peers which don't send it
+        alert -- boolean, False to leave alerting to the caller
+
+        Returns True if the vote was counted.
         """
-        for poll in self._polls:
-            if poll.author == author and poll.title == title:
-                try:
-                    poll.register_vote(choice, votersha)
-                    self.alert(_('Vote'),
-                               _('Somebody voted on %s') % title)
-                except OverflowError:
-                    self._logger.debug('Ignored mesh vote %u from %s:'
-                        ' poll reached maximum votes.',
-                        choice, votersha)
-                except ValueError:
-                    self._logger.debug('Ignored mesh vote %u from %s:'
-                        ' poll closed.',
-                        choice, votersha)
+        poll = self._polls.find(author, title)
+        if poll is None:
+            return False
+        if count is not None:
+            added = self._polls.merge_vote(poll, choice, votersha, count)
+            if added and alert:
+                self.alert(_('Vote'),
+                           _('Somebody voted on %s') % title)
+            return added
+        try:
+            poll.register_vote(choice, votersha)
+            self._polls.vote_registered(poll, choice, votersha)
+            if alert:
+                self.alert(_('Vote'),
+                           _('Somebody voted on %s') % title)
+            return True
+        except OverflowError:
+            self._logger.debug('Ignored mesh vote %u from %s:'
+                ' poll reached maximum votes.',
+                choice, votersha)
+        except ValueError:
+            self._logger.debug('Ignored mesh vote %u from %s:'
+                ' poll closed.',
+                choice, votersha)
+        return False
 
     def _canvas_language_select_box(self):
         """CanvasBox definition for lang select box.
@@ -1095,6 +1231,7 @@ class PollBuilder(activity.Activity):
         self._sharing_setup()
 
         self._logger.debug('This is my activity: making a tube...')
+        telepathy = _get_telepathy()
         id = self.tubes_chan[telepathy.CHANNEL_TYPE_TUBES].OfferDBusTube(
             SERVICE, {})
 
@@ -1111,6 +1248,7 @@ class PollBuilder(activity.Activity):
         self.tubes_chan = self._shared_activity.telepathy_tubes_chan
         self.text_chan = self._shared_activity.telepathy_text_chan
 
+        telepathy = _get_telepathy()
         self.tubes_chan[telepathy.CHANNEL_TYPE_TUBES].connect_to_signal(
             'NewTube', self._new_tube_cb)
 
@@ -1135,6 +1273,7 @@ class PollBuilder(activity.Activity):
         self._sharing_setup()
 
         self._logger.debug('This is not my activity: waiting for a tube...')
+        telepathy = _get_telepathy()
         self.tubes_chan[telepathy.CHANNEL_TYPE_TUBES].ListTubes(
             reply_handler=self._list_tubes_reply_cb,
             error_handler=self._list_tubes_error_cb)
@@ -1144,6 +1283,8 @@ class PollBuilder(activity.Activity):
         self._logger.debug('New tube: ID=%d initator=%d type=%d service=%s '
                      'params=%r state=%d', id, initiator, type, service,
                      params, state)
+        telepathy = _get_telepathy()
+        from sugar.presence.tubeconn import TubeConnection
 
         if (type == telepathy.TUBE_TYPE_DBUS and
             service == SERVICE):
@@ -1166,6 +1307,7 @@ class PollBuilder(activity.Activity):
     def _get_buddy(self, cs_handle):
         """Get a Buddy from a channel specific handle."""
         self._logger.debug('Trying to find owner of handle %u...', cs_handle)
+        telepathy = _get_telepathy()
         group = self.text_chan[telepathy.CHANNEL_INTERFACE_GROUP]
         my_csh = group.GetSelfHandle()
         self._logger.debug('My handle in that group is %u', my_csh)
@@ -1183,65 +1325,900 @@ class PollBuilder(activity.Activity):
             self.conn.service_name, self.conn.object_path, handle)
 
 
-class Poll:
-    """Represent the data of one poll."""
+class PollRegistry(gobject.GObject):
+    """Keep the known polls indexed for constant time lookup.
+
+    Polls are indexed by sha, by (author, title) and by author. The
+    index keys are recorded when a poll is added, so a poll whose title
+    or author changes must be passed to update() (or renamed through
+    retitle()) to keep the indexes consistent. Two different polls with
+    the same sha cannot be registered; add(), update() and retitle()
+    raise ValueError rather than drop one of them. update() should also be
+    called after any other change to a registered poll, and
+    vote_registered() after a successful Poll.register_vote(), so that
+    listeners on the signals below see every change.
+    """
+    __gsignals__ = {
+        'poll-added': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE,
+                       (gobject.TYPE_PYOBJECT,)),
+        'poll-removed': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE,
+                         (gobject.TYPE_PYOBJECT,)),
+        'poll-changed': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE,
+                         (gobject.TYPE_PYOBJECT,)),
+        'poll-voted': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE,
+                       (gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT,
+                        gobject.TYPE_PYOBJECT)),
+    }
+
+    def __init__(self):
+        gobject.GObject.__init__(self)
+        self._by_sha = {}
+        self._by_key = {}
+        self._by_author = {}
+        self._keys = {}  # Poll -> (sha, author, title) it is indexed by
+
+    def __iter__(self):
+        return iter(self._by_sha.values())
+
+    def __len__(self):
+        return len(self._by_sha)
+
+    def __contains__(self, poll):
+        return poll in self._keys
+
+    def add(self, poll):
+        """Add a poll.
+
+        poll -- Poll
+
+        Raises ValueError if another poll with the same sha is
+        registered.
+        """
+        if poll in self._keys:
+            self.update(poll)
+            return
+        self._check_unique(poll)
+        self._index(poll)
+        self.emit('poll-added', poll)
+
+    def remove(self, poll):
+        """Remove a poll.
+
+        poll -- Poll
+
+        Raises KeyError if the poll is not in the registry.
+        """
+        if poll not in self._keys:
+            raise KeyError(poll)
+        self._unindex(poll)
+        self.emit('poll-removed', poll)
+
+    def update(self, poll):
+        """Re-index a poll after it changed.
+
+        poll -- Poll
+
+        Raises ValueError, leaving the poll indexed as before, if another
+        poll with its new sha is registered.
+        """
+        self._check_unique(poll)
+        self._unindex(poll)
+        self._index(poll)
+        self.emit('poll-changed', poll)
+
+    def vote_registered(self, poll, choice, votersha):
+        """Announce a vote which was registered on a poll.
+
+        poll -- Poll
+        choice -- integer 0-4
+        votersha -- string, sha1 of the voter nick
+        """
+        if poll in self._keys:
+            self.emit('poll-voted', poll, choice, votersha)
+
+    def merge_vote(self, poll, choice, votersha, count):
+        """Merge a vote from the mesh into a poll, see Poll.merge_vote.
+
+        poll -- Poll
+        choice -- integer 0-4
+        votersha -- string, sha1 of the voter nick
+        count -- integer, the voter's count for choice
+
+        Returns True if the vote was not counted before.
+        """
+        before = poll.data.get(choice, 0)
+        added = poll.merge_vote(choice, votersha, count)
+        if added == 1 and poll.data.get(choice, 0) == before + 1:
+            self.vote_registered(poll, choice, votersha)
+        elif added:
+            # Earlier votes by this voter were missed, or the tally
+            # already had the vote
+            self.update(poll)
+        return bool(added)
+
+    def retitle(self, poll, title):
+        """Change the title of a poll and re-index it.
+
+        poll -- Poll
+        title -- string
+
+        Raises ValueError, leaving the title unchanged, if the author
+        already has another poll with title.
+        """
+        old_title = poll.title
+        poll.title = title
+        try:
+            self.update(poll)
+        except ValueError:
+            poll.title = old_title
+            raise
+
+    def get(self, sha):
+        """Return the poll with sha, or None.
+
+        sha -- string, sha property of the poll
+        """
+        return self._by_sha.get(sha)
+
+    def find(self, author, title):
+        """Return the poll by author with title, or None.
+
+        author -- string
+        title -- string
+        """
+        return self._by_key.get((author, title))
+
+    def by_author(self, author):
+        """Return list of Polls created by author.
+
+        author -- string
+        """
+        return self._by_author.get(author, {}).values()
+
+    def _check_unique(self, poll):
+        existing = self._by_sha.get(poll.sha)
+        if existing is not None and existing is not poll:
+            raise ValueError('Poll %s by %s is already registered' %
+                             (poll.title, poll.author))
+
+    def _index(self, poll):
+        sha = poll.sha
+        key = (poll.author, poll.title)
+        self._keys[poll] = (sha, poll.author, poll.title)
+        self._by_sha[sha] = poll
+        self._by_key[key] = poll
+        self._by_author.setdefault(poll.author, {})[sha] = poll
+
+    def _unindex(self, poll):
+        sha, author, title = self._keys.pop(poll)
+        del self._by_sha[sha]
+        del self._by_key[(author, title)]
+        author_polls = self._by_author[author]
+        del author_polls[sha]
+        if not author_polls:
+            del self._by_author[author]
+
+
+class OwnerIdentity(gobject.GObject):
+    """My nick and its sha1, resolved once from the presence service.
+
+    The owner Buddy's property-changed signal keeps them current, so
+    reading them never costs a D-Bus round trip.
+    """
+    __gsignals__ = {
+        'nick-changed': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE,
+                         (gobject.TYPE_PYOBJECT,)),
+    }
+
+    def __init__(self, owner):
+        """Create the OwnerIdentity.
+
+        owner -- sugar.presence.buddy.Buddy, from get_owner()
+        """
+        gobject.GObject.__init__(self)
+        self._logger = logging.getLogger('poll-activity.OwnerIdentity')
+        self._set_nick(owner.props.nick)
+        owner.connect('property-changed', self._property_changed_cb)
+
+    def _set_nick(self, nick):
+        self._nick = nick
+        self._nick_sha1 = sha1(nick).hexdigest()
+
+    @property
+    def nick(self):
+        """Return my nick."""
+        return self._nick
+
+    @property
+    def nick_sha1(self):
+        """Return the sha1 of my nick."""
+        return self._nick_sha1
+
+    def _property_changed_cb(self, buddy, properties):
+        """Callback for changes to the owner Buddy's properties."""
+        if 'nick' not in properties or properties['nick'] == self._nick:
+            return
+        self._logger.debug('Nick changed from %s to %s', self._nick,
+                           properties['nick'])
+        self._set_nick(properties['nick'])
+        self.emit('nick-changed', self._nick)
+
+
+class PollSelector(object):
+    """The scrolling list of polls on the Choose a Poll screen.
+
+    Only ROWS rows of widgets are ever built. Scrolling binds them to
+    different polls instead of creating new ones. The sorted order of
+    polls is kept up to date from the PollRegistry signals; changes are
+    applied together in an idle callback, and visible rows are rebound.
+    """
+    ROWS = 10
+    # Above this many queued changes, resort rather than insert each one
+    BULK_CHANGES = 64
+
+    def __init__(self, polls, identity, select_cb, delete_cb):
+        """Create the PollSelector.
+
+        polls -- PollRegistry
+        identity -- OwnerIdentity, whose polls can be deleted
+        select_cb -- function called with (button, sha) for VOTE
+        delete_cb -- function called with (button, sha) for DELETE
+        """
+        self._polls = polls
+        self._identity = identity
+        self._select_cb = select_cb
+        self._delete_cb = delete_cb
+        self._order = []  # sorted keys, see _key()
+        self._keys = {}  # Poll -> key in self._order
+        self._by_key = {}  # key in self._order -> Poll
+        self._queued = {}  # Poll -> True to (re)insert, False to remove
+        self._idle_id = None
+        self._first = 0  # index in self._order of the first row
+        self._rows = []
+        self._build()
+        for poll in polls:
+            self._queued[poll] = True
+        self._refresh()
+        polls.connect('poll-added', self._poll_changed_cb)
+        polls.connect('poll-changed', self._poll_changed_cb)
+        polls.connect('poll-removed', self._poll_removed_cb)
+        polls.connect('poll-voted', self._poll_voted_cb)
+        identity.connect('nick-changed', self._nick_changed_cb)
+
+    def get_root(self):
+        """Return the root canvas item, removed from any previous parent."""
+        parent = self.root.get_parent()
+        if parent is not None:
+            parent.remove(self.root)
+        return self.root
+
+    def _build(self):
+        self.root = hippo.CanvasBox(
+            orientation=hippo.ORIENTATION_HORIZONTAL)
+        self._rows_box = rows_box = hippo.CanvasBox(
+            orientation=hippo.ORIENTATION_VERTICAL)
+        rows_box.connect('scroll-event', self._scroll_event_cb)
+        self.root.append(rows_box, hippo.PACK_EXPAND)
+        self._adjustment = gtk.Adjustment(0, 0, 0, 1, self.ROWS, self.ROWS)
+        self._adjustment.connect('value-changed', self._scrolled_cb)
+        self.root.append(hippo.CanvasWidget(
+            widget=gtk.VScrollbar(self._adjustment)))
+
+        for i in range(self.ROWS):
+            row = _PollSelectorRow()
+            row.box = hippo.CanvasBox(
+                padding_top=4, padding_bottom=4,
+                orientation=hippo.ORIENTATION_HORIZONTAL)
+            rows_box.append(row.box)
+
+            sized_box = hippo.CanvasBox(
+                box_width=600,
+                orientation=hippo.ORIENTATION_HORIZONTAL)
+            row.box.append(sized_box)
+            row.title = hippo.CanvasText(
+                xalign=hippo.ALIGNMENT_START,
+                color=style.Color(DARK_GREEN).get_int(),
+                font_desc = pango.FontDescription('Sans 10'))
+            sized_box.append(row.title)
+
+            sized_box = hippo.CanvasBox(
+                box_width=180,
+                orientation=hippo.ORIENTATION_HORIZONTAL)
+            row.box.append(sized_box)
+            row.select_button = gtk.Button(_('VOTE'))
+            row.select_button.connect('clicked', self._button_cb,
+                                      self._select_cb, row)
+            sized_box.append(hippo.CanvasWidget(
+                widget=theme_button(row.select_button)))
+
+            row.delete_box = hippo.CanvasBox(
+                box_width=150,
+                orientation=hippo.ORIENTATION_HORIZONTAL)
+            row.box.append(row.delete_box)
+            button = gtk.Button(_('DELETE'))
+            button.connect('clicked', self._button_cb, self._delete_cb, row)
+            row.delete_button = hippo.CanvasWidget(
+                widget=theme_button(button))
+            row.delete_box.append(row.delete_button)
+            row.date = hippo.CanvasText(
+                color=style.Color(DARK_GREEN).get_int())
+            row.box.append(row.date)
+            self._rows.append(row)
+
+    def _key(self, poll):
+        """Sort newest polls first, then by title and author."""
+        return (-poll.createdate.toordinal(), poll.title.lower(),
+                poll.author, poll.sha)
+
+    def _poll_changed_cb(self, registry, poll):
+        self._queue(poll, True)
+
+    def _poll_removed_cb(self, registry, poll):
+        self._queue(poll, False)
+
+    def _poll_voted_cb(self, registry, poll, choice, votersha):
+        # A vote can close the poll, which changes its button
+        key = self._keys.get(poll)
+        if key is None:
+            return
+        index = bisect.bisect_left(self._order, key)
+        if self._first <= index < self._first + self.ROWS:
+            self._bind(self._rows[index - self._first], index,
+                       self._identity.nick)
+
+    def _nick_changed_cb(self, identity, nick):
+        self._bind_rows()
+
+    def _queue(self, poll, present):
+        self._queued[poll] = present
+        if self._idle_id is None:
+            self._idle_id = gobject.idle_add(self._refresh)
+
+    def _refresh(self):
+        """Apply the queued changes and rebind the rows."""
+        self._idle_id = None
+        queued = self._queued
+        self._queued = {}
+        order = self._order
+        keys = self._keys
+        by_key = self._by_key
+        bulk = len(queued) > self.BULK_CHANGES
+        # Remove everything first: a poll replacing another in this batch
+        # has the same sha, so it may take the key of the one it replaces
+        for poll in queued:
+            old_key = keys.pop(poll, None)
+            if old_key is not None:
+                del by_key[old_key]
+                if not bulk:
+                    del order[bisect.bisect_left(order, old_key)]
+        for poll, present in queued.iteritems():
+            if present:
+                key = self._key(poll)
+                keys[poll] = key
+                by_key[key] = poll
+                if not bulk:
+                    bisect.insort(order, key)
+        if bulk:
+            order = self._order = sorted(by_key.keys())
+
+        adjustment = self._adjustment
+        adjustment.upper = max(len(order), self.ROWS)
+        adjustment.changed()
+        first = min(self._first, len(order) - self.ROWS)
+        first = max(first, 0)
+        if adjustment.value != first:
+            adjustment.set_value(first)  # rebinds via _scrolled_cb
+        else:
+            self._bind_rows()
+        return False
+
+    def _scrolled_cb(self, adjustment):
+        self._first = int(adjustment.value)
+        self._bind_rows()
+
+    def _scroll_event_cb(self, item, event):
+        adjustment = self._adjustment
+        if event.direction == hippo.SCROLL_UP:
+            value = adjustment.value - adjustment.step_increment
+        elif event.direction == hippo.SCROLL_DOWN:
+            value = adjustment.value + adjustment.step_increment
+        else:
+            return False
+        adjustment.set_value(min(max(value, adjustment.lower),
+                                 adjustment.upper - adjustment.page_size))
+        return True
+
+    def _bind_rows(self):
+        nick = self._identity.nick
+        for i, row in enumerate(self._rows):
+            self._bind(row, self._first + i, nick)
+
+    def _bind(self, row, index, nick):
+        """Show the poll at index in self._order on row.
+
+        nick -- string, my nick
+        """
+        if index >= len(self._order):
+            row.sha = None
+            self._rows_box.set_child_visible(row.box, False)
+            return
+        poll = self._by_key[self._order[index]]
+        row.sha = poll.sha
+        if index % 2:
+            row.box.props.background_color = style.COLOR_WHITE.get_int()
+        else:
+            row.box.props.background_color = \
+                style.COLOR_SELECTION_GREY.get_int()
+        row.title.props.text = poll.title + ' (' + poll.author + ')'
+        if poll.active:
+            row.select_button.set_label(_('VOTE'))
+        else:
+            row.select_button.set_label(_('SEE RESULTS'))
+        row.delete_box.set_child_visible(row.delete_button,
+                                         poll.author == nick)
+        # Rows used to ask the presence service for my nick each
+        metrics.count('owner_calls_avoided')
+        row.date.props.text = poll.createdate.strftime('%d/%m/%y')
+        self._rows_box.set_child_visible(row.box, True)
+
+    def _button_cb(self, button, callback, row):
+        if row.sha is not None:
+            callback(button, row.sha)
+
+
+class _PollSelectorRow(object):
+    """The widgets of one PollSelector row and the sha of its poll."""
+    __slots__ = ('box', 'title', 'select_button', 'delete_box',
+                 'delete_button', 'date', 'sha')
+
+
+class _ObservedDict(dict):
+    """A dict which calls changed() after every modification.
+
+    Poll uses this for options and data so that in-place edits, e.g.
+    from PollBuilder._entry_activate_cb, invalidate its cached values.
+    """
+    def __init__(self, changed, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._changed = changed
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed()
+
+    def clear(self):
+        dict.clear(self)
+        self._changed()
+
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._changed()
+        return value
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self._changed()
+        return item
+
+    def setdefault(self, key, default=None):
+        value = dict.setdefault(self, key, default)
+        self._changed()
+        return value
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._changed()
+
+
+class _VoterTable(object):
+    """Intern voter sha1s as small integers shared by all polls."""
+    def __init__(self):
+        self._ids = {}
+        self._shas = []
+
+    def intern(self, votersha):
+        """Return the integer id of votersha, allocating it if new."""
+        votersha = str(votersha)
+        try:
+            return self._ids[votersha]
+        except KeyError:
+            voter_id = len(self._shas)
+            self._ids[votersha] = voter_id
+            self._shas.append(votersha)
+            return voter_id
+
+    def lookup(self, votersha):
+        """Return the integer id of votersha, or None if never seen."""
+        return self._ids.get(str(votersha))
+
+    def sha(self, voter_id):
+        """Return the voter sha1 for an integer id."""
+        return self._shas[voter_id]
+
+
+_voters = _VoterTable()
+
+# Voter of the dummy vote every Poll used to be created with; journals
+# and peers from before per-voter counts may still carry it
+_PLACEHOLDER_VOTER = 'foo'
+
+
+class _TallyView(DictMixin, object):
+    """Dict-shaped {choice: votes} access to a Poll's tally array."""
+    __slots__ = ('_poll',)
+
+    def __init__(self, poll):
+        self._poll = poll
+
+    def __getitem__(self, choice):
+        tally = self._poll._tally
+        if not 0 <= choice < len(tally):
+            raise KeyError(choice)
+        return tally[choice]
+
+    def __setitem__(self, choice, value):
+        tally = self._poll._writable_tally()
+        if not 0 <= choice < len(tally):
+            raise KeyError(choice)
+        tally[choice] = value
+        self._poll._invalidate_vote_count()
+
+    def __delitem__(self, choice):
+        raise TypeError('Poll tallies cannot be deleted')
+
+    def __contains__(self, choice):
+        return 0 <= choice < len(self._poll._tally)
+
+    def __iter__(self):
+        return iter(range(len(self._poll._tally)))
+
+    def __len__(self):
+        return len(self._poll._tally)
+
+    def keys(self):
+        return range(len(self._poll._tally))
+
+    def values(self):
+        return self._poll._tally.tolist()
+
+    def iteritems(self):
+        return enumerate(self._poll._tally)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+
+class _VotesView(DictMixin, object):
+    """Dict-shaped {votersha: choice} access to a Poll's interned votes.
+
+    Read-only: votes are only added through register_vote, merge_vote
+    and merge_counts, which keep the counts per voter in step.
+    """
+    __slots__ = ('_poll',)
+
+    def __init__(self, poll):
+        self._poll = poll
+
+    def __getitem__(self, votersha):
+        voter_id = _voters.lookup(votersha)
+        if voter_id is None:
+            raise KeyError(votersha)
+        return self._poll._vote_ids()[voter_id]
+
+    def __setitem__(self, votersha, choice):
+        raise TypeError('Poll votes are read-only, use register_vote')
+
+    def __delitem__(self, votersha):
+        raise TypeError('Poll votes cannot be deleted')
+
+    def __contains__(self, votersha):
+        return _voters.lookup(votersha) in self._poll._vote_ids()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._poll._vote_ids())
+
+    def keys(self):
+        return [_voters.sha(voter_id) for voter_id in self._poll._vote_ids()]
+
+    def iteritems(self):
+        sha = _voters.sha
+        for voter_id, choice in self._poll._vote_ids().iteritems():
+            yield sha(voter_id), choice
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+
+class Poll(object):
+    """Represent the data of one poll.
+
+    The sha and the vote count are cached. Setting title or author
+    drops the cached sha; setting or editing options or data drops the
+    cached vote count, which register_vote otherwise keeps up to date.
+
+    Tallies are kept in an array and votes are keyed by voter ids from
+    the shared _voters table. The data and votes attributes give the
+    usual dict-shaped access to them.
+
+    Copies of a poll on different laptops are kept in step as a
+    grow-only counter per voter: _counts holds how many times each voter
+    voted for each choice, and only ever goes up. A vote is sent around
+    as the voter's new count (merge_vote) and whole copies are combined
+    by taking the higher of each count (merge_counts), so votes received
+    twice or out of order are counted once and copies that merged the
+    same votes agree. The tallies are the sums of the counts, or higher
+    where they came from a copy whose counts are not known yet (see
+    merge).
+
+    If load_body is given, question, options, data and votes are not
+    set from the arguments but from the (question, options, data, votes)
+    it returns when one of them is first used. data and votes may then
+    be a journal.MappedTally and journal.MappedVotes reading straight
+    from the journal buffer: the tally is only copied into an array when
+    it is first changed, and votes registered before the mapped votes
+    are needed are kept in the _votes and _counts overlays.
+    """
+    __slots__ = ('activity', '_title', '_author', 'active', 'createdate',
+                 'maxvoters', '_question', 'number_of_options', '_options',
+                 '_tally', '_votes', '_counts', '_mapped_votes', '_sha',
+                 '_vote_count',
+                 '_load_body')
+
+    _logger = logging.getLogger('poll-activity.Poll')
+
     def __init__(self, activity=None, title='', author='', active=False,
                  createdate=date.today(), maxvoters=20, question='',
                  number_of_options=5, 
                  options={0: '', 1: '', 2: '', 3: '', 4: ''},
-                 data={0:0, 1:0, 2:0, 3:0, 4:0}, votes={'foo': 0}):
+                 data={0:0, 1:0, 2:0, 3:0, 4:0}, votes={},
+                 load_body=None):
         """Create the Poll."""
+        self._sha = None
+        self._vote_count = None
+        self._load_body = None
+        self._mapped_votes = None
         self.activity = activity
         self.title = title
         self.author = author
         self.active = active
         self.createdate = createdate
         self.maxvoters = maxvoters
-        self.question = question
         self.number_of_options = number_of_options
-        self.options = options
-        self.data = data
-        self.votes = votes
-        self._logger = logging.getLogger('poll-activity.Poll')
+        if load_body is None:
+            self.question = question
+            self.options = options
+            self.data = data
+            self.votes = votes
+        else:
+            self._load_body = load_body
         self._logger.debug('Creating Poll(%s by %s)' % (title, author))
 
-    def dump(self):
-        """Dump a pickled version for the journal"""
-        # The attributes may be dbus types. These are not serialisable
-        # with pickle at the moment, so convert them to builtin types.
-        # Pay special attention to dicts - we need to convert the keys
-        # and values too.
-        s = cPickle.dumps(str(self.title))
-        s += cPickle.dumps(str(self.author))
-        s += cPickle.dumps(bool(self.active))
-        s += cPickle.dumps(self.createdate.toordinal())
-        s += cPickle.dumps(int(self.maxvoters))
-        s += cPickle.dumps(str(self.question))
-        s += cPickle.dumps(int(self.number_of_options))
-        options = {}
-        for key in self.options:
-            value = self.options[key]
-            options[int(key)] = str(value)
-        data = {}
-        for key in self.data:
-            value = self.data[key]
-            data[int(key)] = int(value)
-        votes = {}
-        for key in self.votes:
-            value = self.votes[key]
-            votes[str(key)] = int(value)
-        s += cPickle.dumps(options)
-        s += cPickle.dumps(data)
-        s += cPickle.dumps(votes)
-        return s
+    def _get_title(self):
+        return self._title
+
+    def _set_title(self, title):
+        self._title = title
+        self._sha = None
+
+    title = property(_get_title, _set_title)
+
+    def _get_author(self):
+        return self._author
+
+    def _set_author(self, author):
+        self._author = author
+        self._sha = None
+
+    author = property(_get_author, _set_author)
+
+    def _ensure_body(self):
+        """Set the question, options, data and votes if still deferred."""
+        load_body = self._load_body
+        if load_body is not None:
+            self._load_body = None
+            question, options, data, votes = load_body()
+            self.question = question
+            self.options = options
+            self.data = data
+            self.votes = votes
+
+    def _get_question(self):
+        if self._load_body is not None:
+            self._ensure_body()
+        return self._question
+
+    def _set_question(self, question):
+        if self._load_body is not None:
+            self._ensure_body()
+        self._question = question
+
+    question = property(_get_question, _set_question)
+
+    def _get_options(self):
+        if self._load_body is not None:
+            self._ensure_body()
+        return self._options
+
+    def _set_options(self, options):
+        if self._load_body is not None:
+            self._ensure_body()
+        self._options = _ObservedDict(self._invalidate_vote_count, options)
+        self._vote_count = None
+
+    options = property(_get_options, _set_options)
+
+    def _get_data(self):
+        if self._load_body is not None:
+            self._ensure_body()
+        return _TallyView(self)
+
+    def _set_data(self, data):
+        if self._load_body is not None:
+            self._ensure_body()
+        if isinstance(data, journal.MappedTally):
+            self._tally = data
+            self._vote_count = None
+            return
+        if data:
+            tally = array('l', [0]) * (max(data.keys()) + 1)
+        else:
+            tally = array('l')
+        for choice, value in data.items():
+            tally[int(choice)] = int(value)
+        self._tally = tally
+        self._vote_count = None
+
+    def _writable_tally(self):
+        """Return the tally array, copying a mapped tally first."""
+        if not isinstance(self._tally, array):
+            self._tally = array('l', self._tally)
+        return self._tally
+
+    data = property(_get_data, _set_data)
+
+    def _get_votes(self):
+        if self._load_body is not None:
+            self._ensure_body()
+        return _VotesView(self)
+
+    def _set_votes(self, votes):
+        if self._load_body is not None:
+            self._ensure_body()
+        self._votes = {}
+        self._counts = {}
+        if isinstance(votes, journal.MappedVotes):
+            self._mapped_votes = votes
+            return
+        self._mapped_votes = None
+        if hasattr(votes, 'items'):
+            votes = votes.items()
+        # A list of (votersha, choice) may hold one pair per vote
+        self._add_votes(votes)
+
+    votes = property(_get_votes, _set_votes)
+
+    def _add_votes(self, votes):
+        """Add (votersha, choice) pairs to _votes and _counts.
+
+        The placeholder vote of older polls is left out.
+        """
+        ids = self._votes
+        counts = self._counts
+        intern = _voters.intern
+        for votersha, choice in votes:
+            if votersha == _PLACEHOLDER_VOTER:
+                continue
+            voter_id = intern(votersha)
+            choice = int(choice)
+            ids[voter_id] = choice
+            key = voter_id << 8 | choice
+            counts[key] = counts.get(key, 0) + 1
+
+    def _vote_ids(self):
+        """Return the {voter id: choice} dict, merging any mapped votes."""
+        mapped = self._mapped_votes
+        if mapped is not None:
+            self._mapped_votes = None
+            overlay = self._votes
+            overlay_counts = self._counts
+            self._votes = {}
+            self._counts = {}
+            self._add_votes(mapped.iteritems())
+            self._votes.update(overlay)
+            counts = self._counts
+            for key, count in overlay_counts.iteritems():
+                counts[key] = counts.get(key, 0) + count
+        return self._votes
+
+    def _count_ids(self):
+        """Return the {voter id << 8 | choice: count} dict."""
+        if self._mapped_votes is not None:
+            self._vote_ids()
+        return self._counts
+
+    def vote_counts(self):
+        """Return a list of (votersha, choice, count), see merge_counts.
+
+        The entry for the choice in votes comes after any other choices
+        of the same voter.
+        """
+        if self._load_body is not None:
+            self._ensure_body()
+        sha = _voters.sha
+        ids = self._vote_ids()
+        earlier = []
+        latest = []
+        for key, count in self._count_ids().iteritems():
+            voter_id = key >> 8
+            choice = key & 0xff
+            if ids.get(voter_id) == choice:
+                latest.append((sha(voter_id), choice, count))
+            else:
+                earlier.append((sha(voter_id), choice, count))
+        return earlier + latest
+
+    def body(self):
+        """Return (question, options, data, votes) for saving.
+
+        votes holds one (votersha, choice) per vote, as a list, a dict
+        or journal.MappedVotes, and data may be a journal.MappedTally.
+        A body still deferred is returned as load_body gives it, without
+        loading it into this poll.
+        """
+        if self._load_body is not None:
+            return self._load_body()
+        votes = []
+        for votersha, choice, count in self.vote_counts():
+            votes.extend([(votersha, choice)] * count)
+        return self.question, self.options, self.data, votes
+
+    def _invalidate_vote_count(self):
+        self._vote_count = None
 
     @property
     def vote_count(self):
         """Return the total votes cast."""
-        total = 0
-        for choice in self.options.keys():
-            total += self.data[choice]
-        return total
+        if self._vote_count is None:
+            total = 0
+            data = self.data
+            for choice in self.options.keys():
+                total += data[choice]
+            self._vote_count = total
+        return self._vote_count
+
+    @property
+    def version(self):
+        """Return how many changes this poll has seen.
+
+        Votes only add up and polls are only ever closed, so a higher
+        version means a more recent state of the poll.
+        """
+        return self.vote_count + (not self.active)
+
+    @property
+    def checksum(self):
+        """Return a CRC-32 of the tallies and the counts per voter.
+
+        Two copies of a poll with the same version but a different
+        checksum were changed concurrently.
+        """
+        if self._load_body is not None:
+            self._ensure_body()
+        crc = zlib.crc32('%d %s' % (self.active, ' '.join(
+            [str(value) for value in self.data.values()])))
+        sha = _voters.sha
+        for key, count in self._count_ids().iteritems():
+            # Order independent
+            crc ^= zlib.crc32('%s %d %d' % (sha(key >> 8), key & 0xff,
+                                            count))
+        return crc & 0xffffffff
 
     @property
     def sha(self):
@@ -1249,8 +2226,11 @@ class Poll:
 
         Currently we sha1 the poll title and author.
         """
-        return sha1(self.title + self.author).hexdigest()
+        if self._sha is None:
+            self._sha = sha1(self.title + self.author).hexdigest()
+        return self._sha
 
+    @metrics.timed('register_vote')
     def register_vote(self, choice, votersha):
         """Register a vote on the poll.
 
@@ -1258,6 +2238,8 @@ class Poll:
           sha1 of the voter nick
         """
         self._logger.debug('In Poll.register_vote')
+        if self._load_body is not None:
+            self._ensure_body()
         if self.active:
             if self.vote_count < self.maxvoters:
                 self._logger.debug('About to vote')
@@ -1268,11 +2250,19 @@ class Poll:
                 #    self._logger.debug('%s already voted, decrementing their '
                 #        'old choice %d' % (votersha, self.votes[votersha]))
                 #    self.data[self.votes[votersha]] -= 1
-                self.votes[votersha] = choice
-                self.data[choice] += 1
-                self._logger.debug(
-                    'Recording vote %d by %s on %s by %s' %
-                    (choice, votersha, self.title, self.author))
+                choice = int(choice)
+                voter_id = _voters.intern(votersha)
+                counts = self._count_ids()
+                key = voter_id << 8 | choice
+                count = counts.get(key, 0) + 1
+                counts[key] = count
+                self._votes[voter_id] = choice
+                vote_count = self.vote_count
+                self._writable_tally()[choice] += 1
+                if choice in self.options:
+                    self._vote_count = vote_count + 1
+                self._logger.debug('Recording vote %d by %s on %s by %s',
+                                   choice, votersha, self.title, self.author)
                 # Close poll:
                 if self.vote_count >= self.maxvoters:
                     self.active = False
@@ -1281,42 +2271,203 @@ class Poll:
                     # We are shared so we can send the Vote signal if I voted
                     if votersha == self.activity.nick_sha1:
                         self._logger.debug(
-                            'Shared, I voted so sending signal')
-                        self.activity.poll_session.Vote(
-                            self.author, self.title, choice, votersha)
+                            'Shared, I voted so queueing signal')
+                        self.activity.poll_session.queue_vote(
+                            self.author, self.title, choice, votersha,
+                            count)
             else:
                 raise OverflowError, 'Poll reached maxvoters'
         else:
             raise ValueError, 'Poll closed'
 
+    def merge(self, active, data):
+        """Merge the state of another copy of this poll.
+
+        active -- boolean
+        data -- dict, {choice: votes}
+
+        Closing wins and each tally keeps the higher count, so copies
+        merged in any order end up the same. Tallies merged this way may
+        still miss votes the other copy did not know about; merging its
+        counts with merge_counts settles them. Returns True if this poll
+        changed.
+        """
+        changed = False
+        if self.active and not active:
+            self.active = False
+            changed = True
+        tally = self.data
+        for choice, value in data.items():
+            if choice in tally and value > tally[choice]:
+                tally[choice] = value
+                changed = True
+        return changed
+
+    def merge_vote(self, choice, votersha, count):
+        """Merge a vote from the mesh.
+
+        choice -- integer
+        votersha -- string, sha1 of the voter nick
+        count -- integer, how many times the voter has now voted for
+          choice
+
+        Unlike register_vote this does not refuse votes on polls which
+        are closed or full here, since the voter's copy accepted it.
+        The tally of choice becomes at least the sum of its counts, but
+        is not raised further: a tally received with merge may already
+        include the vote. Returns how many votes this added to the
+        counts: 0 if they were already counted.
+        """
+        if self._load_body is not None:
+            self._ensure_body()
+        choice = int(choice)
+        voter_id = _voters.intern(votersha)
+        counts = self._count_ids()
+        key = voter_id << 8 | choice
+        added = count - counts.get(key, 0)
+        if added <= 0:
+            return 0
+        counts[key] = count
+        self._votes[voter_id] = choice
+        total = 0
+        for other, other_count in counts.iteritems():
+            if other & 0xff == choice:
+                total += other_count
+        tally = self._writable_tally()
+        if choice >= len(tally):
+            tally.extend([0] * (choice + 1 - len(tally)))
+        if total > tally[choice]:
+            tally[choice] = total
+        self._vote_count = None
+        if self.active and self.vote_count >= self.maxvoters:
+            self.active = False
+            self._logger.debug('Poll hit maxvoters, closing')
+        return added
+
+    def merge_counts(self, counts):
+        """Merge the counts of another copy of this poll.
+
+        counts -- list of (votersha, choice, count) as returned by
+          vote_counts()
+
+        Each count keeps the higher value, and each tally becomes at
+        least the sum of its counts. Returns True if this poll changed.
+        """
+        if self._load_body is not None:
+            self._ensure_body()
+        known = self._count_ids()
+        ids = self._votes
+        intern = _voters.intern
+        changed = False
+        for votersha, choice, count in counts:
+            if votersha == _PLACEHOLDER_VOTER:
+                continue
+            voter_id = intern(votersha)
+            key = voter_id << 8 | int(choice)
+            if count > known.get(key, 0):
+                known[key] = int(count)
+                ids.setdefault(voter_id, int(choice))
+                changed = True
+        if not changed:
+            return False
+        sums = {}
+        for key, count in known.iteritems():
+            sums[key & 0xff] = sums.get(key & 0xff, 0) + count
+        tally = self._writable_tally()
+        for choice, total in sums.items():
+            if choice >= len(tally):
+                tally.extend([0] * (choice + 1 - len(tally)))
+            if total > tally[choice]:
+                tally[choice] = total
+        self._vote_count = None
+        if self.active and self.vote_count >= self.maxvoters:
+            self.active = False
+        return True
+
     def broadcast_on_mesh(self):
         if self.activity.poll_session:
             # We are shared so we can broadcast this poll
             self.activity.poll_session.UpdatedPoll(
-                self.title, self.author, self.active,
-                self.createdate.toordinal(),
-                self.maxvoters, self.question, self.number_of_options,
-                self.options, self.data, self.votes) 
+                ByteArray(wire.encode_poll(self)))
 
 
 class PollSession(ExportedGObject):
-    """The bit that talks over the TUBES!!!"""
+    """The bit that talks over the TUBES!!!
+
+    Peers keep their polls in step by anti-entropy: a peer that hears
+    Hello sends the newcomer one hash per bucket of polls (SyncBuckets),
+    then the (sha, version, checksum) digest of the buckets that differ
+    (SyncDigest), and each side sends the other only the polls it lacks
+    or has an older copy of. Copies changed concurrently are combined
+    with Poll.merge.
+
+    Method calls on other peers never block: they go through call(),
+    which runs at most MAX_PEER_CALLS of them at a time on each peer and
+    retries failed ones with a growing delay. Each peer has its own
+    window and timeout, so a peer which vanished without leaving the
+    tube only holds up the calls to itself, and for less time once its
+    calls time out.
+
+    Each peer numbers the votes it sends in Votes signals and keeps the
+    last VOTE_HISTORY of them. A peer that sees a gap in the numbers
+    asks the sender for the missing range (GetVoteRange), and falls back
+    to the digest sync above if the sender no longer has them all.
+    """
 
-    def __init__(self, tube, is_initiator, get_buddy, activity):
+    BUCKETS = 64  # polls are bucketed by sha for SyncBuckets
+    VOTE_WINDOW = 500  # ms to collect my votes for one Votes signal
+    VOTE_HISTORY = 512  # sent votes kept for GetVoteRange
+    MAX_PEER_CALLS = 2  # method calls on one peer in progress at once
+    CALL_TIMEOUT = 10  # seconds before a method call fails
+    MIN_CALL_TIMEOUT = 2  # seconds, for a peer whose calls keep timing out
+    CALL_RETRIES = 3  # times a failed method call is retried
+    RETRY_DELAY = 1000  # ms before the first retry, doubled for each next
+
+    def __init__(self, tube, is_initiator, get_buddy, activity,
+                 vote_window=VOTE_WINDOW):
         """Initialise the PollSession.
 
-        tube -- TubeConnection
+        tube -- TubeConnection, or a stand-in transport with an export
+          method such as loopback.LoopbackTube
         is_initiator -- boolean, True = we are sharing, False = we are joining
         get_buddy -- function
         activity -- PollBuilder (sugar.activity.Activity)
+        vote_window -- integer, ms to collect votes for one Votes signal
         """
-        super(PollSession, self).__init__(tube, PATH)
+        export = getattr(tube, 'export', None)
+        if export is None:
+            super(PollSession, self).__init__(tube, PATH)
+        else:
+            super(PollSession, self).__init__()
+            export(self, PATH)
         self._logger = logging.getLogger('poll-activity.PollSession')
         self.tube = tube
         self.is_initiator = is_initiator
         self.entered = False  # Have we set up the tube?
         self._get_buddy = get_buddy  # Converts handle to Buddy object
         self.activity = activity  # PollBuilder
+        # Bus names to ask for the votes of polls received by UpdatePolls
+        self._vote_sources = {}  # poll sha -> bus name
+        # Polls asked for in SyncDigest but not received yet
+        self._wanted = {}  # poll sha -> (version, bus name asked)
+        self._fetching = set()  # shas of polls with GetVotes in progress
+        self._bus_names = {}  # handle -> bus name of participants
+        self._nicks = {}  # handle -> nick of participants, found on joining
+        # Calls waiting to start: (bus name, method, args, reply_cb,
+        # error_cb, tries)
+        self._calls = {}  # bus name -> calls waiting, oldest first
+        self._calls_running = {}  # bus name -> number of calls in progress
+        self._call_timeouts = {}  # bus name -> seconds, if not CALL_TIMEOUT
+        self.vote_window = vote_window
+        self._outgoing_votes = {}  # (author, title, choice, votersha) -> count
+        self._vote_timer = None
+        self._vote_seq = 0  # sequence number of my next vote
+        # Ring buffer of my last votes, vote n at n % VOTE_HISTORY
+        self._sent_votes = [None] * self.VOTE_HISTORY
+        self._next_votes = {}  # bus name -> sequence number expected next
+        # Votes received but not alerted yet
+        self._votes_received = {}  # title -> number of votes
+        self._vote_alert_timer = None
         self.tube.watch_participants(self.participant_change_cb)
 
     def participant_change_cb(self, added, removed):
@@ -1327,20 +2478,13 @@ class PollSession(ExportedGObject):
         if removed:
             self._logger.debug('Removing participants: %r' % removed)
         for handle, bus_name in added:
+            self._bus_names[handle] = bus_name
             buddy = self._get_buddy(handle)
             if buddy is not None:
+                self._nicks[handle] = buddy.props.nick
                 self._logger.debug('Buddy %s was added' % buddy.props.nick)
-        for handle in removed:
-            buddy = self._get_buddy(handle)
-            if buddy is not None:
-                self._logger.debug('Buddy %s was removed' % buddy.props.nick)
-                # Set buddy's polls to not active so I can't vote on them
-                for poll in self.activity._polls:
-                    if poll.author == buddy.props.nick:
-                        poll.active = False
-                        self._logger.debug(
-                            'Closing poll %s of %s who just left.' %
-                            (poll.title, poll.author))
+        if removed:
+            self._participants_left(removed)
 
         if not self.entered:
             if self.is_initiator:
@@ -1352,16 +2496,19 @@ class PollSession(ExportedGObject):
                 path=PATH, sender_keyword='sender')
             self.tube.add_signal_receiver(self.vote_cb, 'Vote', IFACE,
                 path=PATH, sender_keyword='sender')
+            self.tube.add_signal_receiver(self.votes_cb, 'Votes', IFACE,
+                path=PATH, sender_keyword='sender')
             self.tube.add_signal_receiver(self.helloback_cb, 'HelloBack',
                 IFACE, path=PATH, sender_keyword='sender')
-            self.tube.add_signal_receiver(self.updatedpoll_cb, 
-                'UpdatedPoll', IFACE, path=PATH, sender_keyword='sender')
+            self.tube.add_signal_receiver(self.updatedpoll_cb,
+                'UpdatedPoll', IFACE, path=PATH, sender_keyword='sender',
+                byte_arrays=True)
             self.my_bus_name = self.tube.get_unique_name()
             self.entered = True
 
     @signal(dbus_interface=IFACE, signature='')
     def Hello(self):
-        """Request that my UpdatePoll method is called to let me know about
+        """Request that my UpdatePolls method is called to let me know about
         other known polls.
         """
 
@@ -1373,8 +2520,66 @@ class PollSession(ExportedGObject):
         title -- string, poll title
         choice -- integer 0-4, selected vote
         votersha -- string, sha1 of voter's nick
+
+        Only older versions send this; see Votes.
         """
 
+    @signal(dbus_interface=IFACE, signature='ua(ssusu)')
+    def Votes(self, seq, votes):
+        """Send my votes of the last vote_window ms.
+
+        seq -- integer, sequence number of the first vote; the others
+          follow on
+        votes -- list of (author, title, choice, votersha, count):
+          the buddy name of the poll's author, the poll title, the
+          choice, the sha1 of the voter's nick and how many times the
+          voter has now voted for choice
+        """
+
+    def queue_vote(self, author, title, choice, votersha, count):
+        """Send my vote in the next Votes signal."""
+        key = (author, title, choice, votersha)
+        # A later count includes the earlier votes
+        if count > self._outgoing_votes.get(key, 0):
+            self._outgoing_votes[key] = count
+        if self._vote_timer is None:
+            self._vote_timer = gobject.timeout_add(self.vote_window,
+                                                   self._send_votes_cb)
+
+    def _send_votes_cb(self):
+        """Send the queued votes."""
+        self._vote_timer = None
+        votes = [key + (count,)
+                 for key, count in self._outgoing_votes.iteritems()]
+        self._outgoing_votes = {}
+        if votes:
+            seq = self._vote_seq
+            self._logger.debug('Sending votes %d-%d' %
+                               (seq, seq + len(votes) - 1))
+            history = self._sent_votes
+            for vote in votes:
+                history[self._vote_seq % self.VOTE_HISTORY] = vote
+                self._vote_seq += 1
+            self.Votes(seq, votes)
+        return False
+
+    @method(dbus_interface=IFACE, in_signature='uu',
+            out_signature='ba(ssusu)')
+    def GetVoteRange(self, first, end):
+        """Return the votes I sent numbered from first up to end.
+
+        first -- integer, sequence number of the first vote
+        end -- integer, sequence number following the last vote
+
+        Returns (complete, votes). complete is False, and votes empty,
+        if I no longer have all of them.
+        """
+        if end > self._vote_seq or first < self._vote_seq - self.VOTE_HISTORY:
+            return False, []
+        history = self._sent_votes
+        return True, [history[seq % self.VOTE_HISTORY]
+                      for seq in xrange(first, end)]
+
     @signal(dbus_interface=IFACE, signature='s')
     def HelloBack(self, recipient):
         """Respond to Hello.
@@ -1382,10 +2587,12 @@ class PollSession(ExportedGObject):
         recipient -- string, sender of Hello.
         """
 
-    @signal(dbus_interface=IFACE, signature='ssuuusua{us}a{uu}a{su}')
-    def UpdatedPoll(self, title, author, active, createdate, maxvoters,
-                   question, number_of_options, options, data, votes):
-        """Broadcast a new poll to the mesh."""
+    @signal(dbus_interface=IFACE, signature='ay')
+    def UpdatedPoll(self, poll):
+        """Broadcast a new poll to the mesh.
+
+        poll -- dbus.ByteArray, see wire.encode_poll
+        """
 
     def hello_cb(self, sender=None):
         """Tell the newcomer what's going on."""
@@ -1395,17 +2602,182 @@ class PollSession(ExportedGObject):
         if sender == self.my_bus_name:
             # then I don't want to respond to my own Hello
             return
-        # Send my polls
-        for poll in self.activity.get_my_polls():
-            self._logger.debug('Telling %s about my %s' % 
-                               (sender, poll.title))
-            self.tube.get_object(sender, PATH).UpdatePoll(
-                poll.title, poll.author, int(poll.active),
-                poll.createdate.toordinal(),
-                poll.maxvoters, poll.question, poll.number_of_options,
-                poll.options, poll.data, poll.votes, dbus_interface=IFACE)
-        # Ask for other's polls back
-        self.HelloBack(sender)
+        self.sync(sender)
+
+    def sync(self, bus_name):
+        """Compare polls with bus_name, each then sends what the other
+        lacks."""
+        self.call(bus_name, 'SyncBuckets', (self.bucket_hashes(),),
+                  self._sync_buckets_reply_cb)
+
+    def _sync_buckets_reply_cb(self, sender, buckets):
+        """Send the digest of the buckets the newcomer differs in."""
+        if not buckets:
+            return
+        self._logger.debug('Sending %s the digest of %d buckets' %
+                           (sender, len(buckets)))
+        self.call(sender, 'SyncDigest', (buckets, self.digest(buckets)),
+                  self._sync_digest_reply_cb)
+
+    def _sync_digest_reply_cb(self, sender, wanted, polls):
+        """Take the polls the newcomer sent and send those it wants."""
+        self._receive_polls(polls, sender)
+        self.send_polls(sender, self._polls_by_sha(wanted))
+
+    def call(self, bus_name, method, args, reply_cb=None, error_cb=None):
+        """Call method on the peer bus_name without blocking.
+
+        bus_name -- string
+        method -- string, name of a PollSession method
+        args -- tuple of arguments
+        reply_cb -- function called with bus_name and the return values,
+          or None
+        error_cb -- function called with bus_name if the call failed for
+          good, or None
+
+        Failed calls are retried CALL_RETRIES times, unless the peer
+        left meanwhile.
+        """
+        self._calls.setdefault(bus_name, []).append(
+            (bus_name, method, args, reply_cb, error_cb, 0))
+        self._start_calls(bus_name)
+
+    def _start_calls(self, bus_name):
+        """Start the calls waiting for bus_name, as its window allows."""
+        waiting = self._calls.get(bus_name)
+        running = self._calls_running
+        while waiting and running.get(bus_name, 0) < self.MAX_PEER_CALLS:
+            call = waiting.pop(0)
+            if not waiting:
+                del self._calls[bus_name]
+            bus_name, method, args, reply_cb, error_cb, tries = call
+            running[bus_name] = running.get(bus_name, 0) + 1
+            metrics.count('calls')
+            reply_handler, error_handler = self._call_handlers(call)
+            try:
+                remote = self.tube.get_object(bus_name, PATH)
+                getattr(remote, method)(*args, **{
+                    'dbus_interface': IFACE,
+                    'byte_arrays': True,
+                    'reply_handler': reply_handler,
+                    'error_handler': error_handler,
+                    'timeout': self._call_timeouts.get(bus_name,
+                                                       self.CALL_TIMEOUT)})
+            except DBusException, e:
+                error_handler(e)
+
+    def _call_done(self, bus_name):
+        """Free the place of a finished call in the window of bus_name."""
+        running = self._calls_running
+        if running[bus_name] == 1:
+            del running[bus_name]
+        else:
+            running[bus_name] -= 1
+
+    def _call_handlers(self, call):
+        """Return the reply and error handlers for call."""
+        return (lambda *values: self._call_reply_cb(call, values),
+                lambda e: self._call_error_cb(call, e))
+
+    def _call_reply_cb(self, call, values):
+        bus_name, method, args, reply_cb, error_cb, tries = call
+        self._call_done(bus_name)
+        # The peer answers again
+        self._call_timeouts.pop(bus_name, None)
+        if reply_cb is not None:
+            reply_cb(bus_name, *values)
+        self._start_calls(bus_name)
+
+    def _call_error_cb(self, call, e):
+        metrics.count('call_errors')
+        bus_name, method, args, reply_cb, error_cb, tries = call
+        self._call_done(bus_name)
+        if e.get_dbus_name() == 'org.freedesktop.DBus.Error.NoReply':
+            # Wait less for a peer which stopped answering
+            timeout = self._call_timeouts.get(bus_name, self.CALL_TIMEOUT)
+            self._call_timeouts[bus_name] = max(timeout / 2,
+                                                self.MIN_CALL_TIMEOUT)
+        if tries < self.CALL_RETRIES and \
+                bus_name in self._bus_names.itervalues():
+            delay = self.RETRY_DELAY << tries
+            self._logger.debug('%s on %s failed, retrying in %d ms: %s' %
+                               (method, bus_name, delay, e))
+            gobject.timeout_add(delay, self._retry_call_cb,
+                                (bus_name, method, args, reply_cb, error_cb,
+                                 tries + 1))
+        else:
+            self._logger.debug('%s on %s failed: %s' % (method, bus_name, e))
+            if error_cb is not None:
+                error_cb(bus_name)
+        self._start_calls(bus_name)
+
+    def _retry_call_cb(self, call):
+        if call[0] in self._bus_names.itervalues():
+            self._calls.setdefault(call[0], []).append(call)
+            self._start_calls(call[0])
+        elif call[4] is not None:
+            call[4](call[0])
+        return False
+
+    def _participants_left(self, handles):
+        """Forget the peers which left and close the polls of their buddies.
+
+        handles -- list of channel specific handles
+
+        The nicks were found when the peers joined, so this makes no
+        D-Bus calls, and a whole class leaving at once costs a single
+        pass over the pending calls plus a look at each of their polls.
+        """
+        bus_names = set()
+        nicks = set()
+        for handle in handles:
+            bus_name = self._bus_names.pop(handle, None)
+            if bus_name is not None:
+                bus_names.add(bus_name)
+            nick = self._nicks.pop(handle, None)
+            if nick is None:
+                # The buddy was not known yet when it joined
+                buddy = self._get_buddy(handle)
+                if buddy is not None:
+                    nick = buddy.props.nick
+            if nick is not None:
+                nicks.add(nick)
+        if bus_names:
+            self._forget_peers(bus_names)
+        # Still here with another handle
+        nicks.difference_update(self._nicks.itervalues())
+        polls = self.activity._polls
+        for nick in nicks:
+            self._logger.debug('Buddy %s was removed' % nick)
+            # Set buddy's polls to not active so I can't vote on them
+            for poll in polls.by_author(nick):
+                if poll.active:
+                    poll.active = False
+                    polls.update(poll)
+                    self._logger.debug(
+                        'Closing poll %s of %s who just left.' %
+                        (poll.title, poll.author))
+
+    def _forget_peers(self, bus_names):
+        """Drop the calls and requests involving peers which left.
+
+        bus_names -- set of strings
+        """
+        for sha, (version, asked) in self._wanted.items():
+            if asked in bus_names:
+                del self._wanted[sha]
+        for sha, source in self._vote_sources.items():
+            if source in bus_names:
+                del self._vote_sources[sha]
+        dropped = []
+        for bus_name in bus_names:
+            self._next_votes.pop(bus_name, None)
+            self._call_timeouts.pop(bus_name, None)
+            dropped.extend(self._calls.pop(bus_name, ()))
+        # Error callbacks may start calls to the peers still here
+        for call in dropped:
+            if call[4] is not None:
+                call[4](call[0])
 
     def helloback_cb(self, recipient, sender):
         """Reply to Hello.
@@ -1423,56 +2795,97 @@ class PollSession(ExportedGObject):
             # This is not for me
             return
         self._logger.debug('*** It was for me, so sending my polls back.')
-        for poll in self.activity.get_my_polls():
-            self._logger.debug('Telling %s about my %s' % 
-                               (sender, poll.title))
-            self.tube.get_object(sender, PATH).UpdatePoll(
-                poll.title, poll.author, int(poll.active),
-                poll.createdate.toordinal(),
-                poll.maxvoters, poll.question, poll.number_of_options,
-                poll.options, poll.data, poll.votes, dbus_interface=IFACE)
+        self.send_polls(sender)
+
+    @metrics.timed('updatedpoll_cb')
+    def updatedpoll_cb(self, *poll, **keywords):
+        """Handle an UpdatedPoll signal, see _add_wire_poll.
 
-    def updatedpoll_cb(self, title, author, active, createdate, maxvoters,
-                       question, number_of_options, options_d, data_d,
-                       votes_d, sender):
-        """Handle an UpdatedPoll signal by creating a new Poll."""
+        poll -- dbus.ByteArray, see wire.encode_poll; older versions
+          send the fields of the poll instead, see _legacy_poll
+        """
+        sender = keywords.get('sender')
         self._logger.debug('Received UpdatedPoll from %s' % sender)
         if sender == self.my_bus_name:
             # Ignore my own signal
             return
-        # We get the parameters as dbus types. These are not serialisable
-        # with pickle at the moment, so convert them to builtin types.
-        # Pay special attention to dicts - we need to convert the keys
-        # and values too.
-        title = str(title)
-        author = str(author)
-        active = bool(active)
-        createdate = date.fromordinal(int(createdate))
-        maxvoters = int(maxvoters)
-        question = str(question)
-        number_of_options = int(number_of_options)
+        if len(poll) == 1:
+            self._add_wire_poll(poll[0], sender)
+        else:
+            self._add_poll(self._legacy_poll(*poll), sender)
+
+    def _add_wire_poll(self, payload, sender):
+        """Add or merge the poll sent by sender with UpdatedPoll.
+
+        payload -- dbus.ByteArray, see wire.encode_poll
+        """
+        try:
+            fields = wire.decode_poll(payload)
+        except ValueError, e:
+            self._logger.debug('Ignoring poll from %s: %s' % (sender, e))
+            return
+        self._add_poll(fields, sender)
+
+    def _legacy_poll(self, title, author, active, createdate, maxvoters,
+                     question, number_of_options, options_d, data_d,
+                     votes_d):
+        """Convert a poll sent by an older version to builtin types.
+
+        Returns the fields as wire.decode_poll does, counting one vote
+        per voter in votes_d.
+        """
         options = {}
         for key in options_d:
-            value = options_d[key]
-            options[int(key)] = str(value)
+            options[int(key)] = str(options_d[key])
         data = {}
         for key in data_d:
-            value = data_d[key]
-            data[int(key)] = int(value)
-        votes = {}
-        for key in votes_d:
-            value = votes_d[key]
-            votes[str(key)] = int(value)
-        poll = Poll(self.activity, title, author, active, 
-                    createdate, maxvoters, question, number_of_options,
-                    options, data, votes)
-        self.activity._polls.add(poll)
+            data[int(key)] = int(data_d[key])
+        counts = [(str(votersha), int(votes_d[votersha]), 1)
+                  for votersha in votes_d]
+        return (str(title), str(author), bool(active),
+                date.fromordinal(int(createdate)), int(maxvoters),
+                str(question), int(number_of_options), options, data, counts)
+
+    def _add_poll(self, fields, sender):
+        """Add or merge a poll sent by sender.
+
+        fields -- tuple, as returned by wire.decode_poll
+
+        A poll I already know is merged into my copy rather than
+        replacing it, so peers rejoining and sending it again add
+        neither objects nor alerts. Copies that add nothing to mine,
+        such as repeats and stale versions, are dropped.
+        """
+        (title, author, active, createdate, maxvoters, question,
+         number_of_options, options, data, counts) = fields
+        poll = self.activity._polls.find(author, title)
+        if poll is not None:
+            self._wanted.pop(poll.sha, None)
+            changed = poll.merge(active, data)
+            if poll.merge_counts(counts):
+                changed = True
+            if changed:
+                self.activity._polls.update(poll)
+            else:
+                self._logger.debug('Dropping stale copy of %s from %s' %
+                                   (title, sender))
+            return
+        poll = Poll(self.activity, title, author, active, createdate,
+                    maxvoters, question, number_of_options, options, data,
+                    wire.vote_pairs(counts))
+        try:
+            self.activity._polls.add(poll)
+        except ValueError, e:
+            self._logger.debug('Ignoring poll from %s: %s' % (sender, e))
+            return
+        self._wanted.pop(poll.sha, None)
         self.activity.alert(_('New Poll'),
-                            _("%s shared a poll '%s' with you.") % 
+                            _("%s shared a poll '%s' with you.") %
                             (author, title))
 
+    @metrics.timed('vote_cb')
     def vote_cb(self, author, title, choice, votersha, sender=None):
-        """Receive somebody's vote signal.
+        """Receive the Vote signal of an older version.
 
         author -- string, buddy name
         title -- string, poll title
@@ -1488,54 +2901,337 @@ class PollSession(ExportedGObject):
         self._logger.debug('In vote_cb. sender: %r' % sender)
         self._logger.debug('%s voted %d on %s by %s' % (votersha, choice,
                                                         title, author))
-        self.activity.vote_on_poll(author, title, choice, votersha)
+        self.activity.vote_on_poll(str(author), str(title), int(choice),
+                                   str(votersha))
+
+    @metrics.timed('votes_cb')
+    def votes_cb(self, seq, votes, sender=None):
+        """Receive somebody's Votes signal.
+
+        seq -- integer, sequence number of the first vote
+        votes -- list of (author, title, choice, votersha, count)
+
+        Votes missed since the last signal from sender are asked for
+        with GetVoteRange.
+        """
+        if sender == self.my_bus_name:
+            return
+        seq = int(seq)
+        self._logger.debug('%s sent votes %d-%d' %
+                           (sender, seq, seq + len(votes) - 1))
+        expected = self._next_votes.get(sender)
+        if expected is not None and seq > expected:
+            self._logger.debug('Missed votes %d-%d of %s' %
+                               (expected, seq - 1, sender))
+            metrics.count('vote_gaps')
+            self.call(sender, 'GetVoteRange', (expected, seq),
+                      self._vote_range_reply_cb)
+        if expected is None or seq + len(votes) > expected:
+            self._next_votes[sender] = seq + len(votes)
+        self._merge_votes(votes)
+
+    def _vote_range_reply_cb(self, sender, complete, votes):
+        """Merge the missed votes, or sync if sender no longer has them."""
+        if complete:
+            self._merge_votes(votes)
+        else:
+            self._logger.debug('%s no longer has the votes I missed' %
+                               sender)
+            self.sync(sender)
+
+    def _merge_votes(self, votes):
+        """Merge votes from the mesh.
+
+        votes -- list of (author, title, choice, votersha, count)
+
+        The votes received over vote_window ms share a single alert.
+        """
+        metrics.count('votes_received', len(votes))
+        received = self._votes_received
+        for author, title, choice, votersha, count in votes:
+            title = str(title)
+            if self.activity.vote_on_poll(str(author), title, int(choice),
+                                          str(votersha), int(count),
+                                          alert=False):
+                received[title] = received.get(title, 0) + 1
+        if received and self._vote_alert_timer is None:
+            self._vote_alert_timer = gobject.timeout_add(
+                self.vote_window, self._alert_votes_cb)
+
+    def _alert_votes_cb(self):
+        """Alert the votes received since the last alert."""
+        self._vote_alert_timer = None
+        received = self._votes_received
+        self._votes_received = {}
+        counted = sum(received.values())
+        if counted == 1:
+            self.activity.alert(_('Vote'),
+                                _('Somebody voted on %s') % received.keys()[0])
+        elif len(received) == 1:
+            self.activity.alert(_('Vote'),
+                                _('%d votes on %s') %
+                                (counted, received.keys()[0]))
+        elif counted:
+            self.activity.alert(_('Vote'),
+                                _('%d votes on %d polls') %
+                                (counted, len(received)))
+        return False
 
     @method(dbus_interface=IFACE, in_signature='ssuuusua{us}a{uu}a{su}',
-            out_signature='')
+            out_signature='', sender_keyword='sender')
     def UpdatePoll(self, title, author, active, createdate, maxvoters,
-                   question, number_of_options, options_d, data_d, votes_d):
+                   question, number_of_options, options_d, data_d, votes_d,
+                   sender=None):
         """To be called on the incoming buddy by the other participants
-        to inform you of their polls and state."""
-        # We get the parameters as dbus types. These are not serialisable
-        # with pickle at the moment, so convert them to builtin types.
-        # Pay special attention to dicts - we need to convert the keys
-        # and values too.
-        title = str(title)
-        author = str(author)
-        active = bool(active)
-        createdate = date.fromordinal(int(createdate))
-        maxvoters = int(maxvoters)
-        question = str(question)
-        number_of_options = int(number_of_options)
-        options = {}
-        for key in options_d:
-            value = options_d[key]
-            options[int(key)] = str(value)
-        data = {}
-        for key in data_d:
-            value = data_d[key]
-            data[int(key)] = int(value)
-        votes = {}
-        for key in votes_d:
-            value = votes_d[key]
-            votes[str(key)] = int(value)
-        poll = Poll(self.activity, title, author, active, 
-                    createdate, maxvoters, question, number_of_options,
-                    options, data, votes)
-        self.activity._polls.add(poll)
-        self.activity.alert(_('New Poll'),
-                            _("%s shared a poll '%s' with you.") % 
-                            (author, title))
+        to inform you of their polls and state.
+
+        Only older versions call this; see UpdatePolls.
+        """
+        self._add_poll(self._legacy_poll(title, author, active, createdate,
+                                         maxvoters, question,
+                                         number_of_options, options_d,
+                                         data_d, votes_d), sender)
 
     @method(dbus_interface=IFACE, in_signature='s', out_signature='')
     def PollsWanted(self, sender):
         """Notification to send my polls to sender."""
-        for poll in self.activity.get_my_polls():
-            self.tube.get_object(sender, PATH).UpdatePoll(
+        self.send_polls(sender)
+
+    def _bucket(self, sha):
+        """Return the bucket of the poll with sha."""
+        return int(sha[:4], 16) % self.BUCKETS
+
+    def bucket_hashes(self):
+        """Return one hash of the digest of each bucket of polls."""
+        hashes = [0] * self.BUCKETS
+        for poll in self.activity._polls:
+            sha = poll.sha
+            hashes[self._bucket(sha)] ^= zlib.crc32('%s %d %d' % (
+                sha, poll.version, poll.checksum)) & 0xffffffff
+        return hashes
+
+    def digest(self, buckets=None):
+        """Return (sha, version, checksum) of the polls I know.
+
+        buckets -- list of bucket numbers, or None for all polls
+        """
+        if buckets is not None:
+            buckets = set(buckets)
+        return [(poll.sha, poll.version, poll.checksum)
+                for poll in self.activity._polls
+                if buckets is None or self._bucket(poll.sha) in buckets]
+
+    @method(dbus_interface=IFACE, in_signature='au', out_signature='au')
+    def SyncBuckets(self, hashes):
+        """Return the buckets whose hash differs from mine.
+
+        hashes -- list of uint32, see bucket_hashes()
+        """
+        mine = self.bucket_hashes()
+        return [bucket for bucket in range(self.BUCKETS)
+                if hashes[bucket] != mine[bucket]]
+
+    def _polls_by_sha(self, shas):
+        """Return the known polls among shas."""
+        polls = []
+        for sha in shas:
+            poll = self.activity._polls.get(str(sha))
+            if poll is not None:
+                polls.append(poll)
+        return polls
+
+    @method(dbus_interface=IFACE, in_signature='aua(suu)',
+            out_signature='asa(ssuuusua{us}a{uu}uu)',
+            sender_keyword='sender')
+    def SyncDigest(self, buckets, digest, sender=None):
+        """Compare the caller's digest with my polls.
+
+        buckets -- list of bucket numbers the digest covers
+        digest -- list of (sha, version, checksum), see digest()
+
+        Returns the shas of the polls I want from the caller, and the
+        polls the caller lacks or has an older or concurrent version of
+        as for UpdatePolls.
+        """
+        wanted = []
+        send = []
+        theirs = {}  # sha -> version
+        for sha, version, checksum in digest:
+            sha = str(sha)
+            version = int(version)
+            theirs[sha] = version
+            poll = self.activity._polls.get(sha)
+            if poll is None:
+                if self._wanted.get(sha, (-1, None))[0] < version:
+                    wanted.append(sha)
+                continue
+            if version == poll.version and checksum == poll.checksum:
+                continue
+            if version >= poll.version:
+                # Newer or concurrent: both sides merge the other's copy
+                if self._wanted.get(sha, (-1, None))[0] < version:
+                    wanted.append(sha)
+            if version <= poll.version:
+                send.append(poll)
+        for sha in wanted:
+            # Don't ask other peers for these while they are coming
+            self._wanted[sha] = (theirs[sha], sender)
+        buckets = set(buckets)
+        for poll in self.activity._polls:
+            sha = poll.sha
+            if sha not in theirs and self._bucket(sha) in buckets:
+                send.append(poll)
+        self._logger.debug('Digest from %s: want %d polls, sending %d' %
+                           (sender, len(wanted), len(send)))
+        return wanted, self._poll_batch(send)
+
+    def send_polls(self, recipient, polls=None):
+        """Send polls to recipient in one UpdatePolls call.
+
+        recipient -- string, bus name
+        polls -- list of Poll, defaults to all my polls
+        """
+        if polls is None:
+            polls = self.activity.get_my_polls()
+        if polls:
+            self._logger.debug('Telling %s about %d polls' %
+                               (recipient, len(polls)))
+            self.call(recipient, 'UpdatePolls', (self._poll_batch(polls),))
+
+    def _poll_batch(self, polls):
+        """Return polls as the argument of UpdatePolls."""
+        batch = []
+        for poll in polls:
+            batch.append((
                 poll.title, poll.author, int(poll.active),
                 poll.createdate.toordinal(),
                 poll.maxvoters, poll.question, poll.number_of_options,
-                poll.options, poll.data, poll.votes, dbus_interface=IFACE)
+                dict(poll.options), dict(poll.data), poll.version,
+                poll.checksum))
+        return batch
+
+    @method(dbus_interface=IFACE,
+            in_signature='a(ssuuusua{us}a{uu}uu)', out_signature='',
+            sender_keyword='sender')
+    def UpdatePolls(self, polls, sender=None):
+        """To be called on the incoming buddy by the other participants
+        to inform you of their polls and state.
+
+        Unlike UpdatePoll this carries many polls at once and no votes.
+        Those are only fetched from the caller with GetVotes when a poll
+        is opened, see fetch_votes. Polls I already know are merged with
+        Poll.merge.
+
+        polls -- list of (title, author, active, createdate, maxvoters,
+                 question, number_of_options, options, data, version,
+                 checksum), see Poll.version and Poll.checksum
+        """
+        self._receive_polls(polls, sender)
+
+    @metrics.timed('receive_polls')
+    def _receive_polls(self, polls, sender):
+        """Add or merge polls sent by sender, see UpdatePolls."""
+        metrics.count('polls_received', len(polls))
+        new_polls = []
+        for (title, author, active, createdate, maxvoters, question,
+             number_of_options, options_d, data_d, version,
+             checksum) in polls:
+            title = str(title)
+            author = str(author)
+            data = {}
+            for key in data_d:
+                data[int(key)] = int(data_d[key])
+            poll = self.activity._polls.find(author, title)
+            if poll is not None:
+                self._wanted.pop(poll.sha, None)
+                differ = (int(version) != poll.version or
+                          int(checksum) != poll.checksum)
+                if poll.merge(bool(active), data):
+                    self.activity._polls.update(poll)
+                    differ = True
+                if differ:
+                    # Settle the votes by merging the counts
+                    self._vote_sources[poll.sha] = sender
+                    self.fetch_votes(poll)
+                continue
+            options = {}
+            for key in options_d:
+                options[int(key)] = str(options_d[key])
+            poll = Poll(self.activity, title, author, bool(active),
+                        date.fromordinal(int(createdate)), int(maxvoters),
+                        str(question), int(number_of_options),
+                        options, data, {})
+            try:
+                self.activity._polls.add(poll)
+            except ValueError, e:
+                self._logger.debug('Ignoring poll from %s: %s' % (sender, e))
+                continue
+            self._wanted.pop(poll.sha, None)
+            self._vote_sources[poll.sha] = sender
+            new_polls.append(poll)
+        if len(new_polls) == 1:
+            poll = new_polls[0]
+            self.activity.alert(_('New Poll'),
+                                _("%s shared a poll '%s' with you.") %
+                                (poll.author, poll.title))
+        elif new_polls:
+            self.activity.alert(_('New Poll'),
+                                _('%d polls were shared with you.') %
+                                len(new_polls))
+
+    @method(dbus_interface=IFACE, in_signature='ss', out_signature='ay')
+    def GetVotes(self, author, title):
+        """Return the votes of author's poll title.
+
+        author -- string, buddy name
+        title -- string, poll title
+
+        Returns its vote_counts() packed by wire.encode_counts, see
+        Poll.merge_counts.
+        """
+        poll = self.activity._polls.find(str(author), str(title))
+        if poll is None:
+            return ByteArray(wire.encode_counts([]))
+        return ByteArray(wire.encode_counts(poll.vote_counts()))
+
+    def fetch_votes(self, poll):
+        """Get the votes of a poll received by UpdatePolls.
+
+        poll -- Poll, does nothing if its votes are already known.
+        """
+        if poll.sha in self._fetching:
+            # Fetched from the latest source once this one is done
+            return
+        sender = self._vote_sources.pop(poll.sha, None)
+        if sender is None:
+            return
+        self._logger.debug('Asking %s for the votes on %s' %
+                           (sender, poll.title))
+        self._fetching.add(poll.sha)
+        self.call(sender, 'GetVotes', (poll.author, poll.title),
+                  lambda sender, votes: self._got_votes(poll, votes),
+                  lambda sender: self._got_votes(poll, None))
+
+    def _got_votes(self, poll, votes):
+        """Merge the votes returned by GetVotes into poll.
+
+        votes -- dbus.ByteArray, see wire.encode_counts, or None if
+          the call failed
+        """
+        self._fetching.discard(poll.sha)
+        if poll not in self.activity._polls:
+            # Deleted meanwhile
+            return
+        counts = []
+        if votes is not None:
+            try:
+                counts = wire.decode_counts(votes)
+            except ValueError, e:
+                self._logger.debug('Ignoring votes on %s: %s' %
+                                   (poll.title, e))
+        if poll.merge_counts(counts):
+            self.activity._polls.update(poll)
+        self.fetch_votes(poll)
 
 
 def justify(textdict, choice):
@@ -1556,39 +3252,85 @@ def justify(textdict, choice):
 
 
 class LessonPlanWidget (gtk.Notebook):
-    def __init__ (self, basepath):
+    """Notebook of lesson plans, one tab per lesson.
+
+    Laying out a lesson takes long, so each lesson is only loaded when
+    its tab is first shown, and the others are loaded one at a time
+    while the main loop is idle. The file shown for each lesson comes
+    from the lesson manifest, see i18n.find_lessons.
+    """
+    def __init__ (self, basepath, code=None):
         """Create a Notebook widget for displaying lesson plans in tabs.
 
         basepath -- string, path of directory containing lesson plans.
+        code -- string, locale code such as 'pt_BR' to pick the
+          translated lessons, or None for the default ones
         """
         super(LessonPlanWidget, self).__init__()
-        lessons = filter(lambda x: os.path.isdir(os.path.join(basepath,
-                                                              'lessons', x)),
-                         os.listdir(os.path.join(basepath, 'lessons')))
-        lessons.sort()
-        for lesson in lessons:
-            self._load_lesson(os.path.join(basepath, 'lessons', lesson),
-                              _(lesson))
+        self._basepath = basepath
+        self._code = code
+        self._pages = []  # (box, lesson, path of the lesson file)
+        self._loaded = set()  # page numbers loaded or given up on
+        self._rescanned = None  # {lesson: path} once rescanned
+        self._prefetch_id = None
+        for lesson, path in i18n.find_lessons(basepath, code):
+            box = gtk.VBox()
+            box.show()
+            self.append_page(box, gtk.Label(_(lesson)))
+            self._pages.append((box, lesson, path))
+        self.connect('switch-page', self._switch_page_cb)
+        self.connect('map', self._map_cb)
+
+    def _switch_page_cb (self, notebook, page, page_num):
+        self._load_page(page_num)
+
+    def _map_cb (self, widget):
+        self._load_page(self.get_current_page())
+        if self._prefetch_id is None and self._pages:
+            self._prefetch_id = gobject.idle_add(self._prefetch_cb,
+                                                 priority=gobject.PRIORITY_LOW)
+
+    def _prefetch_cb (self):
+        """Load the next lesson not loaded yet."""
+        for page_num in range(len(self._pages)):
+            if page_num not in self._loaded:
+                self._load_page(page_num)
+                return True
+        return False
+
+    def _load_page (self, page_num):
+        """Load the lesson of tab page_num unless it was already."""
+        if not 0 <= page_num < len(self._pages) or page_num in self._loaded:
+            return
+        self._loaded.add(page_num)
+        box, lesson, path = self._pages[page_num]
+        if not os.path.exists(path):
+            # The manifest is out of date; rescan once for all the tabs
+            if self._rescanned is None:
+                self._rescanned = dict(i18n.find_lessons(
+                    self._basepath, self._code, rescan=True))
+            path = self._rescanned.get(lesson)
+            if path is None:
+                # The lesson is gone, leave its tab empty
+                return
+            self._pages[page_num] = (box, lesson, path)
+        box.pack_start(self._load_lesson(path))
 
-    def _load_lesson (self, path, name):
-        """Load the lesson content from a .abw, taking l10n into account.
+    def _load_lesson (self, path):
+        """Return an AbiCanvas showing a lesson.
 
-        path -- string, path of lesson plan file, e.g. lessons/Introduction
-        lesson -- string, name of lesson
+        path -- string, path of lesson plan file, e.g.
+          lessons/Introduction/default.abw
         """
-        code, encoding = locale.getdefaultlocale()
+        from abiword import Canvas as AbiCanvas
         canvas = AbiCanvas()
         canvas.show()
-        files = map(lambda x: os.path.join(path, '%s.abw' % x),
-                    ('_'+code.lower(), '_'+code.split('_')[0].lower(), 
-                     'default'))
-        files = filter(lambda x: os.path.exists(x), files)
         # On jhbuild, the first works, on XO image 432 the second works:
         try:
-            canvas.load_file('file://%s' % files[0], 'text/plain')
+            canvas.load_file('file://%s' % path, 'text/plain')
         except:
-            canvas.load_file('file://%s' % files[0])
+            canvas.load_file('file://%s' % path)
         canvas.view_online_layout()
         canvas.zoom_width()
         canvas.set_show_margin(False)
-        self.append_page(canvas, gtk.Label(name))
+        return canvas
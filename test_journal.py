@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""Tests of the journal file format and of JournalWriter.
+
+journal.py only needs the standard library, so these use small
+stand-ins for Poll and PollRegistry and run anywhere:
+
+  python test_journal.py
+"""
+
+import os
+import shutil
+import cPickle
+import tempfile
+import unittest
+from datetime import date
+
+import journal
+
+VOTER = 'a' * 40
+
+
+class _Poll(object):
+    """The parts of a Poll the journal reads."""
+    def __init__(self, title, author='author', maxvoters=1000):
+        self.title = title
+        self.author = author
+        self.active = True
+        self.createdate = date(2008, 1, 31)
+        self.maxvoters = maxvoters
+        self.question = 'Question?'
+        self.number_of_options = 2
+        self.options = {0: 'Yes', 1: 'No'}
+        self.data = {0: 0, 1: 0}
+        self.counts = {}  # (votersha, choice) -> count
+
+    def vote_counts(self):
+        return [(votersha, choice, count)
+                for (votersha, choice), count in self.counts.items()]
+
+    def body(self):
+        votes = []
+        for votersha, choice, count in self.vote_counts():
+            votes.extend([(votersha, choice)] * count)
+        return self.question, self.options, self.data, votes
+
+    def register_vote(self, choice, votersha):
+        self.data[choice] += 1
+        key = (votersha, choice)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def state(self):
+        """Return the poll as read_polls returns it, votes sorted."""
+        votes = []
+        for votersha, choice, count in self.vote_counts():
+            votes.extend([(votersha, choice)] * count)
+        return (self.title, self.author, self.active, self.createdate,
+                self.maxvoters, self.question, self.number_of_options,
+                dict(self.options), dict(self.data), sorted(votes))
+
+
+class _Registry(object):
+    """The signals of a PollRegistry, emitted by hand."""
+    def __init__(self):
+        self.polls = []
+        self._handlers = {}
+
+    def connect(self, name, handler):
+        self._handlers[name] = handler
+
+    def add(self, poll):
+        self.polls.append(poll)
+        self._handlers['poll-added'](self, poll)
+
+    def update(self, poll):
+        self._handlers['poll-changed'](self, poll)
+
+    def remove(self, poll):
+        self.polls.remove(poll)
+        self._handlers['poll-removed'](self, poll)
+
+    def vote(self, poll, choice, votersha):
+        poll.register_vote(choice, votersha)
+        self._handlers['poll-voted'](self, poll, choice, votersha)
+
+
+def read_states(path):
+    """Return the sorted polls in the journal at path, votes sorted."""
+    f = open(path, 'rb')
+    try:
+        polls = journal.read_polls(f)
+    finally:
+        f.close()
+    states = []
+    for fields in polls:
+        votes = fields[9]
+        if hasattr(votes, 'items'):
+            # Legacy files hold a {votersha: choice} dict
+            votes = votes.items()
+        states.append(fields[:9] + (sorted(votes),))
+    return sorted(states)
+
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'polls')
+        self.map_threshold = journal.MAP_THRESHOLD
+
+    def tearDown(self):
+        journal.MAP_THRESHOLD = self.map_threshold
+        shutil.rmtree(self.dir)
+
+    def states(self, polls):
+        return sorted([poll.state() for poll in polls])
+
+
+class WriteTest(JournalTestCase):
+
+    def test_snapshot_round_trip(self):
+        polls = [_Poll('first'), _Poll('second', 'other')]
+        polls[0].register_vote(1, VOTER)
+        polls[0].register_vote(1, VOTER)
+        polls[1].active = False
+        f = open(self.path, 'wb')
+        journal.write_polls(f, polls)
+        f.close()
+        self.assertEqual(read_states(self.path), self.states(polls))
+
+    def test_mapped_round_trip(self):
+        journal.MAP_THRESHOLD = 0
+        polls = [_Poll('poll %d' % i) for i in range(50)]
+        for i, poll in enumerate(polls):
+            poll.register_vote(i % 2, VOTER)
+        writer = journal.JournalWriter()
+        writer.write(self.path, polls)
+        self.assertEqual(read_states(self.path), self.states(polls))
+
+    def test_legacy_pickles(self):
+        f = open(self.path, 'wb')
+        cPickle.dump(1, f)
+        for value in ['title', 'author', True,
+                      date(2008, 1, 31).toordinal(), 20, 'Question?', 2,
+                      {0: 'Yes', 1: 'No'}, {0: 1, 1: 0}, {VOTER: 0}]:
+            cPickle.dump(value, f)
+        f.close()
+        self.assertEqual(read_states(self.path), [
+            ('title', 'author', True, date(2008, 1, 31), 20, 'Question?', 2,
+             {0: 'Yes', 1: 'No'}, {0: 1, 1: 0}, [(VOTER, 0)])])
+
+
+class AppendTest(JournalTestCase):
+
+    def setUp(self):
+        JournalTestCase.setUp(self)
+        self.registry = _Registry()
+        # Never compact unless a test asks to
+        self.writer = journal.JournalWriter(compact_records=1000,
+                                            compact_ratio=1000)
+        self.writer.watch(self.registry)
+        for title in ('first', 'second', 'third'):
+            self.registry.add(_Poll(title))
+        self.save()
+        self.snapshot_size = os.path.getsize(self.path)
+        # File size after each save -> state it must read back
+        self.saved = [(self.snapshot_size, self.states(self.registry.polls))]
+
+    def save(self):
+        self.writer.write(self.path, self.registry.polls)
+
+    def change(self, step):
+        """Make one change which saves as one log record, and save it."""
+        registry = self.registry
+        poll = registry.polls[step % len(registry.polls)]
+        if step % 5 == 3:
+            poll.question = 'Question %d?' % step
+            registry.update(poll)
+        elif step == 7:
+            registry.remove(poll)
+        elif step == 11:
+            registry.add(_Poll('fourth'))
+        else:
+            registry.vote(poll, step % 2, VOTER)
+        self.save()
+        self.saved.append((os.path.getsize(self.path),
+                           self.states(registry.polls)))
+
+    def test_vote_appends_one_small_record(self):
+        poll = self.registry.polls[0]
+        self.registry.vote(poll, 1, VOTER)
+        self.save()
+        added = os.path.getsize(self.path) - self.snapshot_size
+        self.assert_(0 < added < 100, added)
+        self.assertEqual(read_states(self.path),
+                         self.states(self.registry.polls))
+
+    def test_replay(self):
+        for step in range(20):
+            self.change(step)
+            self.assertEqual(read_states(self.path), self.saved[-1][1])
+
+    def test_compaction(self):
+        self.writer.compact_records = 3
+        for step in range(4):
+            self.change(step)
+        self.assertEqual(os.path.getsize(self.path), self.writer._size)
+        self.assert_(self.writer._log_records < 4)
+        self.assertEqual(read_states(self.path),
+                         self.states(self.registry.polls))
+
+    def check_truncations(self):
+        for step in range(20):
+            self.change(step)
+        f = open(self.path, 'rb')
+        contents = f.read()
+        f.close()
+        cut_path = os.path.join(self.dir, 'cut')
+        for size in range(self.snapshot_size, len(contents) + 1):
+            f = open(cut_path, 'wb')
+            f.write(contents[:size])
+            f.close()
+            expected = [state for saved_size, state in self.saved
+                        if saved_size <= size][-1]
+            self.assertEqual(read_states(cut_path), expected,
+                             'truncated to %d bytes' % size)
+
+    def test_truncated_tail(self):
+        self.check_truncations()
+
+    def test_truncated_tail_mapped(self):
+        journal.MAP_THRESHOLD = 0
+        self.check_truncations()
+
+    def test_corrupt_tail(self):
+        self.change(0)
+        self.change(1)
+        f = open(self.path, 'r+b')
+        f.seek(-6, 2)
+        byte = f.read(1)
+        f.seek(-6, 2)
+        f.write(chr(ord(byte) ^ 0xff))
+        f.close()
+        self.assertEqual(read_states(self.path), self.saved[-2][1])
+
+
+class LogPathTest(JournalTestCase):
+    """Saving to a new file each time, as Sugar does."""
+
+    def setUp(self):
+        JournalTestCase.setUp(self)
+        self.registry = _Registry()
+        self.writer = journal.JournalWriter(
+            os.path.join(self.dir, 'log'), compact_records=1000,
+            compact_ratio=1000)
+        self.writer.watch(self.registry)
+        for title in ('first', 'second'):
+            self.registry.add(_Poll(title))
+        self.saves = 0
+
+    def save(self):
+        """Save to a new file and return its path."""
+        self.saves += 1
+        path = os.path.join(self.dir, 'save%d' % self.saves)
+        self.writer.write(path, self.registry.polls)
+        return path
+
+    def test_vote_appends_to_the_log(self):
+        first = self.save()
+        log_size = os.path.getsize(self.writer.log_path)
+        states = self.states(self.registry.polls)
+        self.registry.vote(self.registry.polls[0], 1, VOTER)
+        second = self.save()
+        added = os.path.getsize(self.writer.log_path) - log_size
+        self.assert_(0 < added < 100, added)
+        self.assertEqual(read_states(second),
+                         self.states(self.registry.polls))
+        # Files saved before keep what they had
+        self.assertEqual(read_states(first), states)
+
+    def test_adopt_appends_to_the_file_read(self):
+        self.registry.vote(self.registry.polls[0], 0, VOTER)
+        path = self.save()
+        os.remove(self.writer.log_path)
+        registry = _Registry()
+        writer = journal.JournalWriter(os.path.join(self.dir, 'log2'))
+        writer.watch(registry)
+        f = open(path, 'rb')
+        try:
+            polls = journal.read_polls(f)
+        finally:
+            f.close()
+        for fields in polls:
+            poll = _Poll(fields[0], fields[1])
+            poll.data = fields[8]
+            for vote in fields[9]:
+                poll.counts[vote] = poll.counts.get(vote, 0) + 1
+            registry.add(poll)
+        writer.adopt(path, registry.polls)
+        size = os.path.getsize(path)
+        registry.vote(registry.polls[0], 1, VOTER)
+        saved = os.path.join(self.dir, 'resaved')
+        writer.write(saved, registry.polls)
+        self.assert_(0 < os.path.getsize(saved) - size < 100)
+        self.assertEqual(read_states(saved), self.states(registry.polls))
+
+    def test_adopt_legacy_file_snapshots(self):
+        f = open(self.path, 'wb')
+        cPickle.dump(0, f)
+        f.close()
+        self.writer.adopt(self.path, [])
+        path = self.save()
+        self.assertEqual(read_states(path), self.states(self.registry.polls))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""Tests of Poll and of sharing polls over a loopback.LoopbackBus.
+
+These import poll.py, so they need the same environment as the
+activity (pygtk, hippo, dbus and sugar). Run them with
+
+  python test_poll.py
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from datetime import date
+
+import gobject
+from dbus import DBusException
+
+import wire
+import journal
+from poll import Poll, PollRegistry, sha1
+from loopback import LoopbackBus, _LoadPeer
+
+
+def make_ui_poll(peer, title):
+    """Return a poll built the way the Build a Poll screen builds one."""
+    poll = Poll(activity=peer)
+    poll.title = title
+    poll.author = peer.nick
+    poll.question = 'Question?'
+    poll.options[0] = 'Yes'
+    poll.options[1] = 'No'
+    poll.number_of_options = 2
+    poll.active = True
+    return poll
+
+
+def settle(bus, peers):
+    """Run the main loop until no message or vote is waiting."""
+    loop = gobject.MainLoop()
+
+    def check_cb():
+        if bus.pending or [peer for peer in peers
+                           if peer.poll_session._vote_timer]:
+            return True
+        loop.quit()
+        return False
+    gobject.timeout_add(10, check_cb)
+    loop.run()
+
+
+class PlaceholderVoteTest(unittest.TestCase):
+    """Polls must not count the 'foo' vote they were once created with."""
+
+    def test_default_poll_has_no_votes(self):
+        poll = Poll()
+        self.assertEqual(poll.vote_counts(), [])
+        self.assertEqual(len(poll.votes), 0)
+
+    def test_legacy_placeholder_is_ignored(self):
+        poll = Poll(None, 'title', 'author', True, date.today(), 20, 'Q?',
+                    2, {0: 'Yes', 1: 'No'}, {0: 0, 1: 1},
+                    {'foo': 0, 'a' * 40: 1})
+        self.assertEqual(poll.vote_counts(), [('a' * 40, 1, 1)])
+        poll.merge_counts([('foo', 0, 1)])
+        self.assertEqual(dict(poll.data), {0: 0, 1: 1})
+
+    def test_ui_poll_converges_to_votes_cast(self):
+        bus = LoopbackBus(1)
+        peers = [_LoadPeer(bus, nick, nick == 'a') for nick in 'abc']
+        author = peers[0]
+        poll = make_ui_poll(author, 'ui poll')
+        author._polls.add(poll)
+        for peer in peers:
+            peer.join()
+        settle(bus, peers)
+        poll.register_vote(1, author.nick_sha1)
+        author._polls.vote_registered(poll, 1, author.nick_sha1)
+        settle(bus, peers)
+        for peer in peers[1:]:
+            copy = peer._polls.find('a', 'ui poll')
+            peer.poll_session.fetch_votes(copy)
+        settle(bus, peers)
+        for peer in peers:
+            copy = peer._polls.find('a', 'ui poll')
+            self.assertEqual((copy.data[0], copy.data[1]), (0, 1))
+            self.assertEqual(copy.checksum, poll.checksum)
+
+
+class CacheTest(unittest.TestCase):
+    """Poll.sha and Poll.vote_count must match a full recomputation."""
+
+    VOTERS = [sha1(str(i)).hexdigest() for i in range(5)]
+
+    def check(self, poll):
+        self.assertEqual(poll.sha, sha1(poll.title + poll.author).hexdigest())
+        total = 0
+        for choice in poll.options.keys():
+            total += poll.data[choice]
+        self.assertEqual(poll.vote_count, total)
+
+    def edit(self, rand, poll, polls):
+        """Make one random change to poll."""
+        op = rand.randrange(10)
+        choice = rand.randrange(5)
+        if op == 0:
+            poll.title = rand.choice(['a', 'b', 'c'])
+        elif op == 1:
+            poll.author = rand.choice(['x', 'y'])
+        elif op == 2:
+            try:
+                polls.retitle(poll, rand.choice(['d', 'e', 'f']))
+            except ValueError:
+                pass
+        elif op == 3:
+            # As PollBuilder._entry_activate_cb does
+            poll.options[choice] = rand.choice(['', 'Yes', 'No'])
+        elif op == 4:
+            poll.options = dict([(i, 'o%d' % i)
+                                 for i in range(rand.randint(2, 5))])
+        elif op == 5:
+            poll.data[choice] = rand.randrange(10)
+        elif op == 6:
+            poll.data = dict([(i, rand.randrange(10)) for i in range(5)])
+        elif op == 7:
+            poll.active = True
+            try:
+                poll.register_vote(choice, rand.choice(self.VOTERS))
+            except OverflowError:
+                pass
+        elif op == 8:
+            votersha = rand.choice(self.VOTERS)
+            poll.merge_vote(choice, votersha, rand.randint(1, 5))
+        else:
+            poll.merge_counts([(rand.choice(self.VOTERS), choice,
+                                rand.randint(1, 5))])
+
+    def test_random_edits_and_votes(self):
+        for seed in range(20):
+            rand = random.Random(seed)
+            polls = PollRegistry()
+            poll = Poll(_LoadPeer(LoopbackBus(), 'x', True), title='a',
+                        author='x', active=True, maxvoters=1000,
+                        options={0: 'Yes', 1: 'No', 2: '', 3: '', 4: ''})
+            polls.add(poll)
+            for step in range(300):
+                self.edit(rand, poll, polls)
+                self.check(poll)
+
+    def test_votes_are_read_only(self):
+        poll = Poll(title='a', author='x', active=True,
+                    votes=[(self.VOTERS[0], 1)])
+        self.assertRaises(TypeError, poll.votes.__setitem__,
+                          self.VOTERS[1], 0)
+        self.assertRaises(TypeError, poll.votes.__delitem__, self.VOTERS[0])
+        self.assertRaises(TypeError, poll.votes.clear)
+        self.assertEqual(dict(poll.votes), {self.VOTERS[0]: 1})
+        self.assertEqual(poll.vote_counts(), [(self.VOTERS[0], 1, 1)])
+
+    def test_deferred_body(self):
+        poll = Poll(_LoadPeer(LoopbackBus(), 'x', True), title='a',
+                    author='x', active=True, maxvoters=10,
+                    load_body=lambda: ('Q?', {0: 'Yes', 1: 'No'},
+                                       {0: 2, 1: 3}, []))
+        self.check(poll)
+        poll.register_vote(1, self.VOTERS[0])
+        self.check(poll)
+        self.assertEqual(poll.vote_count, 6)
+
+
+class ConvergenceTest(unittest.TestCase):
+    """Copies of a poll agree once each has merged every vote message,
+    in whatever order and however many times they arrive.
+    """
+
+    def author_poll(self, ui):
+        """Return the author's poll."""
+        peer = _LoadPeer(LoopbackBus(), 'peer0', True)
+        if ui:
+            return make_ui_poll(peer, 'poll')
+        return Poll(peer, 'poll', 'peer0', True, date.today(), 1000,
+                    'Question?', 2, {0: 'Yes', 1: 'No'}, {0: 0, 1: 0}, {})
+
+    def copies(self, rand, poll):
+        """Return poll and copies as peers first get them."""
+        peers = [_LoadPeer(LoopbackBus(), 'peer%d' % i, False)
+                 for i in range(1, 4)]
+        replicas = [poll]
+        for peer in peers:
+            if rand.random() < 0.5:
+                # By UpdatedPoll, with the votes
+                fields = wire.decode_poll(wire.encode_poll(poll))
+                copy = Poll(peer, *(fields[:9] + (wire.vote_pairs(
+                    fields[9]),)))
+            else:
+                # By UpdatePolls, without them
+                copy = Poll(peer, poll.title, poll.author, poll.active,
+                            poll.createdate, poll.maxvoters, poll.question,
+                            poll.number_of_options, dict(poll.options),
+                            dict(poll.data), {})
+            replicas.append(copy)
+        return replicas
+
+    def check_convergence(self, seed, ui):
+        rand = random.Random(seed)
+        poll = self.author_poll(ui)
+        # Each voter votes on their own copy
+        voters = [sha1('voter%d' % i).hexdigest() for i in range(4)]
+        cast = {0: 0, 1: 0}
+        messages = []
+        # Votes on the author's copy before the others get theirs, which
+        # then include them in their tallies but maybe not in their counts
+        early = rand.randrange(5)
+        replicas = [poll]
+        for i in range(min(poll.maxvoters - 1, 40)):
+            if i == early:
+                replicas = self.copies(rand, poll)
+            home = rand.randrange(len(replicas))
+            replica = replicas[home]
+            choice = rand.randrange(2)
+            replica.register_vote(choice, voters[home])
+            cast[choice] += 1
+            count = dict([((votersha, c), n) for votersha, c, n
+                          in replica.vote_counts()])[(voters[home], choice)]
+            messages.append(('vote', choice, voters[home], count))
+            if rand.random() < 0.2:
+                # A whole copy, as GetVotes returns it
+                messages.append(('counts', replica.vote_counts()))
+        for replica in replicas:
+            received = []
+            for message in messages:
+                received.extend([message] * rand.randint(1, 3))
+            rand.shuffle(received)
+            for message in received:
+                if message[0] == 'vote':
+                    replica.merge_vote(*message[1:])
+                else:
+                    replica.merge_counts(message[1])
+        first = replicas[0]
+        for replica in replicas:
+            self.assertEqual(sorted(replica.vote_counts()),
+                             sorted(first.vote_counts()))
+            self.assertEqual(replica.checksum, first.checksum)
+            self.assertEqual((replica.data[0], replica.data[1]),
+                             (cast[0], cast[1]))
+
+    def test_reordering_and_duplication(self):
+        for seed in range(50):
+            self.check_convergence(seed, False)
+
+    def test_ui_polls(self):
+        for seed in range(50):
+            self.check_convergence(seed, True)
+
+
+class SyncTest(unittest.TestCase):
+    """Peers sharing polls over a LoopbackBus."""
+
+    def setUp(self):
+        self.bus = LoopbackBus(1)
+        self.peers = []
+
+    def join(self, nick, polls=()):
+        """Return a new peer with polls titled polls, joined to the bus."""
+        peer = _LoadPeer(self.bus, nick, not self.peers)
+        for title in polls:
+            peer._polls.add(Poll(peer, title, nick, True, date.today(), 20,
+                                 'Question?', 2, {0: 'Yes', 1: 'No'},
+                                 {0: 0, 1: 0}, {}))
+        self.peers.append(peer)
+        peer.join()
+        return peer
+
+    def settle(self):
+        settle(self.bus, self.peers)
+
+    def test_vote_counted_once_when_synced_before_its_signal(self):
+        author = self.join('a', ['poll'])
+        self.settle()
+        poll = author._polls.find('a', 'poll')
+        poll.register_vote(0, author.nick_sha1)
+        author._polls.vote_registered(poll, 0, author.nick_sha1)
+        # Gets the poll with the vote in its tally by UpdatePolls, and
+        # the Votes signal only once the vote window is over
+        other = self.join('b')
+        self.settle()
+        copy = other._polls.find('a', 'poll')
+        self.assertEqual((copy.data[0], copy.data[1]), (1, 0))
+        other.poll_session.sync(author.poll_session.my_bus_name)
+        self.settle()
+        for each in (poll, copy):
+            self.assertEqual((each.data[0], each.data[1]), (1, 0))
+        self.assertEqual(copy.checksum, poll.checksum)
+
+    def test_rebroadcast_poll_is_merged_into_one_copy(self):
+        author = self.join('a')
+        other = self.join('b')
+        self.settle()
+        poll = Poll(author, 'poll', 'a', True, date.today(), 20,
+                    'Question?', 2, {0: 'Yes', 1: 'No'}, {0: 0, 1: 0}, {})
+        author._polls.add(poll)
+        for i in range(100):
+            poll.broadcast_on_mesh()
+        self.settle()
+        self.assertEqual(len(other._polls), 1)
+        self.assertEqual(other.alerts, 1)
+        copy = other._polls.find('a', 'poll')
+        # A stale copy leaves the vote cast here
+        copy.register_vote(1, 'c' * 40)
+        poll.broadcast_on_mesh()
+        self.settle()
+        self.assert_(other._polls.find('a', 'poll') is copy)
+        self.assertEqual((copy.data[0], copy.data[1]), (0, 1))
+        # A concurrent vote is merged into the same copy
+        poll.register_vote(0, 'd' * 40)
+        poll.broadcast_on_mesh()
+        self.settle()
+        self.assert_(other._polls.find('a', 'poll') is copy)
+        self.assertEqual((copy.data[0], copy.data[1]), (1, 1))
+        self.assertEqual(sorted(copy.vote_counts()),
+                         [('c' * 40, 1, 1), ('d' * 40, 0, 1)])
+        self.assertEqual(len(other._polls), 1)
+        self.assertEqual(other.alerts, 1)
+
+    def test_departed_buddies_polls_are_closed(self):
+        peers = [self.join(nick, ['poll']) for nick in 'abcd']
+        self.settle()
+        looked_up = []
+        for peer in peers:
+            get_buddy = peer.poll_session._get_buddy
+            peer.poll_session._get_buddy = lambda handle, get=get_buddy: (
+                looked_up.append(handle) or get(handle))
+        for peer in peers[2:]:
+            peer.poll_session.tube.close()
+        self.settle()
+        for peer in peers[:2]:
+            self.assertEqual(len(peer._polls), 4)
+            for poll in peer._polls:
+                self.assertEqual(poll.active, poll.author in 'ab',
+                                 poll.author)
+        # The nicks of the peers were found when they joined
+        self.assertEqual(looked_up, [])
+
+    def test_missed_votes_are_fetched_by_range(self):
+        author = self.join('a', ['poll'])
+        other = self.join('b')
+        self.settle()
+        made = self.calls_made(other)
+        poll = author._polls.find('a', 'poll')
+        emit = self.bus._emit
+
+        def vote(choice, lost=False):
+            if lost:
+                self.bus._emit = lambda sender, name, args: None
+            poll.register_vote(choice, author.nick_sha1)
+            author._polls.vote_registered(poll, choice, author.nick_sha1)
+            self.settle()
+            self.bus._emit = emit
+        vote(0)
+        vote(1, lost=True)
+        vote(1, lost=True)
+        copy = other._polls.find('a', 'poll')
+        self.assertEqual((copy.data[0], copy.data[1]), (1, 0))
+        vote(0)
+        self.assertEqual(made, ['GetVoteRange'])
+        self.assertEqual((copy.data[0], copy.data[1]), (2, 2))
+        self.assertEqual(copy.checksum, poll.checksum)
+        # Votes the author no longer keeps are settled by a sync
+        vote(1, lost=True)
+        author.poll_session.VOTE_HISTORY = 1
+        vote(1, lost=True)
+        vote(0)
+        self.assertEqual(made[1:3], ['GetVoteRange', 'SyncBuckets'])
+        self.assertEqual((copy.data[0], copy.data[1]), (3, 4))
+        self.assertEqual(copy.checksum, poll.checksum)
+
+    def test_vote_signal_of_older_versions(self):
+        author = self.join('a', ['poll'])
+        other = self.join('b')
+        self.settle()
+        other.poll_session.Vote('a', 'poll', 1, other.nick_sha1)
+        self.settle()
+        poll = author._polls.find('a', 'poll')
+        self.assertEqual((poll.data[0], poll.data[1]), (0, 1))
+        self.assertEqual(poll.vote_counts(), [(other.nick_sha1, 1, 1)])
+
+    def calls_made(self, peer):
+        """Return a list which gets the name of each call peer makes."""
+        made = []
+        session = peer.poll_session
+        call = session.call
+
+        def recording_call(bus_name, method, *args):
+            made.append(method)
+            call(bus_name, method, *args)
+        session.call = recording_call
+        return made
+
+    def test_resent_polls_fetch_only_changed_votes(self):
+        author = self.join('a', ['one', 'two', 'three'])
+        other = self.join('b')
+        self.settle()
+        made = self.calls_made(other)
+        bus_name = other.poll_session.tube.bus_name
+        author.poll_session.send_polls(bus_name)
+        self.settle()
+        self.assertEqual(made, [])
+        # A vote the other peer never heard of
+        author._polls.find('a', 'two').register_vote(1, 'c' * 40)
+        author.poll_session.send_polls(bus_name)
+        self.settle()
+        self.assertEqual(made, ['GetVotes'])
+        self.assertEqual(other._polls.find('a', 'two').vote_counts(),
+                         [('c' * 40, 1, 1)])
+
+
+class SaveTest(unittest.TestCase):
+
+    def test_snapshot_leaves_bodies_deferred(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'read')
+            f = open(path, 'wb')
+            journal.write_polls(f, [Poll(None, 'poll', 'author', True,
+                                         date.today(), 20, 'Q?', 2,
+                                         {0: 'Yes', 1: 'No'}, {0: 1, 1: 1},
+                                         [('a' * 40, 0), ('b' * 40, 1)])])
+            f.close()
+            f = open(path, 'rb')
+            polls = [Poll(None, title, author, active, createdate,
+                          maxvoters, number_of_options=number_of_options,
+                          load_body=load_body)
+                     for (title, author, active, createdate, maxvoters,
+                          number_of_options, load_body)
+                     in journal.read_index(f)]
+            f.close()
+            saved = os.path.join(directory, 'saved')
+            journal.JournalWriter().write(saved, polls)
+            self.assert_(polls[0]._load_body is not None)
+            f = open(saved, 'rb')
+            self.assertEqual(journal.read_polls(f)[0][8:],
+                             ({0: 1, 1: 1}, [('a' * 40, 0), ('b' * 40, 1)]))
+            f.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+class CallWindowTest(unittest.TestCase):
+    """A peer which stops answering only holds up the calls to itself."""
+
+    def setUp(self):
+        self.bus = LoopbackBus(1)
+        self.peers = [_LoadPeer(self.bus, nick, nick == 'a')
+                      for nick in 'abc']
+        for peer in self.peers:
+            peer.join()
+        settle(self.bus, self.peers)
+        self.session = self.peers[0].poll_session
+        self.hung = self.peers[2].poll_session.tube.bus_name
+        self.timeouts = []
+        self.error_handlers = []
+        get_object = self.session.tube.get_object
+
+        def hung_get_object(bus_name, path):
+            remote = get_object(bus_name, path)
+            if bus_name != self.hung:
+                return remote
+            return _HungRemote(self.timeouts, self.error_handlers)
+        self.session.tube.get_object = hung_get_object
+
+    def test_hung_peer_keeps_to_its_own_window(self):
+        done = []
+        for i in range(5):
+            self.session.call(self.hung, 'GetVotes', ('a', 'poll'))
+        other = self.peers[1].poll_session.tube.bus_name
+        self.session.call(other, 'GetVotes', ('a', 'poll'),
+                          lambda *args: done.append('reply'),
+                          lambda *args: done.append('error'))
+        settle(self.bus, self.peers)
+        self.assertEqual(len(done), 1)
+        self.assertEqual(len(self.timeouts), self.session.MAX_PEER_CALLS)
+
+    def test_timeout_shrinks_while_peer_does_not_answer(self):
+        session = self.session
+        session.RETRY_DELAY = 1
+        session.call(self.hung, 'GetVotes', ('a', 'poll'))
+        for i in range(session.CALL_RETRIES):
+            error_handler = self.error_handlers.pop(0)
+            error_handler(DBusException(
+                'no reply', name='org.freedesktop.DBus.Error.NoReply'))
+            # Wait for the retry
+            loop = gobject.MainLoop()
+            gobject.timeout_add(10, loop.quit)
+            loop.run()
+        self.assertEqual(self.timeouts, [10, 5, 2, 2])
+
+
+class _HungRemote(object):
+    """Remote object of a peer which never answers.
+
+    timeouts -- list, gets the timeout of each call made
+    error_handlers -- list, gets the error handler of each call made,
+      for the test to time it out
+    """
+    def __init__(self, timeouts, error_handlers):
+        self._timeouts = timeouts
+        self._error_handlers = error_handlers
+
+    def __getattr__(self, name):
+        def call(*args, **keywords):
+            self._timeouts.append(keywords['timeout'])
+            self._error_handlers.append(keywords['error_handler'])
+        return call
+
+
+class PollRegistryTest(unittest.TestCase):
+
+    def test_add_refuses_a_second_poll_with_the_same_sha(self):
+        polls = PollRegistry()
+        first = Poll(title='title', author='author')
+        polls.add(first)
+        self.assertRaises(ValueError, polls.add,
+                          Poll(title='title', author='author'))
+        self.assertEqual(list(polls), [first])
+
+    def test_retitle_onto_another_poll_is_refused(self):
+        polls = PollRegistry()
+        first = Poll(title='first', author='author')
+        second = Poll(title='second', author='author')
+        polls.add(first)
+        polls.add(second)
+        self.assertRaises(ValueError, polls.retitle, second, 'first')
+        self.assertEqual(second.title, 'second')
+        self.assert_(polls.find('author', 'first') is first)
+        self.assert_(polls.find('author', 'second') is second)
+        polls.retitle(second, 'third')
+        self.assert_(polls.find('author', 'third') is second)
+
+
+class WireTest(unittest.TestCase):
+
+    def test_round_trip_skips_voters_that_are_not_sha1s(self):
+        poll = Poll(None, 'title', 'author', True, date.today(), 20, 'Q?',
+                    2, {0: 'Yes', 1: 'No'}, {0: 1, 1: 2},
+                    [('a' * 40, 1), ('a' * 40, 1), ('bar', 0)])
+        fields = wire.decode_poll(wire.encode_poll(poll))
+        self.assertEqual(fields[:9], ('title', 'author', True, date.today(),
+                                      20, 'Q?', 2, {0: 'Yes', 1: 'No'},
+                                      {0: 1, 1: 2}))
+        self.assertEqual(fields[9], [('a' * 40, 1, 2)])
+
+    def test_counts_round_trip(self):
+        counts = [('a' * 40, 1, 2), ('b' * 40, 0, 1), ('bar', 0, 1)]
+        packed = wire.encode_counts(counts)
+        self.assertEqual(wire.decode_counts(packed), counts[:2])
+        self.assertEqual(wire.decode_counts(wire.encode_counts([])), [])
+        self.assertRaises(ValueError, wire.decode_counts, packed[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
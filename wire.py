@@ -0,0 +1,249 @@
+# Copyright 2007 World Wide Workshop Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""Wire format of the polls sent by UpdatedPoll and the votes GetVotes
+returns.
+
+UpdatePoll keeps its older signature of D-Bus values, for the peers
+which call it.
+
+A poll travels as a single byte array (D-Bus signature 'ay') rather
+than as a struct of D-Bus values, so the receiver unpacks it in one go
+instead of converting every dict key and value. All integers are
+big-endian:
+
+  uint8 version
+  title, author, question
+  uint8 active, uint32 createdate ordinal, uint32 maxvoters,
+  uint8 number_of_options
+  uint8 option count, then per option uint8 key, text
+  uint8 tally count, then one uint32 per tally
+  the vote entries
+
+GetVotes returns the vote entries on their own, as laid out by
+encode_counts:
+
+  uint32 number of vote entries, then the entries column by column:
+    the 20 byte sha1 digest of each voter, the uint8 choice of each
+    entry and the uint32 number of votes for that choice
+
+where each string is a uint16 length followed by the UTF-8 bytes. Voter
+sha1s are sent as raw digests rather than 40 hex digits, and keeping
+each column together lets them all be converted in one go. The entries
+of one voter are in the order of Poll.vote_counts, so the choice the
+voter made last comes last. Entries whose voter is not a sha1 of 40
+hex digits cannot be packed and are left out.
+
+decode_poll() refuses versions other than VERSION, so the layout can
+change without older peers misreading it.
+"""
+
+import re
+import sys
+import struct
+from array import array
+from binascii import hexlify, unhexlify
+from datetime import date
+
+VERSION = 1
+
+_VERSION = struct.Struct('>B')
+_HEAD = struct.Struct('>BIIB')
+_STRING = struct.Struct('>H')
+_SMALL_COUNT = struct.Struct('>B')
+_COUNT = struct.Struct('>I')
+
+_SHA1 = re.compile('[0-9a-fA-F]{40}$')
+
+# array typecode of a uint32
+_UINT32 = [code for code in 'IL' if array(code).itemsize == 4][0]
+
+
+def _to_str(value):
+    """Convert a (possibly dbus) string to a byte string."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _encode_string(value):
+    value = _to_str(value)
+    return _STRING.pack(len(value)) + value
+
+
+def _decode_string(buf, offset):
+    (length,) = _STRING.unpack_from(buf, offset)
+    offset += _STRING.size
+    value = buf[offset:offset + length]
+    if len(value) != length:
+        raise ValueError('Truncated poll')
+    return value, offset + length
+
+
+def encode_poll(poll):
+    """Return poll packed as a byte string.
+
+    poll -- Poll; votes by voters that are not 40 hex digits are
+      left out
+    """
+    options = poll.options
+    data = poll.data
+    parts = [_VERSION.pack(VERSION), _encode_string(poll.title),
+             _encode_string(poll.author), _encode_string(poll.question),
+             _HEAD.pack(bool(poll.active), poll.createdate.toordinal(),
+                        int(poll.maxvoters), int(poll.number_of_options)),
+             _SMALL_COUNT.pack(len(options))]
+    for key in options:
+        parts.append(_SMALL_COUNT.pack(int(key)))
+        parts.append(_encode_string(options[key]))
+    tally = [int(data[key]) for key in sorted(data.keys())]
+    parts.append(struct.pack('>B%dI' % len(tally), len(tally), *tally))
+    parts.append(encode_counts(poll.vote_counts()))
+    return ''.join(parts)
+
+
+def encode_counts(counts):
+    """Return vote entries packed as a byte string.
+
+    counts -- list of (votersha, choice, count) as returned by
+      Poll.vote_counts; entries whose voter is not 40 hex digits are
+      left out
+    """
+    digests, counts = _pack_voters(counts)
+    parts = [_COUNT.pack(len(counts))]
+    if counts:
+        shas, choices, numbers = zip(*counts)
+        parts.append(digests)
+        parts.append(array('B', choices).tostring())
+        parts.append(_uint32_string(numbers))
+    return ''.join(parts)
+
+
+def _pack_voters(counts):
+    """Return the packed voter digests of counts, and the entries packed.
+
+    counts -- list of (votersha, choice, count)
+
+    Entries whose voter is not 40 hex digits are left out. Checking
+    each voter is only needed when the whole column fails to unpack.
+    """
+    shas = [entry[0] for entry in counts]
+    if set(map(len, shas)) == set([40]):
+        try:
+            return unhexlify(''.join(shas)), counts
+        except TypeError:
+            pass
+    counts = [entry for entry in counts if _SHA1.match(entry[0])]
+    return unhexlify(''.join([entry[0] for entry in counts])), counts
+
+
+def _uint32_string(values):
+    """Return values packed as big-endian uint32s."""
+    values = array(_UINT32, values)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values.tostring()
+
+
+def _uint32_array(buf, offset, count):
+    """Return an array of the count big-endian uint32s at offset."""
+    values = array(_UINT32, buf[offset:offset + 4 * count])
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def decode_poll(buf):
+    """Unpack a poll packed by encode_poll.
+
+    buf -- string, or dbus.ByteArray
+
+    Returns a (title, author, active, createdate, maxvoters, question,
+    number_of_options, options, data, counts) tuple, in the order of the
+    Poll constructor arguments following activity. counts is a list of
+    (votersha, choice, count) as returned by Poll.vote_counts; see
+    vote_pairs for the votes argument of Poll.
+
+    Raises ValueError if buf is not a poll of this VERSION.
+    """
+    buf = str(buf)
+    try:
+        (version,) = _VERSION.unpack_from(buf)
+        if version != VERSION:
+            raise ValueError('Unsupported poll version %d' % version)
+        offset = _VERSION.size
+        title, offset = _decode_string(buf, offset)
+        author, offset = _decode_string(buf, offset)
+        question, offset = _decode_string(buf, offset)
+        active, createdate, maxvoters, number_of_options = \
+            _HEAD.unpack_from(buf, offset)
+        offset += _HEAD.size
+
+        (num_options,) = _SMALL_COUNT.unpack_from(buf, offset)
+        offset += _SMALL_COUNT.size
+        options = {}
+        for i in xrange(num_options):
+            (key,) = _SMALL_COUNT.unpack_from(buf, offset)
+            options[key], offset = _decode_string(buf,
+                                                  offset + _SMALL_COUNT.size)
+
+        (num_tallies,) = _SMALL_COUNT.unpack_from(buf, offset)
+        offset += _SMALL_COUNT.size
+        data = dict(enumerate(struct.unpack_from('>%dI' % num_tallies,
+                                                 buf, offset)))
+        offset += 4 * num_tallies
+    except struct.error, e:
+        raise ValueError('Truncated poll: %s' % e)
+    counts = decode_counts(buf, offset)
+    return (title, author, bool(active), date.fromordinal(createdate),
+            maxvoters, question, number_of_options, options, data, counts)
+
+
+def decode_counts(buf, offset=0):
+    """Unpack vote entries packed by encode_counts.
+
+    buf -- string, or dbus.ByteArray
+    offset -- integer, where the entries start; they must end buf
+
+    Returns a list of (votersha, choice, count). Raises ValueError if
+    buf does not hold exactly the entries.
+    """
+    buf = str(buf)
+    try:
+        (num_entries,) = _COUNT.unpack_from(buf, offset)
+    except struct.error, e:
+        raise ValueError('Truncated votes: %s' % e)
+    offset += _COUNT.size
+    if len(buf) - offset != 25 * num_entries:
+        raise ValueError('%d bytes of votes for %d entries' %
+                         (len(buf) - offset, num_entries))
+    shas = hexlify(buf[offset:offset + 20 * num_entries])
+    offset += 20 * num_entries
+    choices = array('B', buf[offset:offset + num_entries])
+    offset += num_entries
+    numbers = _uint32_array(buf, offset, num_entries)
+    return zip([shas[i:i + 40] for i in xrange(0, len(shas), 40)],
+               choices, numbers)
+
+
+def vote_pairs(counts):
+    """Return counts as a list of (votersha, choice) pairs, one per vote.
+
+    counts -- list of (votersha, choice, count), see decode_poll
+    """
+    return [(votersha, choice) for votersha, choice, count in counts
+            for i in xrange(count)]